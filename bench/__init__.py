@@ -0,0 +1,10 @@
+"""
+Picomon benchmarks.
+
+Synthetic configurations of any size are run against local stand-in
+services (see bench.stubs) and fake external commands (see bench.fakebin),
+measuring scheduling lateness, throughput, CPU time, memory and mail
+throughput.  Run ``python -m bench.run --help`` from the top of the source
+tree.
+
+"""
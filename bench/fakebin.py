@@ -0,0 +1,45 @@
+"""
+Fake external commands standing in for ping and the Nagios plugins.
+
+They sleep for $FAKE_LATENCY seconds and fail for $FAKE_FAILURE out of 1000
+invocations (picked from their pid), printing output matching what the
+checks expect.  They are plain shell scripts, so that benchmarks measure
+picomon rather than interpreter startups.
+
+"""
+
+
+import os
+import tempfile
+
+SCRIPT = """#!/bin/sh
+sleep "${FAKE_LATENCY:-0}"
+if [ $(($$ % 1000)) -lt "${FAKE_FAILURE:-0}" ]; then
+    echo "FAKE CRITICAL - $0 $*"
+    exit 2
+fi
+echo "FAKE OK - status: NOERROR - $0 $*"
+exit 0
+"""
+
+COMMANDS = ('ping', 'ping6', 'check_http', 'check_smtp', 'check_jabber',
+            'check_udp', 'check_dns_soa', 'dig', 'check_fake')
+
+
+def create(latency=0, failure_rate=0, directory=None):
+    """ Create the fake commands in directory (a new temporary one by
+    default) and set the environment for them, returns the directory """
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='picomon-bench-')
+    script = os.path.join(directory, 'fake')
+    with open(script, 'w') as f:
+        f.write(SCRIPT)
+    os.chmod(script, 0o755)
+    for command in COMMANDS:
+        path = os.path.join(directory, command)
+        if not os.path.exists(path):
+            os.symlink(script, path)
+    os.environ['FAKE_LATENCY'] = '%f' % latency
+    os.environ['FAKE_FAILURE'] = str(int(failure_rate * 1000))
+    os.environ['PATH'] = directory + os.pathsep + os.environ.get('PATH', '')
+    return directory
@@ -0,0 +1,263 @@
+"""
+Benchmark harness.
+
+``load`` runs a synthetic configuration of --checks checks (built through
+Checks.add) for --duration seconds against local stand-in services and fake
+commands, then reports how late checks started, how many ran per second, the
+CPU time and peak memory used, and how many alert emails went out.
+``micro`` times single calls of Check.run() and exec_with_timeout().
+
+Results are printed (or written to --output) as JSON, to be compared across
+commits.
+
+"""
+
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from threading import Thread
+
+from picomon import config, mails, metrics, report, scheduler
+from picomon.checks import (Check, Check4, Checks, CheckDNSRec4, CheckHTTP4,
+                            CheckPing4, CheckSMTP4, Host,
+                            resolve_dependencies)
+from . import fakebin
+
+
+class FakeCheck(Check4):
+    def build_command(self):
+        return ['check_fake', self.addr]
+
+
+class FakePing(CheckPing4):
+    ping_command = 'ping'
+
+
+class NullCheck(Check):
+    def check(self):
+        return True
+
+
+def kinds(ports):
+    """ Check classes and options of each kind of check """
+    return {'ping': (CheckPing4, {}),
+            'ping-exec': (FakePing, {'native': False}),
+            'http': (CheckHTTP4, {'port': ports['http']}),
+            'dns': (CheckDNSRec4, {'port': ports['dns'],
+                                   'qname': 'bench.test'}),
+            'smtp': (CheckSMTP4, {'port': ports['smtp']}),
+            'exec': (FakeCheck, {})}
+
+
+def loopback(i):
+    """ A distinct loopback address per check, for ICMP """
+    i, c = divmod(i, 254)
+    a, b = divmod(i, 256)
+    return '127.%d.%d.%d' % (a % 256, b, c + 1)
+
+
+def quantile(hist, q):
+    total = sum(hist.counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, n in zip(metrics.BUCKETS + (float('inf'),), hist.counts):
+        seen += n
+        if seen >= q * total:
+            return bound
+
+
+def summary(hist):
+    total = sum(hist.counts)
+    return {'count': total,
+            'mean': hist.sum / total if total else None,
+            'p50': quantile(hist, 0.5),
+            'p90': quantile(hist, 0.9),
+            'p99': quantile(hist, 0.99)}
+
+
+def rusage():
+    usage = {}
+    for who, name in ((resource.RUSAGE_SELF, 'self'),
+                      (resource.RUSAGE_CHILDREN, 'children')):
+        r = resource.getrusage(who)
+        usage[name] = {'user': r.ru_utime, 'system': r.ru_stime,
+                       'max_rss_kb': r.ru_maxrss}
+    return usage
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'commit': commit}
+
+
+def start_stubs(latency, failure_rate):
+    stubs = subprocess.Popen([sys.executable, '-m', 'bench.stubs',
+                              '--latency', str(latency),
+                              '--failure-rate', str(failure_rate)],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return stubs, json.loads(stubs.stdout.readline().decode())
+
+
+def build_checks(count, names, ports, every, timeout):
+    available = kinds(ports)
+    checks = Checks()
+    for i in range(count):
+        cls, options = available[names[i % len(names)]]
+        addr = loopback(i) if cls is CheckPing4 else '127.0.0.1'
+        # the n option makes each check distinct, so that none share results
+        checks.add(cls, Host(ipv4=addr, name='bench%d' % i), n=i,
+                   every=every, timeout=timeout, **options)
+    return checks
+
+
+def load(args):
+    fakebin.create(args.latency, args.failure_rate)
+    stubs, ports = start_stubs(args.latency, args.failure_rate)
+
+    config.base_tick = args.tick
+    config.emails.to = ['bench@localhost']
+    config.emails.smtp_host = '127.0.0.1:%d' % ports['mail']
+    config.scheduler.mode = args.mode
+    checks = build_checks(args.checks, args.kinds.split(','), ports,
+                          args.every, args.timeout)
+    config.checks = checks
+    resolve_dependencies(checks, auto=False)
+    report.index.reset(checks)
+    mails.start()
+
+    limits = scheduler.Limits(0)
+    if args.mode == 'asyncio':
+        from picomon import aio
+        target = lambda: aio.run(checks, args.tick, args.concurrency,
+                                 args.workers, limits=limits)
+    else:
+        target = lambda: scheduler.run_threads(checks, args.tick,
+                                               args.workers, limits=limits)
+    before = rusage()
+    start = time.monotonic()
+    Thread(target=target, daemon=True).start()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - start
+    after = rusage()
+
+    duration = metrics.Histogram()
+    lateness = metrics.Histogram()
+    successes = failures = overruns = 0
+    for check in checks:
+        duration.add(check.stats.duration)
+        lateness.add(check.stats.lateness)
+        successes += check.stats.successes
+        failures += check.stats.failures
+        overruns += check.overruns
+    runs = successes + failures
+    sent = mails.counters()['sent']
+
+    stubs.stdin.close()
+    stubs.wait()
+    cpu = dict((who, dict((k, after[who][k] - before[who][k])
+                          for k in ('user', 'system')))
+               for who in after)
+    return {'runs': runs,
+            'checks_per_second': runs / elapsed,
+            'successes': successes,
+            'failures': failures,
+            'overruns': overruns,
+            'lateness_seconds': summary(lateness),
+            'duration_seconds': summary(duration),
+            'cpu_seconds': cpu,
+            'peak_rss_kb': after['self']['max_rss_kb'],
+            'mails': {'sent': sent, 'per_second': sent / elapsed,
+                      'queued': mails.queue_size()}}
+
+
+def micro(args):
+    fakebin.create(args.latency, 0)
+    check = NullCheck(every=1)
+    durations = {}
+    calls = {'run': lambda: check.run(immediate=True),
+             'exec': lambda: check.exec_with_timeout(['check_fake'])}
+    for name in args.calls.split(','):
+        call = calls[name]
+        times = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - start)
+        times.sort()
+        durations[name] = {'iterations': len(times),
+                           'mean': sum(times) / len(times),
+                           'p50': times[len(times) // 2],
+                           'p99': times[int(len(times) * 0.99)]}
+    return {'call_seconds': durations, 'cpu_seconds': rusage()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help='write results to this file')
+    sub = parser.add_subparsers(dest='benchmark')
+    sub.required = True
+
+    p = sub.add_parser('load', help='run a synthetic configuration')
+    p.add_argument('--checks', type=int, default=1000)
+    p.add_argument('--kinds', default='ping,http,dns,smtp,exec',
+                   help='comma separated kinds of checks, among: %s' %
+                   ', '.join(sorted(kinds(dict.fromkeys(('http', 'dns',
+                                                         'smtp'), 0)))))
+    p.add_argument('--duration', type=float, default=30,
+                   help='seconds to run for')
+    p.add_argument('--tick', type=float, default=1,
+                   help='base_tick, in seconds')
+    p.add_argument('--every', type=int, default=5)
+    p.add_argument('--timeout', type=float, default=2)
+    p.add_argument('--mode', choices=('threads', 'asyncio'),
+                   default='threads')
+    p.add_argument('--workers', type=int, default=5)
+    p.add_argument('--concurrency', type=int, default=256)
+    p.add_argument('--latency', type=float, default=0.01,
+                   help='seconds stand-in services take to answer')
+    p.add_argument('--failure-rate', type=float, default=0.01,
+                   help='share of stand-in answers which fail')
+    p.set_defaults(run=load)
+
+    p = sub.add_parser('micro', help='time single calls')
+    p.add_argument('--calls', default='run,exec',
+                   help='comma separated calls to time, among: run, exec')
+    p.add_argument('--iterations', type=int, default=1000)
+    p.add_argument('--latency', type=float, default=0,
+                   help='seconds the fake command takes')
+    p.set_defaults(run=micro)
+
+    args = parser.parse_args()
+    params = dict((k, v) for (k, v) in vars(args).items()
+                  if k not in ('run', 'output'))
+    results = {'benchmark': args.benchmark, 'params': params,
+               'environment': environment(), 'results': args.run(args)}
+    output = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+    sys.stdout.flush()
+    # checks are run by daemon threads which never return
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Local stand-in services: an HTTP server, a DNS server, and SMTP servers for
+SMTP checks and for alert emails, each answering after `latency` seconds and
+failing a `failure_rate` share of requests (but the mail sink, which never
+fails).
+
+Run as ``python -m bench.stubs``: the ports of the services are printed as a
+JSON line, then they serve until stdin is closed.
+
+"""
+
+
+import argparse
+import heapq
+import json
+import random
+import socket
+import socketserver
+import struct
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Condition, Thread
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def http_server(latency, failure_rate):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def do_GET(self):
+            time.sleep(latency)
+            failed = random.random() < failure_rate
+            body = b'Failed\n' if failed else b'OK\n'
+            self.send_response(500 if failed else 200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _HTTPServer(('127.0.0.1', 0), Handler)
+
+
+def smtp_server(latency, failure_rate):
+    class Handler(socketserver.StreamRequestHandler):
+        def reply(self, line):
+            self.wfile.write(line.encode('ascii') + b'\r\n')
+
+        def handle(self):
+            time.sleep(latency)
+            if random.random() < failure_rate:
+                self.reply('554 bench stub busy')
+                return
+            self.reply('220 bench stub ready')
+            for line in self.rfile:
+                command = line.decode('ascii', 'replace').strip().upper()
+                if command.startswith('EHLO'):
+                    self.reply('250-bench')
+                    self.reply('250 8BITMIME')
+                elif command.startswith('DATA'):
+                    self.reply('354 go ahead')
+                    for data in self.rfile:
+                        if data == b'.\r\n':
+                            break
+                    self.reply('250 accepted')
+                elif command.startswith('QUIT'):
+                    self.reply('221 bye')
+                    return
+                else:
+                    self.reply('250 ok')
+
+    return _ThreadingServer(('127.0.0.1', 0), Handler)
+
+
+class DNSServer(object):
+    """Answers A queries with 127.0.0.1 (or SERVFAIL), after latency
+    seconds"""
+
+    def __init__(self, latency, failure_rate):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self._delayed = []
+        self._cond = Condition()
+
+    def answer(self, query):
+        end = 12
+        while query[end]:
+            end += query[end] + 1
+        question = query[12:end + 5]
+        if random.random() < self.failure_rate:
+            return query[:2] + struct.pack('!HHHHH', 0x8182, 1, 0, 0, 0) + \
+                question
+        return query[:2] + struct.pack('!HHHHH', 0x8180, 1, 1, 0, 0) + \
+            question + struct.pack('!HHHIH', 0xc00c, 1, 1, 60, 4) + \
+            socket.inet_aton('127.0.0.1')
+
+    def serve_forever(self):
+        Thread(target=self.__send_delayed, daemon=True).start()
+        while True:
+            query, addr = self.sock.recvfrom(512)
+            try:
+                reply = self.answer(query)
+            except (IndexError, struct.error):
+                continue
+            if self.latency <= 0:
+                self.sock.sendto(reply, addr)
+                continue
+            with self._cond:
+                heapq.heappush(self._delayed, (time.monotonic() +
+                                               self.latency, reply, addr))
+                self._cond.notify()
+
+    def __send_delayed(self):
+        while True:
+            with self._cond:
+                while not self._delayed or \
+                        self._delayed[0][0] > time.monotonic():
+                    self._cond.wait(self._delayed[0][0] - time.monotonic()
+                                    if self._delayed else None)
+                due, reply, addr = heapq.heappop(self._delayed)
+            self.sock.sendto(reply, addr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before answering')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='share of requests failing, from 0 to 1')
+    args = parser.parse_args()
+
+    servers = {'http': http_server(args.latency, args.failure_rate),
+               'dns': DNSServer(args.latency, args.failure_rate),
+               'smtp': smtp_server(args.latency, args.failure_rate),
+               'mail': smtp_server(0, 0)}
+    ports = {}
+    for name, server in servers.items():
+        ports[name] = server.port if name == 'dns' \
+            else server.server_address[1]
+        Thread(target=server.serve_forever, daemon=True).start()
+    print(json.dumps(ports))
+    sys.stdout.flush()
+    sys.stdin.read()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,62 @@ from picomon import config
 # (-1 ⇒ same as 'every')
 #config.default_error_every = -1
 
+# Default 'native' parameter for all checks: run probes in-process (ICMP
+# sockets...) rather than through external commands when possible
+#config.default_native = True
+
+# Derive timeouts from the duration of past runs, within 0.5 and 10 seconds
+#config.timeouts.adaptive = True
+#config.timeouts.min = 0.5
+#config.timeouts.max = 10
+
+# Threads running in-process HTTP(S) checks, and how long idle kept-alive
+# connections are kept for reuse
+#config.probes.http.workers = 32
+#config.probes.http.keepalive = 30
+
+# Bytes of stdout and of stderr kept from each external command
+#config.probes.exec.max_output = 65536
+
+# Scheduler: 'threads' or 'asyncio' (python >= 3.5), the latter running checks
+# as coroutines with at most 'concurrency' of them in flight
+#config.scheduler.mode = 'threads'
+#config.scheduler.concurrency = 256
+#config.scheduler.workers = 5
+
+# Run checks in 4 worker processes (split by target), the main one sending
+# emails and reports
+#config.shards.processes = 4
+#config.shards.sync_every = 5
+
+# Share the checks between 3 nodes, each started with --node <its address>
+#config.cluster.nodes = ['10.1.0.1:7400', '10.1.0.2:7400', '10.1.0.3:7400']
+#config.cluster.timeout = 5
+#config.cluster.secret = 'change me'
+
+# Caps on the checks in flight at once against a single target address and
+# per check class (subclasses included), none by default
+#config.scheduler.max_per_target = 2
+#config.scheduler.max_per_class = {'CheckHTTP': 50}
+
+# Serve Prometheus metrics (check durations, results, scheduler and mail queue
+# state) on http://localhost:9478/metrics
+#config.metrics.listen = 'localhost:9478'
+
+# Answer requests (list, get, run, mute, ack, subscribe...) on a Unix socket
+#config.control.path = '/run/picomon.sock'
+#config.control.mode = 0o660
+
+# Keep the outcome of the last million check runs, for availability queries
+# with picomon-history
+#config.history.path = '/var/lib/picomon/history'
+#config.history.records = 1000000
+
+# Save the state of checks (written every 'flush_every' seconds) to restore it
+# on restart, without alerting again about ongoing failures
+#config.state.path = '/var/lib/picomon/state'
+#config.state.flush_every = 5
+
 
 # Email notifications
 #####################
@@ -36,6 +92,19 @@ config.emails.to.append('them@localhost')
 # The SMTP host, with optional :port suffix
 #config.emails.smtp_host = 'localhost:25'
 
+# Number of SMTP connections sending emails in parallel, and how many emails
+# are sent in a row on one
+#config.emails.smtp_senders = 1
+#config.emails.batch_size = 20
+
+# Emails which couldn't be sent are retried after smtp_retry_timeout seconds,
+# doubling the delay after each failure up to smtp_retry_max
+#config.emails.smtp_retry_timeout = 60
+#config.emails.smtp_retry_max = 3600
+
+# Keep emails on disk until sent, so that none is lost on restart
+#config.emails.spool_dir = '/var/spool/picomon'
+
 # Subject template for state change email notifications
 # available substitutions:
 #   - state ("Problem" or "OK")
@@ -43,6 +112,16 @@ config.emails.to.append('them@localhost')
 #   - dest  (the target of the check ie. an IP or a Host's 'name' parameter)
 #config.emails.subject_tpl = "[DOMAIN] {state}: {check} on {dest}"
 
+# Collect state changes for 'window' seconds, sending a single digest email
+# (grouped by target and check class) when there are several
+#config.emails.coalesce.window = 30
+#config.emails.coalesce.subject_tpl = "[DOMAIN] {problems} problem(s), {recoveries} recovery(ies)"
+
+# Suppress notifications of checks changing state at least 'threshold' times
+# within 'window' seconds, until they settle down
+#config.emails.flap.window = 3600
+#config.emails.flap.threshold = 6
+
 # Interval in seconds between global reports when some checks are in error
 # 0 disables reports
 #config.emails.report.every = 0
@@ -51,6 +130,15 @@ config.emails.to.append('them@localhost')
 #config.emails.report.subject = "[DOMAIN] Picomon report"
 
 
+# Identical checks (same class, address and probe options, under different
+# hosts or periods) share results for 'ttl' seconds instead of running again
+#config.sharing.ttl = 10
+
+# Make checks on a Host depend on its ping checks, so that they are skipped
+# (and not alerted about) while it's down
+#config.dependencies.auto = True
+
+
 # Hosts
 #######
 
@@ -71,6 +159,7 @@ halfday = 43200 / config.base_tick
 config.checks.add([CheckPing4, CheckPing6], [localhost, h1], retry=2, every=5)
 #config.checks.add(CheckDNSZone, ["example.net", "example.org"], ip_version=4)
 #config.checks.add(CheckDNSRec4, [h1])
+#config.checks.add(CheckDNSRec6, [h1], qname='example.org', qtype='AAAA')
 #config.checks.add(CheckJabber6, [h1])
 #config.checks.add(CheckSMTP4, [h1])
 #config.checks.add(CheckSMTP6, [unnamed, v6only])
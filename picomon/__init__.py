@@ -3,49 +3,188 @@ from .attrtree import AttrTree
 from .checks import Checks
 
 
-config = AttrTree()
-
-# the list of checks
-config.install_attr('checks', Checks())
-
-# This is the base granularity (in seconds) for polling
-# Each check may then individually be configured to run every N * tick
-config.install_attr('base_tick', 60)
-
-# Default "every" check parameter, can be overridden on a per-check basis
-config.install_attr('default_every', 1)
-
-# Default "error_every" (how often we retry checks that are in error) parameter
-# -1 disables feature (same as regular "every"), can be also be overridden
-config.install_attr('default_error_every', -1)
-
-# Verbosity level (one of CRITICAL, ERROR, WARNING, INFO, DEBUG)
-config.install_attr('verb_level', 'INFO')
-
-# Email addresses to send to when an alert is triggered
-config.install_attr('emails.to', [])
-# The From: address
-config.install_attr('emails.addr_from',
-                    'Picomon <picomon@%s>' % socket.getfqdn())
-# The SMTP host, with optional :port suffix
-config.install_attr('emails.smtp_host', 'localhost:25')
-# The inactive timeout after which to close the SMTP connection
-config.install_attr('emails.smtp_keepalive_timeout', 60)
-# Timeout after which to retry sending emails after a failure
-config.install_attr('emails.smtp_retry_timeout', 60)
-# Interval in seconds between global reports when some checks are in error
-# 0 disables reports
-config.install_attr('emails.report.every', 0)
-
-# Subject template for state change email notifications
-# available substitutions:
-#   - state ("Problem" or "OK")
-#   - check (check's name, like "CheckDNSRec6")
-#   - dest  (the target of the check ie. an IP or a Host's 'name'
-#            parameter)
-config.install_attr('emails.subject_tpl',
-                    '[DOMAIN] {state}: {check} on {dest}')
-# reports email subject
-config.install_attr('emails.report.subject', '[DOMAIN] Picomon error report')
-# watchdog error email subject
-config.install_attr('emails.watchdog_subject', '[DOMAIN] Picomon stopped')
+def default_config():
+    """ Return a new config tree holding the default settings """
+    config = AttrTree()
+
+    # the list of checks
+    config.install_attr('checks', Checks())
+
+    # This is the base granularity (in seconds) for polling
+    # Each check may then individually be configured to run every N * tick
+    config.install_attr('base_tick', 60)
+
+    # Default "every" check parameter, can be overridden on a per-check basis
+    config.install_attr('default_every', 1)
+
+    # Default "error_every" (how often we retry checks that are in error)
+    # parameter
+    # -1 disables feature (same as regular "every"), can be also be overridden
+    config.install_attr('default_error_every', -1)
+
+    # Default "native" check parameter: use in-process probe engines (ICMP
+    # sockets...) instead of external commands when available
+    config.install_attr('default_native', True)
+
+    # Derive the timeout of checks from the duration of their past successful
+    # runs rather than using their timeout option, so that runs against
+    # hung fast targets give up early and slow targets don't time out.  Can
+    # be overridden on a per-check basis with the adaptive_timeout option.
+    config.install_attr('timeouts.adaptive', False)
+    # Bounds (in seconds) of adaptive timeouts, can be overridden on a
+    # per-check basis with the min_timeout and max_timeout options
+    config.install_attr('timeouts.min', 0.5)
+    config.install_attr('timeouts.max', 10)
+    # Mean deviations of the duration of runs allowed over their smoothed
+    # mean
+    config.install_attr('timeouts.deviations', 4)
+    # Successful runs after which adaptive timeouts apply, the timeout
+    # option being used until then
+    config.install_attr('timeouts.min_samples', 5)
+
+    # Number of threads running in-process HTTP(S) probes
+    config.install_attr('probes.http.workers', 32)
+    # Idle time in seconds after which kept-alive HTTP connections are dropped
+    # rather than reused
+    config.install_attr('probes.http.keepalive', 30)
+
+    # Recursive resolvers used by in-process DNS zone checks to find name
+    # servers, defaults to those of /etc/resolv.conf
+    config.install_attr('probes.dns.resolvers', [])
+
+    # Maximum number of bytes of stdout and of stderr kept from external
+    # commands
+    config.install_attr('probes.exec.max_output', 65536)
+
+    # Make checks on a Host depend on its ping checks (of the same address
+    # family), and ping checks on those of its parent hosts: checks are then
+    # skipped while these fail, instead of alerting too
+    config.install_attr('dependencies.auto', False)
+
+    # Seconds during which the result of a check is shared with identical
+    # checks (same class, address and probe options) instead of running them
+    config.install_attr('sharing.ttl', 10)
+
+    # Number of worker processes checks are spread over (by target), the main
+    # process sending emails and reports.  0 runs checks in the main process.
+    config.install_attr('shards.processes', 0)
+    # Interval (in seconds) between updates of the run statistics (metrics) of
+    # checks sent by worker processes
+    config.install_attr('shards.sync_every', 5)
+
+    # Addresses (host:port, UDP) of all the nodes of a cluster sharing this
+    # configuration, each running its share of the checks.  Empty runs all
+    # checks on this node.
+    config.install_attr('cluster.nodes', [])
+    # Address of this node among cluster.nodes, overridden by --node
+    config.install_attr('cluster.node', '')
+    # Interval (in seconds) between heartbeats sent to the other nodes
+    config.install_attr('cluster.heartbeat', 1)
+    # Seconds without a heartbeat after which a node is considered down and
+    # its checks taken over, to be kept below base_tick
+    config.install_attr('cluster.timeout', 5)
+    # Interval (in seconds) between resends of the state of all owned checks
+    # to the other nodes, in case of lost datagrams
+    config.install_attr('cluster.sync_every', 30)
+    # Shared secret signing messages between nodes, empty not to sign them
+    config.install_attr('cluster.secret', '')
+
+    # How checks are scheduled: 'threads' runs checks in a thread pool, while
+    # 'asyncio' (python >= 3.5) runs them as coroutines on an event loop
+    config.install_attr('scheduler.mode', 'threads')
+    # Maximum number of checks in flight at once in 'asyncio' mode
+    config.install_attr('scheduler.concurrency', 256)
+    # Number of threads running checks which can't run in-process or as
+    # coroutines (all of them in 'threads' mode)
+    config.install_attr('scheduler.workers', 5)
+    # Maximum number of checks in flight at once against the same target
+    # address, 0 for no limit
+    config.install_attr('scheduler.max_per_target', 0)
+    # Maximum number of checks in flight at once per check class name, applying
+    # to subclasses too, e.g. {'CheckHTTP': 50}
+    config.install_attr('scheduler.max_per_class', {})
+
+    # Address ('host:port') of the HTTP endpoint serving Prometheus metrics,
+    # empty not to serve them
+    config.install_attr('metrics.listen', '')
+
+    # File the outcome of every check run is appended to, a ring of
+    # history.records records (24 bytes each) overwriting the oldest ones,
+    # for availability queries (picomon-history).  Empty not to keep history.
+    config.install_attr('history.path', '')
+    config.install_attr('history.records', 1000000)
+
+    # Path of the Unix socket serving control requests (see picomon.control),
+    # and its permissions.  Empty disables it.
+    config.install_attr('control.path', '')
+    config.install_attr('control.mode', 0o600)
+
+    # File the state of checks is saved to, so that restarts don't forget
+    # ongoing failures nor alert about them again, empty not to save it
+    config.install_attr('state.path', '')
+    # Interval (in seconds) between writes of changed states
+    config.install_attr('state.flush_every', 5)
+
+    # Verbosity level (one of CRITICAL, ERROR, WARNING, INFO, DEBUG)
+    config.install_attr('verb_level', 'INFO')
+
+    # Email addresses to send to when an alert is triggered
+    config.install_attr('emails.to', [])
+    # The From: address
+    config.install_attr('emails.addr_from',
+                        'Picomon <picomon@%s>' % socket.getfqdn())
+    # The SMTP host, with optional :port suffix
+    config.install_attr('emails.smtp_host', 'localhost:25')
+    # The inactive timeout after which to close the SMTP connection
+    config.install_attr('emails.smtp_keepalive_timeout', 60)
+    # Timeout after which to retry sending emails after a failure
+    config.install_attr('emails.smtp_retry_timeout', 60)
+    # Maximum delay between tries (the delay doubles after each failure)
+    config.install_attr('emails.smtp_retry_max', 3600)
+    # Number of SMTP connections sending emails in parallel
+    config.install_attr('emails.smtp_senders', 1)
+    # Maximum number of emails sent in a row on a connection
+    config.install_attr('emails.batch_size', 20)
+    # Maximum number of emails waiting to be sent, more are dropped (0 for no
+    # limit)
+    config.install_attr('emails.queue_size', 1000)
+    # Directory emails are kept in until sent, so that those which couldn't be
+    # sent before picomon exited are sent on next start. Empty to disable.
+    config.install_attr('emails.spool_dir', '')
+    # Interval in seconds between global reports when some checks are in error
+    # 0 disables reports
+    config.install_attr('emails.report.every', 0)
+
+    # Subject template for state change email notifications
+    # available substitutions:
+    #   - state ("Problem" or "OK")
+    #   - check (check's name, like "CheckDNSRec6")
+    #   - dest  (the target of the check ie. an IP or a Host's 'name'
+    #            parameter)
+    config.install_attr('emails.subject_tpl',
+                        '[DOMAIN] {state}: {check} on {dest}')
+    # Seconds during which state changes are collected before being notified,
+    # as a single digest email when there are several. 0 notifies them right
+    # away.
+    config.install_attr('emails.coalesce.window', 0)
+    # Subject template for digest emails, available substitutions:
+    #   - problems, recoveries (number of checks which failed/recovered)
+    #   - flapping (number of checks which started flapping)
+    config.install_attr('emails.coalesce.subject_tpl',
+                        '[DOMAIN] {problems} problem(s), '
+                        '{recoveries} recovery(ies)')
+    # Checks changing state at least 'threshold' times within 'window' seconds
+    # are flapping: their notifications are suppressed until they settle down.
+    # 0 disables flap damping.
+    config.install_attr('emails.flap.window', 3600)
+    config.install_attr('emails.flap.threshold', 0)
+    # reports email subject
+    config.install_attr('emails.report.subject',
+                        '[DOMAIN] Picomon error report')
+    # watchdog error email subject
+    config.install_attr('emails.watchdog_subject', '[DOMAIN] Picomon stopped')
+
+    return config
+
+
+config = default_config()
@@ -8,55 +8,43 @@ from a python programme with ``picomon.__main__.run()``.
 """
 
 
-import concurrent.futures
 import signal
 import argparse
 import logging
-import traceback
 import sys
 import os
-from time import sleep
-from datetime import datetime, timedelta
+from . import checks
+from . import cluster
 from . import config
+from . import control
+from . import history
 from . import mails
+from . import metrics
+from . import reload
+from . import report
+from . import scheduler
+from . import shards
+from . import state
 
 
-def __create_report(only_old=False):
-    has_error = False
-    report = ''
-    report += "\n    Checks in error:\n"
-    now = datetime.now()
-    delta = timedelta(seconds=config.emails.report.every)
-    for check in config.checks:
-        if not check.ok and (not only_old or now - check.failure_date > delta):
-            has_error = True
-            report += '-+' * 40 + '\n'
-            report += "%s: %s\nSince %s\n\t%s\n" % (check.target_name, check,
-                      check.failure_date, check.errmsg.strip())
-    report += '-+' * 40 + "\n\n"
-    report += "    Other checks (usually OK but may be in retry mode):\n"
-    for check in config.checks:
-        if check.ok:
-            report += "Check %s is %s\n" % (check,
-                      "OK" if check.retry_count == 0 else "retrying")
-
-    return (report, has_error)
+__reporter = None
+__reloader = None
 
 
 def __usr1_handler(signum, frame):
-    (report, err) = __create_report()
-    print ("Signal SIGUSR1 caught, printing state of checks. (%s)" %
-           datetime.now())
-    print (report)
-    sys.stdout.flush()
+    # only queue the report, not to hold the main thread (nor start a run)
+    __reporter.dump()
 
 
 def __alarm_handler(signum, frame):
-    (report, err) = __create_report(only_old=True)
-    if err:
-        report = "Following entries have failed for more than %ss:\n" % \
-                 config.emails.report.every + report
-        mails.send_email_report(report)
+    # a single node of a cluster sends reports
+    if cluster.leads():
+        __reporter.mail(config.emails.report.every)
+
+
+def __hup_handler(signum, frame):
+    # the new configuration is evaluated and swapped in by a worker thread
+    __reloader.reload()
 
 
 def parse_args():
@@ -71,6 +59,9 @@ def parse_args():
     parser.add_argument("-c", "--config",
                         help="Set config file (defauts to config.py)",
                         default='config.py')
+    parser.add_argument("-n", "--node",
+                        help="Address of this node among cluster.nodes " +
+                             "(defaults to cluster.node)")
     return parser.parse_args()
 
 
@@ -92,6 +83,13 @@ def import_config(configfile):
         sys.exit(1)
 
 
+def __print_result(check, success):
+    if success:
+        print("Check %s successful!" % (str(check)))
+    else:
+        print("Check %s failed:\n%s" % (str(check), check.errmsg.strip()))
+
+
 def run():
     # Parse command line
     args = parse_args()
@@ -105,47 +103,88 @@ def run():
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
+    checks.resolve_dependencies(config.checks, config.dependencies.auto)
+
+    # start sending emails, including those spooled before a restart
+    mails.start()
+
+    if config.state.path and not args.one:
+        state.open_store(config.state.path, config.state.flush_every,
+                         config.checks)
+    report.index.reset(config.checks)
+
+    # checks run in worker processes, this one only coordinating them
+    coordinator = None
+    if config.shards.processes and not args.one:
+        coordinator = shards.Coordinator(args.config, config.shards.processes,
+                                         config.shards.sync_every,
+                                         logging.getLogger().level)
+
+    # checks are shared with the other nodes of a cluster, this one running
+    # its share of them
+    node = None
+    if config.cluster.nodes and not args.one:
+        address = args.node or config.cluster.node
+        if address not in config.cluster.nodes:
+            logging.critical("Node address '%s' not in cluster.nodes" %
+                             address)
+            sys.exit(1)
+        if coordinator is not None:
+            logging.critical("Clusters can't run checks in several "
+                             "processes (shards.processes)")
+            sys.exit(1)
+        node = cluster.start(address, config.cluster.nodes, config.checks,
+                             config.cluster.heartbeat, config.cluster.timeout,
+                             config.cluster.sync_every,
+                             config.cluster.secret)
+
     # register signal handling
+    global __reporter, __reloader
+    __reporter = report.Reporter()
     signal.signal(signal.SIGUSR1, __usr1_handler)
     signal.signal(signal.SIGALRM, __alarm_handler)
+    if not args.one:
+        __reloader = reload.Reloader(args.config,
+                                     coordinator and coordinator.restart)
+        signal.signal(signal.SIGHUP, __hup_handler)
 
     # register report signal interval
     if config.emails.report.every > 0:
         signal.setitimer(signal.ITIMER_REAL, config.emails.report.every,
                                              config.emails.report.every)
 
+    if config.metrics.listen and not args.one:
+        metrics.serve(config.metrics.listen)
+
+    # workers keep the history of their own runs
+    if config.history.path and coordinator is None and not args.one:
+        history.open_ring(config.history.path, config.history.records)
+
+    if config.control.path and not args.one:
+        control.serve(config.control.path, config.control.mode)
+
     # do the actual polling
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        if args.one:
-            def runner(check):
-                return check.run(immediate=True), check
-
-            futures = []
-            for check in config.checks:
-                futures.append(executor.submit(runner, check))
-
-            for future in concurrent.futures.as_completed(futures):
-                success, check = future.result()
-                if success:
-                    print("Check %s successful!" % (str(check)))
-                else:
-                    print("Check %s failed:\n%s" %
-                          (str(check), check.errmsg.strip()))
-        else:
-            # Since we never reclaim finished tasks, exceptions raised during
-            # run are never seen. Using a runner we can at least display them.
-            def runner(check):
-                try:
-                    return check.run()
-                except Exception as e:
-                    traceback.print_exc()
-                    raise e
-
-            # This will drift slowly as it takes (base_tick + espilon) seconds
-            while True:
-                for check in config.checks:
-                    executor.submit(runner, check)
-                sleep(config.base_tick)
+    limits = scheduler.Limits(config.scheduler.max_per_target,
+                              config.scheduler.max_per_class)
+    # owned checks are handed to the scheduler by the node
+    running = config.checks if node is None else []
+    if coordinator is not None:
+        coordinator.run()
+    elif config.scheduler.mode == 'asyncio':
+        from . import aio
+        results = aio.run(running, config.base_tick,
+                          config.scheduler.concurrency,
+                          config.scheduler.workers, once=args.one,
+                          limits=limits)
+    else:
+        results = scheduler.run_threads(running, config.base_tick,
+                                        config.scheduler.workers,
+                                        once=args.one, limits=limits)
+    if args.one:
+        for check, success in zip(config.checks, results):
+            __print_result(check, success)
+    state.quit()
+    history.quit()
     mails.quit()
 
 
@@ -0,0 +1,183 @@
+"""
+asyncio based scheduler.
+
+Checks run as coroutines: in-process probes are awaited directly, external
+commands are supervised by the shared process reactor (or spawned with
+asyncio.create_subprocess_exec without it) and only checks overriding
+check() still need a thread.  Needs python >= 3.5.
+
+"""
+
+
+import asyncio
+import concurrent.futures
+import logging
+import traceback
+from asyncio.subprocess import PIPE
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from . import sharing
+from .checks import Check
+from .scheduler import Scheduler, register
+
+
+class Runner(object):
+    """Runs checks as coroutines, with at most `concurrency` of them in
+    flight at once, and within the caps of limits (see scheduler.Limits)"""
+
+    def __init__(self, loop, concurrency, workers, limits=None):
+        self._loop = loop
+        self._limits = limits
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+
+    async def exec_with_timeout(self, check, command, timeout, pattern=''):
+        """ Coroutine equivalent of Check.exec_with_timeout() """
+        check.errmsg = ''
+        try:
+            p = await asyncio.create_subprocess_exec(*command, stdout=PIPE,
+                                                     stderr=PIPE)
+        except OSError as e:
+            check.errmsg = 'Check not available: ' + e.strerror
+            return False
+        try:
+            out, err = await asyncio.wait_for(p.communicate(), timeout)
+        except asyncio.TimeoutError:
+            try:
+                p.kill()
+            except ProcessLookupError:
+                pass  # already gone
+            await p.wait()
+            check.errmsg += "Operation timed out\n"
+            return False
+        return check.exec_result(p.returncode, out, err, pattern)
+
+    async def check(self, check):
+        """ Run the probe of check, returns its result """
+        future = check.probe()
+        if future is not None:
+            return await asyncio.wrap_future(future)
+        if type(check).check is Check.check:
+            command = check.build_command()
+            if command is not None:
+                timeout = check.command_timeout + check.command_grace
+                future = check.spawn(command, timeout, check.command_pattern)
+                if future is not None:
+                    return await asyncio.wrap_future(future)
+                return await self.exec_with_timeout(
+                    check, command, timeout, check.command_pattern)
+        # check() was overridden, it can only run synchronously
+        return await self._loop.run_in_executor(self._executor, check.check)
+
+    async def shared_check(self, check):
+        """ Run check, unless an identical one shares its result """
+        shared = sharing.shared()
+        future = shared.subscribe(check)
+        if future is not None:
+            return await asyncio.wrap_future(future)
+        future = shared.publish(check, concurrent.futures.Future())
+        try:
+            success = await self.check(check)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(success)
+        return success
+
+    async def run(self, check, immediate=False):
+        async with self._semaphore:
+            logging.debug('Running ' + str(check))
+            check.started = monotonic()
+            check.setup()
+            try:
+                success = await self.shared_check(check)
+            finally:
+                check.teardown()
+            check.record(success, immediate)
+        return check.ok
+
+    async def run_scheduled(self, check, scheduler):
+        try:
+            await self.run(check)
+        finally:
+            scheduler.done(check, self._loop.time())
+            self._wakeup.set()
+
+    def submit(self, coro):
+        """ Run coro in a background task, returns the task """
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self.__task_done)
+        return task
+
+    def __task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            exc = task.exception()
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    async def run_forever(self, checks, tick):
+        # the loop's clock is monotonic, so the schedule doesn't drift
+        scheduler = Scheduler(tick, now=self._loop.time(),
+                              limits=self._limits)
+        for check in checks:
+            scheduler.add(check, scheduler.epoch)
+        # checks added on reloads may be due before the next one
+        scheduler.wakeup = lambda: self._loop.call_soon_threadsafe(
+            self._wakeup.set)
+        register(scheduler)
+        while True:
+            for check in scheduler.pop_due(self._loop.time()):
+                self.submit(self.run_scheduled(check, scheduler))
+            # sleep until the next check is due, or until one finishes and
+            # is rescheduled earlier
+            self._wakeup.clear()
+            timeout = None
+            if scheduler.next_due() is not None:
+                timeout = max(0, scheduler.next_due() - self._loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_released(self, check, scheduler):
+        try:
+            return await self.run(check, immediate=True)
+        finally:
+            scheduler.release(check)
+            self._wakeup.set()
+
+    async def run_once(self, checks):
+        """ Run all checks immediately, returns their results in order """
+        scheduler = Scheduler(0, now=self._loop.time(), limits=self._limits,
+                              dependencies=False)
+        for check in checks:
+            scheduler.push(check, scheduler.epoch)
+        tasks = {}
+        while len(tasks) < len(checks):
+            self._wakeup.clear()
+            for check in scheduler.pop_due(self._loop.time()):
+                tasks[check] = self.submit(self.run_released(check,
+                                                             scheduler))
+            if len(tasks) < len(checks):
+                await self._wakeup.wait()
+        return await asyncio.gather(*[tasks[check] for check in checks])
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def run(checks, tick, concurrency, workers, once=False, limits=None):
+    """ Run checks forever (or only once) on a new event loop """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = Runner(loop, concurrency, workers, limits)
+    try:
+        if once:
+            return loop.run_until_complete(runner.run_once(checks))
+        loop.run_until_complete(runner.run_forever(checks, tick))
+    finally:
+        runner.close()
+        loop.close()
@@ -18,6 +18,17 @@ class AttrTree(object):
             sub.install_attr(stems[1], default)
             self._attrs[stems[0]] = sub
 
+    def update(self, other):
+        """ Set the values of the attributes of other (a tree installed with
+        the same defaults) on this one """
+        for key, value in other._attrs.items():
+            if isinstance(value, AttrTree):
+                if key not in self._attrs:
+                    self._attrs[key] = AttrTree()
+                self._attrs[key].update(value)
+            else:
+                self._attrs[key] = value
+
     def __getitem__(self, key):
         return self._attrs[key]
 
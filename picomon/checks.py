@@ -1,16 +1,48 @@
 from .subprocess_compat import TimeoutExpired, Popen, PIPE
+import math
 import re
+import socket
 import logging
+from . import cluster
+from . import history
 from . import mails
-from collections import Iterable
+from . import metrics
+from . import report
+from . import sharing
+from . import shards
+from . import state
+from collections.abc import Iterable
 from datetime import datetime
+from threading import local
+from time import monotonic
+from weakref import WeakValueDictionary
+try:
+    from . import probes
+except ImportError:
+    # in-process probes need the selectors module (python >= 3.4), checks
+    # then fall back to external commands
+    probes = None
+
+
+# the config tree of a configuration file being evaluated by this thread,
+# which the checks it creates take their defaults from (see picomon.reload)
+loading = local()
+
+
+def _config():
+    from . import config
+    tree = getattr(loading, 'config', None)
+    return tree if tree is not None else config
 
 
 class Host(object):
-    def __init__(self, ipv4='192.0.2.1', ipv6='2001:db8::1', name=None):
+    def __init__(self, ipv4='192.0.2.1', ipv6='2001:db8::1', name=None,
+                 parents=()):
         self.ipv4 = ipv4
         self.ipv6 = ipv6
         self.name = name if name is not None else "%s/%s" % (ipv4, ipv6)
+        # upstream hosts (routers...) this one is only reachable through
+        self.parents = list(parents)
 
     def __repr__(self):
         return '<Host ipv4="%s" ipv6="%s">' % (self.ipv4, self.ipv6)
@@ -26,12 +58,109 @@ class Checks(list):
             self += [check(d, **options) for d in dests]
 
 
+def resolve_dependencies(checks, auto=True):
+    """ Set the parents of checks: the checks given in their `depends`
+    option and, if auto, the ping checks of their host (of the same address
+    family), or of the parents of their host for ping checks """
+    pings = {}
+    for check in checks:
+        if isinstance(check, CheckPing) and isinstance(check, CheckIP):
+            key = (id(check.host), getattr(check, 'family', None))
+            pings.setdefault(key, []).append(check)
+    for check in checks:
+        parents = list(check.depends)
+        if auto and isinstance(check, CheckIP):
+            family = getattr(check, 'family', None)
+            hosts = check.host.parents if isinstance(check, CheckPing) \
+                else [check.host]
+            for host in hosts:
+                parents += pings.get((id(host), family), [])
+        check.parents = [p for p in parents if p is not check]
+
+    # a cycle would leave its checks unreachable for ever
+    done = set()
+    for check in checks:
+        if id(check) in done:
+            continue
+        stack = [(check, iter(check.parents))]
+        visiting = {id(check)}
+        while stack:
+            node, parents = stack[-1]
+            for parent in parents:
+                if id(parent) in visiting:
+                    raise ValueError('Dependency cycle through %s' % parent)
+                if id(parent) not in done:
+                    visiting.add(id(parent))
+                    stack.append((parent, iter(parent.parents)))
+                    break
+            else:
+                stack.pop()
+                visiting.discard(id(node))
+                done.add(id(node))
+
+
+class _Options(dict):
+    """Options of a check, a dict which can be weakly referenced"""
+    __slots__ = ('__weakref__',)
+
+
+# option dicts shared by the checks created with the same options, see
+# Check.__init__, gone with the last check using them (e.g. after a reload)
+_option_sets = WeakValueDictionary()
+
+
+def _intern_options(options):
+    """ Return a dict equal to options, shared by the checks with the same
+    options when their values are hashable """
+    try:
+        key = tuple((k, type(v), v) for (k, v) in sorted(options.items()))
+        return _option_sets.setdefault(key, _Options(options))
+    except TypeError:
+        return options
+
+
 class Check(object):
+    # Checks hold their state in slots rather than in a __dict__, as there
+    # may be tens of thousands of them.  Subclasses not declaring __slots__
+    # get a __dict__ and can set any attribute.  host and addr are set by
+    # CheckIP, but declared here so that the classes of each protocol can
+    # have slots of their own and still be mixed with Check4 and Check6.
+    __slots__ = ('depends', 'parents', 'unreachable', 'checked_at',
+                 'failing_since', '_options', 'retry', 'retry_count',
+                 'recovered_after', 'every', 'error_every', 'run_count',
+                 'errmsg', 'ok', 'target_name', '_timeout', 'native',
+                 'timings', 'phase', 'next_due', 'lateness', 'overruns',
+                 'running', 'started', 'stats', 'failure_date', 'mails_msgid',
+                 'muted', 'ack_date', 'history_id', 'host', 'addr')
+
+    # regular expression the output of build_command() has to match
+    command_pattern = ''
+    # attributes a run sets besides its result, copied to the identical
+    # checks sharing it
+    result_attrs = ('errmsg', 'timings')
+    # options which don't change what the probe does
+    alerting_options = ('every', 'error_every', 'retry', 'target_name')
+    # extra seconds given to build_command() over the check timeout, for
+    # commands enforcing the timeout on their own
+    command_grace = 0
+
     def __init__(self, **options):
-        from . import config
-        self._options    = options
+        config = _config()
+        # checks this one depends on, not part of its identity
+        self.depends     = tuple(options.pop('depends', ()))
+        self.parents     = self.depends
+        self.unreachable = False
+        # monotonic times of the last result, and of the first failure of
+        # the current streak
+        self.checked_at  = None
+        self.failing_since = None
+        # read-only, shared with the checks created with the same options
+        self._options    = _intern_options(options)
         self.retry       = options.get('retry', 1)
         self.retry_count = 0
+        # retry_count of the failing streak the check last recovered from,
+        # for the recovery email sent once retry_count is reset
+        self.recovered_after = 0
         self.every       = options.get('every', config.default_every)
         self.error_every = options.get('error_every', config.default_error_every)
         if self.error_every < 0:
@@ -41,6 +170,22 @@ class Check(object):
         self.ok          = True
         self.target_name = options.get('target_name', 'Unknown')
         self.timeout     = options.get('timeout', 2)
+        self.native      = options.get('native', config.default_native)
+        self.timings     = {}
+        # scheduling state, see picomon.scheduler
+        self.phase       = 0.0
+        self.next_due    = None
+        self.lateness    = 0.0
+        self.overruns    = 0
+        self.running     = False
+        self.started     = None
+        self.stats       = metrics.CheckStats()
+        # set through the control socket: no alert emails while muted, and
+        # the failure_date of the acknowledged failure
+        self.muted       = False
+        self.ack_date    = None
+        # id of the check in the history of runs, see picomon.history
+        self.history_id  = None
 
     def __repr__(self):
         return '{:<15s} N={}/{}, R={}/{}, {}'.format(self.__class__.__name__,
@@ -50,42 +195,236 @@ class Check(object):
                                                      self.retry,
                                                      self._options)
 
+    @property
+    def ident(self):
+        """ Stable identity of the check, the same across restarts """
+        return '%s %s %s' % (self.__class__.__name__, self.target_name,
+                             sorted(self._options.items()))
+
+    @property
+    def timeout(self):
+        """ Seconds a run may take: the timeout option or, with adaptive
+        timeouts and enough past runs, a bound on their duration within
+        min_timeout and max_timeout """
+        from . import config
+        latency = self.stats.latency
+        if not self._options.get('adaptive_timeout',
+                                 config.timeouts.adaptive) or \
+                latency.samples < config.timeouts.min_samples:
+            return self._timeout
+        timeout = latency.bound(config.timeouts.deviations)
+        if self.ok:
+            # doubled for each retry, not to alert about a target slower
+            # than usual (but not once failing, runs then only have to see
+            # it back to its usual self)
+            timeout *= 2 ** min(self.retry_count, 10)
+        return min(max(timeout, self._options.get('min_timeout',
+                                                  config.timeouts.min)),
+                   self._options.get('max_timeout', config.timeouts.max))
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+
+    @property
+    def command_timeout(self):
+        """ The timeout in whole seconds, as commands take it """
+        return int(math.ceil(self.timeout))
+
+    @property
+    def acknowledged(self):
+        """ Whether the current failure was acknowledged """
+        return not self.ok and self.ack_date is not None and \
+            self.ack_date == getattr(self, 'failure_date', None)
+
+    @property
+    def probe_key(self):
+        """ Identity of the probe: identical checks share their results """
+        options = sorted((k, v) for (k, v) in self._options.items()
+                         if k not in self.alerting_options)
+        return (type(self), getattr(self, 'addr', None) or self.target_name,
+                repr(options))
+
+    def blocked(self, since=None):
+        """ Return a check this one depends on which is failing, if any.
+        With since, also one which is retrying or which didn't report since
+        then, as it may be failing too """
+        for parent in self.parents:
+            if not parent.ok or parent.unreachable:
+                return parent
+            if since is not None and (parent.retry_count or
+                                      parent.checked_at is None or
+                                      parent.checked_at < since):
+                return parent
+        return None
+
+    def set_unreachable(self, unreachable):
+        """ Mark the check as (not) unreachable, because of a check it
+        depends on """
+        if unreachable != self.unreachable:
+            before = report.state_of(self)
+            self.unreachable = unreachable
+            if not shards.forward(self):
+                report.index.update(self, before)
+                cluster.publish(self)
+
     def setup(self):
         pass
 
     def teardown(self):
         pass
 
-    def check(self, host, addr):
-        pass
+    def build_command(self):
+        """ Return the external command implementing the check, if any """
+        return None
 
-    def run(self, immediate=False):
+    def check(self):
+        future = self.probe()
+        if future is not None:
+            return future.result()
+        command = self.build_command()
+        if command is None:
+            self.errmsg = "Unimplemented"
+            return False
+        return self.exec_with_timeout(
+            command, timeout=self.command_timeout + self.command_grace,
+            pattern=self.command_pattern)
+
+    def due(self, immediate=False):
+        """ Count one tick, returns whether the check has to run now """
         self.run_count = (self.run_count + 1) % (
                           self.every if self.ok else self.error_every)
-        if self.run_count == 0 or immediate:
+        return self.run_count == 0 or immediate
+
+    def probe(self):
+        """ Start the check in-process without blocking and return a Future
+        of its result, or None if it has to run check() synchronously """
+        return None
+
+    def start(self, executor):
+        """ Start the check and return a Future of its result.  In-process
+        probes don't need a thread, other checks run check() in executor """
+        logging.debug('Running ' + str(self))
+        self.started = monotonic()
+        self.setup()
+        shared = sharing.shared()
+        future = shared.subscribe(self)
+        if future is not None:
+            return future
+        future = self.probe()
+        if future is None and type(self).check is Check.check:
+            command = self.build_command()
+            if command is not None:
+                future = self.spawn(
+                    command,
+                    timeout=self.command_timeout + self.command_grace,
+                    pattern=self.command_pattern)
+        if future is None:
+            future = executor.submit(self.check)
+        return shared.publish(self, future)
+
+    def finish(self, future, immediate=False):
+        """ Record the result of a Future returned by start() """
+        try:
+            success = future.result()
+        finally:
+            self.teardown()
+        self.record(success, immediate)
+        return self.ok
+
+    def record(self, success, immediate=False):
+        """ Update retry/failure state with the result of a run """
+        duration = 0.0
+        if self.started is not None:
+            duration = monotonic() - self.started
+            self.stats.observe(success, duration, self.lateness)
+        before = (self.ok, self.retry_count)
+        before_state = report.state_of(self)
+        self.unreachable = False
+        self.checked_at = monotonic()
+        if not success:
+            logging.debug('Fail: ' + str(self))
+            if not self.retry_count:
+                self.failing_since = self.checked_at
+            self.retry_count += 1
+            if self.retry_count >= self.retry or immediate:
+                parent = self.blocked(since=self.failing_since) \
+                    if not immediate else None
+                if self.ok and parent is not None:
+                    # most likely failing because of its parent, which is
+                    # alerted about instead (or has to confirm it's fine
+                    # first)
+                    logging.debug('%s unreachable because of %s' %
+                                  (self, parent))
+                    self.unreachable = True
+                elif self.ok:
+                    logging.debug('Switched to failure: ' + str(self))
+                    self.failure_date = datetime.now()
+                    self.ok = False
+        else:
+            logging.debug('OK: ' + str(self))
+            if not self.ok:
+                logging.debug('Switched to ok: ' + str(self))
+                self.ok = True
+                self.recovered_after = before[1]
+            self.retry_count = 0
+        history.append(self, success, duration)
+        if shards.forward(self):
+            # notified, saved and reported by the coordinator process
+            return
+        if self.ok != before[0] and cluster.owns(self):
+            # not to alert twice while handing it over to another node
+            mails.notify(self)
+        if not success or (self.ok, self.retry_count) != before or \
+                self.stats.latency.samples % 64 == 0:
+            # the latency estimate is saved every 64 successful runs
+            state.mark(self)
+        report.index.update(self, before_state)
+        cluster.publish(self)
+
+    def run(self, immediate=False):
+        if self.due(immediate):
             logging.debug('Running ' + str(self))
+            self.started = monotonic()
             self.setup()
-            if not self.check():
-                logging.debug('Fail: ' + str(self))
-                self.retry_count += 1
-                if self.retry_count >= self.retry or immediate:
-                    if self.ok:
-                        logging.debug('Switched to failure: ' + str(self))
-                        self.failure_date = datetime.now()
-                        self.ok = False
-                        mails.send_email_for_check(self)
-            else:
-                logging.debug('OK: ' + str(self))
-                if not self.ok:
-                    logging.debug('Switched to ok: ' + str(self))
-                    self.ok = True
-                    mails.send_email_for_check(self)
-                self.retry_count = 0
+            self.record(self.check(), immediate)
             self.teardown()
         return self.ok
 
+    def spawn(self, command, timeout=None, pattern=''):
+        """ Start command from the shared process reactor and return a
+        Future of the check result, or None if there is no reactor """
+        reactor = probes.process_reactor() if probes is not None else None
+        if reactor is None:
+            return None
+        timeout = self.timeout if timeout is None else timeout
+        return probes.then(reactor.spawn(command, timeout),
+                           lambda f: self.__spawn_result(f, pattern))
+
+    def __spawn_result(self, future, pattern):
+        self.errmsg = ''
+        try:
+            result = future.result()
+        except OSError as e:
+            self.errmsg = 'Check not available: ' + str(e.strerror)
+            return False
+        self.timings = result.timings
+        if result.timed_out:
+            self.errmsg += "Operation timed out\n"
+            return False
+        start = monotonic()
+        success = self.exec_result(result.returncode, result.out, result.err,
+                                   pattern)
+        if not success and result.truncated:
+            self.errmsg += "(output truncated)\n"
+        self.timings['parse'] = monotonic() - start
+        return success
+
     def exec_with_timeout(self, command, timeout=None, pattern=''):
         timeout = self.timeout if timeout is None else timeout
+        future = self.spawn(command, timeout, pattern)
+        if future is not None:
+            return future.result()
         self.errmsg = ''
         try:
             p = Popen(command, stdout=PIPE, stderr=PIPE)
@@ -99,7 +438,11 @@ class Check(object):
             out, err = p.communicate()
             self.errmsg += "Operation timed out\n"
             return False
-        if p.returncode != 0:
+        return self.exec_result(p.returncode, out, err, pattern)
+
+    def exec_result(self, returncode, out, err, pattern=''):
+        """ Check the outcome of an external command, setting errmsg """
+        if returncode != 0:
             if len(out) > 0:
                 self.errmsg += "stdout:\n" + \
                                out.decode(errors='replace') + '\n'
@@ -110,82 +453,235 @@ class Check(object):
             self.errmsg += ("Pattern '%s' not found in reply.\nstdout: %s"
                             % (pattern, out.decode(errors='replace')))
             return False
-        return p.returncode == 0
+        return returncode == 0
 
 
 class CheckIP(Check):
+    __slots__ = ()
+
     def __init__(self, host, **options):
         super().__init__(**options)
+        self.host = host
         self.target_name = host.name
 
     def __repr__(self):
         return '<%s on %s>' % (super().__repr__(), self.addr)
 
+    @property
+    def ident(self):
+        return '%s %s' % (super().ident, self.addr)
+
 
 class Check4(CheckIP):
+    __slots__ = ()
+    family = socket.AF_INET
+
     def __init__(self, host, **options):
         super().__init__(host, **options)
         self.addr = host.ipv4
 
 
 class Check6(CheckIP):
+    __slots__ = ()
+    family = socket.AF_INET6
+
     def __init__(self, host, **options):
         super().__init__(host, **options)
         self.addr = host.ipv6
 
 
-class CheckPing4(Check4):
-    def check(self):
-        command = ['/bin/ping', '-c', '1', '-W', str(self.timeout), self.addr]
-        return self.exec_with_timeout(command, timeout=self.timeout + 1)
+class CheckPing(Check):
+    __slots__ = ()
+    ping_command = '/bin/ping'
+    command_grace = 1
 
+    def probe(self):
+        pinger = None
+        if self.native and probes is not None:
+            pinger = probes.pinger(self.family)
+        if pinger is None:
+            return None
+        return probes.then(pinger.ping(self.addr, self.timeout),
+                           self.__ping_result)
+
+    def __ping_result(self, future):
+        try:
+            future.result()
+        except probes.ProbeError as e:
+            self.errmsg = str(e) + '\n'
+            return False
+        self.errmsg = ''
+        return True
+
+    def build_command(self):
+        return [self.ping_command, '-c', '1', '-W',
+                str(self.command_timeout), self.addr]
+
+
+class CheckPing4(CheckPing, Check4):
+    __slots__ = ()
 
-class CheckPing6(Check6):
-    def check(self):
-        command = ['/bin/ping6', '-c', '1', '-W', str(self.timeout), self.addr]
-        return self.exec_with_timeout(command, timeout=self.timeout + 1)
+
+class CheckPing6(CheckPing, Check6):
+    __slots__ = ()
+    ping_command = '/bin/ping6'
 
 
 class CheckDNSZone(Check):
+    __slots__ = ('zone', 'servers')
+    result_attrs = Check.result_attrs + ('servers',)
+
     def __init__(self, zone, **options):
         super().__init__(**options)
         self.zone = zone
         self.target_name = "zone '%s'" % zone
+        self.servers = ()
 
     def __repr__(self):
         return '<%s for %s>' % (super().__repr__(), self.zone)
 
-    def check(self):
+    def probe(self):
+        if not self.native or probes is None:
+            return None
+        checker = probes.zone_checker()
+        if checker is None:
+            return None
+        future = checker.check(self.zone, self._options.get('ip_version', 0),
+                               timeout=self.timeout)
+        return probes.then(future, self.__zone_result)
+
+    def __zone_result(self, future):
+        self.errmsg = ''
+        try:
+            self.servers = future.result()
+        except probes.ProbeError as e:
+            self.errmsg = str(e) + '\n'
+            return False
+        serials = set(s.serial for s in self.servers if s.error is None)
+        if len(serials) == 1 and all(s.error is None for s in self.servers):
+            return True
+        for s in self.servers:
+            self.errmsg += '%s (%s): %s\n' % (
+                s.name, s.addr or 'no address',
+                s.error if s.error is not None else 'serial %d' % s.serial)
+        if len(serials) > 1:
+            self.errmsg += 'Serials differ between name servers\n'
+        return False
+
+    def build_command(self):
         command = ['check_dns_soa', '-H', self.zone]
         if self._options.get('ip_version', 0) in [4, 6]:
             command.append('-' + str(self._options['ip_version']))
-        return self.exec_with_timeout(command)
+        return command
 
 
 class CheckDNSRec(Check):
-    def check(self):
-        command = ['dig', 'www.google.com', '@' + self.addr]
-        return self.exec_with_timeout(command, pattern='status: NOERROR')
+    __slots__ = ('qname', 'qtype', 'answers')
+    result_attrs = Check.result_attrs + ('answers',)
+    command_pattern = 'status: NOERROR'
+
+    def __init__(self, *args, **options):
+        super().__init__(*args, **options)
+        self.qname = options.get('qname', 'www.google.com')
+        self.qtype = options.get('qtype', 'A')
+        self.answers = ()
+
+    def probe(self):
+        if not self.native or probes is None:
+            return None
+        client = probes.dns_client()
+        if client is None:
+            return None
+        future = client.query(self.addr, self.qname, self.qtype,
+                              timeout=self.timeout,
+                              port=self._options.get('port', 53))
+        return probes.then(future, self.__dns_result)
+
+    def __dns_result(self, future):
+        self.errmsg = ''
+        try:
+            reply = future.result()
+        except probes.ProbeError as e:
+            self.errmsg = str(e) + '\n'
+            return False
+        self.answers = reply.answers
+        if reply.rcode != 0:
+            self.errmsg = "status: %s for %s %s\n" % (reply.rcode_name,
+                                                       self.qname, self.qtype)
+            return False
+        return True
+
+    def build_command(self):
+        command = ['dig', '@' + self.addr, self.qname, self.qtype]
+        if 'port' in self._options:
+            command += ['-p', str(self._options['port'])]
+        return command
 
 
 class CheckDNSRec4(CheckDNSRec, Check4):
-    pass
+    __slots__ = ()
 
 
 class CheckDNSRec6(CheckDNSRec, Check6):
-    pass
+    __slots__ = ()
 
 
 class CheckDNSAut(Check):
-    def check(self, host, addr):
+    __slots__ = ()
+
+    def check(self):
         self.errmsg = "Unimplemented"
         return False
 
 
 class CheckHTTP(Check):
+    __slots__ = ()
+    command_grace = 1
+    tls = False
+
+    def probe(self):
+        if not self.native or probes is None:
+            return None
+        client = probes.http_client()
+        if client is None:
+            return None
+        future = client.get(self.addr, self.timeout, tls=self.tls,
+                            vhost=self._options.get('vhost'),
+                            url=str(self._options.get('url', '/')),
+                            port=self._options.get('port'))
+        return probes.then(future, self.__http_result)
+
+    def __http_result(self, future):
+        self.errmsg = ''
+        try:
+            result = future.result()
+        except probes.ProbeError as e:
+            self.errmsg = str(e) + '\n'
+            return False
+        self.timings = result.timings
+        # same semantics as check_http: -e expects one of comma-separated
+        # strings in the status line, otherwise 4xx and 5xx are failures
+        if 'status' in self._options:
+            expected = str(self._options['status']).split(',')
+            if not any(e in result.status_line for e in expected):
+                self.errmsg = ("Unexpected status line '%s', expected '%s'\n"
+                               % (result.status_line,
+                                  self._options['status']))
+                return False
+        elif result.status >= 400:
+            self.errmsg = "%s\n" % result.status_line
+            return False
+        if 'string' in self._options:
+            string = str(self._options['string']).encode('utf-8')
+            if string not in result.body:
+                self.errmsg = ("String '%s' not found in reply.\n"
+                               % self._options['string'])
+                return False
+        return True
+
     def build_command(self):
         command = ['/usr/lib/nagios/plugins/check_http',
-                   '-I', self.addr, '-t', str(self.timeout)]
+                   '-I', self.addr, '-t', str(self.command_timeout)]
         if 'status' in self._options:
             command += ['-e', str(self._options['status'])]
         if 'vhost' in self._options:
@@ -194,93 +690,186 @@ class CheckHTTP(Check):
             command += ['-s', str(self._options['string'])]
         if 'url' in self._options:
             command += ['-u', str(self._options['url'])]
+        if 'port' in self._options:
+            command += ['-p', str(self._options['port'])]
         return command
 
-    def check(self):
-        command = self.build_command()
-        return self.exec_with_timeout(command, timeout=self.timeout + 1)
-
 
 class CheckHTTPS(CheckHTTP):
-    def check(self):
-        command = self.build_command() + ['--ssl', '--sni']
-        return self.exec_with_timeout(command, timeout=self.timeout + 1)
+    __slots__ = ()
+    tls = True
+
+    def build_command(self):
+        return super().build_command() + ['--ssl', '--sni']
 
 
 class CheckHTTP4(CheckHTTP, Check4):
-    pass
+    __slots__ = ()
 
 
 class CheckHTTP6(CheckHTTP, Check6):
-    pass
+    __slots__ = ()
 
 
 class CheckHTTPS4(CheckHTTPS, Check4):
-    pass
+    __slots__ = ()
 
 
 class CheckHTTPS6(CheckHTTPS, Check6):
-    pass
+    __slots__ = ()
 
 
 class CheckSMTP(Check):
+    __slots__ = ()
+    command_grace = 1
+
+    def probe(self):
+        if not self.native or probes is None:
+            return None
+        client = probes.stream_client()
+        if client is None:
+            return None
+        dialog = probes.smtp_dialog(
+            socket.gethostname(),
+            self._options.get('from_addr', 'picomon@localhost.local'),
+            self._options.get('command'), self._options.get('response'))
+        future = client.converse(self.addr, self._options.get('port', 25),
+                                 dialog, self.timeout)
+        return probes.then(future, self.__smtp_result)
+
+    def __smtp_result(self, future):
+        self.errmsg = ''
+        try:
+            self.timings = future.result().timings
+        except probes.ProbeError as e:
+            self.errmsg = str(e) + '\n'
+            return False
+        return True
+
     def build_command(self):
         command = ['/usr/lib/nagios/plugins/check_smtp',
                    '-H', self.addr,
                    '-f', self._options.get('from_addr',
                                            'picomon@localhost.local'),
-                   '-t', str(self.timeout)]
+                   '-t', str(self.command_timeout)]
         if 'command' in self._options:
             command += ['-C', str(self._options['command'])]
         if 'response' in self._options:
             command += ['-R', str(self._options['response'])]
+        if 'port' in self._options:
+            command += ['-p', str(self._options['port'])]
         return command
 
-    def check(self):
-        command = self.build_command()
-        return self.exec_with_timeout(command, timeout=self.timeout + 1)
-
 
 class CheckSMTP4(CheckSMTP, Check4):
-    pass
+    __slots__ = ()
 
 
 class CheckSMTP6(CheckSMTP, Check6):
-    pass
+    __slots__ = ()
+
+
+class CheckUDP(Check):
+    """ Base for checks sending a datagram and waiting for a reply, which
+    can be validated by overriding check_reply().  The port and payload
+    can be overridden by the 'port' and 'payload' options. """
+    __slots__ = ()
+    command_grace = 1
+    udp_port = None
+    udp_payload = b''
+
+    def probe(self):
+        if not self.native or probes is None:
+            return None
+        prober = probes.udp_prober()
+        if prober is None:
+            return None
+        payload = self._options.get('payload', self.udp_payload)
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        future = prober.probe(self.addr, self._options.get('port',
+                                                           self.udp_port),
+                              payload, self.timeout)
+        return probes.then(future, self.__udp_result)
+
+    def __udp_result(self, future):
+        self.errmsg = ''
+        try:
+            reply = future.result()
+        except probes.ProbeError as e:
+            self.errmsg = str(e) + '\n'
+            return False
+        return self.check_reply(reply)
 
+    def check_reply(self, reply):
+        """ Return whether reply is the expected one, setting errmsg """
+        return True
 
-class CheckOpenVPN(Check):
-    def check(self):
-        command = ['/usr/lib/nagios/plugins/check_udp',
-                   '-H', self.addr,
-                   '-p', "1194",
-                   '-m', "1",
-                   '-M', "ok",  # actualy just having a reply is enough
-                   '-s', "\x38\x01\x01\x01\x01\x01\x01\x01\x42",
-                   '-e', "@",
-                   '-t', str(self.timeout)]
-        return self.exec_with_timeout(command, timeout=self.timeout + 1)
+
+class CheckOpenVPN(CheckUDP):
+    __slots__ = ()
+    # any reply to a P_CONTROL_HARD_RESET_CLIENT_V2 packet is enough
+    udp_port = 1194
+    udp_payload = b"\x38\x01\x01\x01\x01\x01\x01\x01\x42"
+
+    def build_command(self):
+        payload = self._options.get('payload', self.udp_payload)
+        if isinstance(payload, bytes):
+            payload = payload.decode('latin1')
+        return ['/usr/lib/nagios/plugins/check_udp',
+                '-H', self.addr,
+                '-p', str(self._options.get('port', self.udp_port)),
+                '-m', "1",
+                '-M', "ok",  # actualy just having a reply is enough
+                '-s', payload,
+                '-e', "@",
+                '-t', str(self.command_timeout)]
 
 
 class CheckOpenVPN4(CheckOpenVPN, Check4):
-    pass
+    __slots__ = ()
 
 
 class CheckOpenVPN6(CheckOpenVPN, Check6):
-    pass
+    __slots__ = ()
 
 
 class CheckJabber(Check):
-    def check(self):
+    __slots__ = ()
+    command_grace = 1
+
+    def probe(self):
+        if not self.native or probes is None:
+            return None
+        client = probes.stream_client()
+        if client is None:
+            return None
+        dialog = probes.xmpp_dialog(self._options.get('domain', self.addr))
+        future = client.converse(self.addr, self._options.get('port', 5222),
+                                 dialog, self.timeout)
+        return probes.then(future, self.__xmpp_result)
+
+    def __xmpp_result(self, future):
+        self.errmsg = ''
+        try:
+            self.timings = future.result().timings
+        except probes.ProbeError as e:
+            self.errmsg = str(e) + '\n'
+            return False
+        return True
+
+    def build_command(self):
         command = ['/usr/lib/nagios/plugins/check_jabber',
                    '-H', self.addr,
-                   '-t', str(self.timeout)]
-        return self.exec_with_timeout(command, timeout=self.timeout + 1)
+                   '-t', str(self.command_timeout)]
+        if 'port' in self._options:
+            command += ['-p', str(self._options['port'])]
+        return command
 
 
 class CheckJabber4(CheckJabber, Check4):
-    pass
+    __slots__ = ()
 
 
 class CheckJabber6(CheckJabber, Check6):
-    pass
+    __slots__ = ()
@@ -0,0 +1,344 @@
+"""
+Several picomon nodes sharing the checks of one configuration.
+
+With `cluster.nodes` set to the addresses (host:port) of all nodes, each
+node started with the same configuration and its own address (`--node` or
+`cluster.node`) runs only the checks it owns: checks are spread over the
+live nodes by consistent hashing of their target (address or target name),
+so that checks against the same target stay on the same node and a node
+joining or leaving only moves its own share of them.
+
+Nodes send each other a heartbeat over UDP every `cluster.heartbeat`
+seconds, a node not heard from for `cluster.timeout` seconds being considered
+down, its checks being taken over by the others on their next heartbeat.
+Records of the state changes of checks are sent to the other nodes, which
+keep a copy of the state of all checks: reports and saved state show the
+whole cluster, and a node taking checks over carries on from their last
+known state rather than alerting about failures again.  Records of checks
+which checks owned by other nodes depend on are sent after every run, and
+those of all owned checks every `cluster.sync_every` seconds and to joining
+nodes, in case of lost datagrams.
+
+Only the owner of a check sends alert emails about it, and only one node
+(the first live one, by address) sends the periodic reports.  Messages carry
+a checksum of the checks of the configuration, records from nodes with
+another one (until they are reloaded too) being ignored, and are signed
+with `cluster.secret` when set.
+
+"""
+
+
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import socket
+from threading import Lock, Thread
+from time import monotonic, sleep
+from . import report
+from . import scheduler
+from . import shards
+from . import state
+from .scheduler import Limits
+
+# size of the payload of record datagrams
+_DATAGRAM = 8192
+# characters of errmsg sent in records
+_ERRMSG = 2048
+
+
+def parse_address(address):
+    """ Return the (host, port) of a host:port address """
+    host, port = address.rsplit(':', 1)
+    return host.strip('[]'), int(port)
+
+
+def _point(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8],
+                          'big')
+
+
+class Ring(object):
+    """A consistent hashing ring of nodes, each placed on replicas points"""
+
+    def __init__(self, nodes, replicas=64):
+        points = sorted((_point('%s#%d' % (node, r)), node)
+                        for node in nodes for r in range(replicas))
+        self._hashes = [h for (h, _) in points]
+        self._nodes = [node for (_, node) in points]
+
+    def owner(self, key):
+        """ Return the node owning key """
+        i = bisect.bisect(self._hashes, _point(key))
+        return self._nodes[i % len(self._nodes)]
+
+
+class Node(object):
+    """This node of a cluster, exchanging heartbeats and records with the
+    other ones"""
+
+    def __init__(self, address, nodes, checks, heartbeat=1, timeout=5,
+                 sync_every=30, secret=''):
+        self.address = address
+        self.peers = dict((node, parse_address(node)) for node in nodes
+                          if node != address)
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.sync_every = sync_every
+        self._secret = secret.encode('utf-8')
+        host, port = parse_address(address)
+        family = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0][0]
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        self._sock.bind((host, port))
+        self._lock = Lock()
+        self._seen = {}
+        self._mismatched = set()
+        self._alive = None
+        self._started = None
+        self._joined = False
+        self.checks = []
+        self._owned = set()
+        self._relayed = set()
+        self._sent = {}
+        self._indexes = {}
+        # none scheduled until the first rebalance
+        self.reset(checks)
+
+    def reset(self, checks, added=()):
+        """ Take the checks of a reloaded configuration, returns those of
+        added which this node owns, to be scheduled """
+        with self._lock:
+            # kept checks stay scheduled if they were owned, as their owner
+            # only depends on their target and the live nodes
+            owned = set(id(self.checks[i]) for i in self._owned)
+            if self._alive is not None:
+                ring = Ring(self._alive)
+                owned.update(id(check) for check in added
+                             if ring.owner(Limits.target(check)) ==
+                             self.address)
+            self.checks = list(checks)
+            self._digest = list(shards.digest(self.checks))
+            self._indexes = dict((id(check), i) for (i, check)
+                                 in enumerate(self.checks))
+            self._owned = set(i for (i, check) in enumerate(self.checks)
+                              if id(check) in owned)
+            # for the relays of the new configuration
+            self._alive = None
+            self._relayed = set()
+            self._sent = {}
+            return [check for check in added if id(check) in owned]
+
+    def start(self):
+        """ Start exchanging heartbeats and records.  Checks are scheduled
+        once the other nodes had time to be heard of, not to run (and alert
+        about) those of nodes already up """
+        self._started = monotonic()
+        for target in (self.__receive, self.__tick):
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def alive(self):
+        """ Addresses of the live nodes, this one included """
+        now = monotonic()
+        return sorted([self.address] +
+                      [node for (node, seen) in self._seen.items()
+                       if now - seen <= self.timeout])
+
+    def owns(self, check):
+        """ Whether check is owned by this node """
+        i = self._indexes.get(id(check))
+        return i is None or i in self._owned
+
+    def leads(self):
+        """ Whether this node is the first live one """
+        return self.alive()[0] == self.address
+
+    def __sign(self, payload):
+        if not self._secret:
+            return payload
+        return hmac.new(self._secret, payload, hashlib.sha256).digest() + \
+            payload
+
+    def __verify(self, data):
+        if not self._secret:
+            return data
+        mac, payload = data[:32], data[32:]
+        if hmac.compare_digest(
+                mac, hmac.new(self._secret, payload, hashlib.sha256).digest()):
+            return payload
+        return None
+
+    def __send(self, kind, records=()):
+        message = {'from': self.address, 'digest': self._digest,
+                   'kind': kind, 'records': list(records)}
+        data = self.__sign(json.dumps(message,
+                                      separators=(',', ':')).encode('utf-8'))
+        for node, address in self.peers.items():
+            try:
+                self._sock.sendto(data, address)
+            except OSError as e:
+                logging.debug("Couldn't send to node %s: %s" % (node, e))
+
+    def __send_records(self, records):
+        chunk, size = [], 0
+        for record in records:
+            record = list(record)
+            if record[7]:
+                record[7] = record[7][:_ERRMSG]
+            size += len(json.dumps(record))
+            if chunk and size > _DATAGRAM:
+                self.__send('records', chunk)
+                chunk, size = [], len(json.dumps(record))
+            chunk.append(record)
+        if chunk:
+            self.__send('records', chunk)
+
+    def publish(self, check):
+        """ Send the state of check to the other nodes, if they need it """
+        i = self._indexes.get(id(check))
+        if i is None or not self.peers:
+            return
+        key = (check.ok, check.retry_count, check.unreachable)
+        # checks of other nodes depending on this one need to know when it
+        # last reported
+        if i in self._relayed or self._sent.get(i) != key:
+            self._sent[i] = key
+            self.__send_records([shards.state_record(i, check, monotonic())])
+
+    def __receive(self):
+        while True:
+            data, _ = self._sock.recvfrom(65536)
+            payload = self.__verify(data)
+            if payload is None:
+                logging.warning('Dropped a cluster message with an invalid '
+                                'signature')
+                continue
+            try:
+                message = json.loads(payload.decode('utf-8'))
+                node = message['from']
+                digest = message['digest']
+                records = message['records']
+                if not isinstance(node, str) or \
+                        not isinstance(records, list):
+                    raise TypeError('invalid message')
+            except (ValueError, KeyError, TypeError):
+                logging.warning('Dropped an invalid cluster message')
+                continue
+            if node not in self.peers:
+                logging.warning('Dropped a message from unknown node %s' %
+                                node)
+                continue
+            # a live node is given its share of checks, even while running
+            # another configuration
+            now = monotonic()
+            if now - self._seen.get(node, now - self.timeout - 1) > \
+                    self.timeout:
+                logging.info('Node %s joined' % node)
+                # to send it the state of checks before it takes its share
+                self._joined = True
+            self._seen[node] = now
+            if digest != self._digest:
+                if node not in self._mismatched:
+                    self._mismatched.add(node)
+                    logging.error('Node %s runs another configuration than '
+                                  'this one, ignoring its records' % node)
+                continue
+            self._mismatched.discard(node)
+            with self._lock:
+                try:
+                    for record in records:
+                        self.__apply(record)
+                except (ValueError, TypeError, IndexError, AttributeError):
+                    logging.warning('Dropped invalid records from node %s' %
+                                    node)
+
+    def __apply(self, record):
+        i = record[0]
+        if not 0 <= i < len(self.checks) or i in self._owned:
+            # run (and so reported) by this node
+            return
+        check = self.checks[i]
+        before = (check.ok, check.retry_count)
+        before_state = report.state_of(check)
+        shards.apply_state(check, record, monotonic())
+        if (check.ok, check.retry_count) != before:
+            state.mark(check)
+        report.index.update(check, before_state)
+
+    def __tick(self):
+        last_sync = monotonic()
+        while True:
+            self.__send('heartbeat')
+            if self._joined or self.sync_every > 0 and \
+                    monotonic() - last_sync >= self.sync_every:
+                self._joined = False
+                last_sync = monotonic()
+                with self._lock:
+                    records = [shards.state_record(i, self.checks[i],
+                                                   last_sync)
+                               for i in sorted(self._owned)]
+                self.__send_records(records)
+            if monotonic() - self._started >= self.timeout:
+                with self._lock:
+                    self.__rebalance()
+            sleep(self.heartbeat)
+
+    def __rebalance(self):
+        alive = self.alive()
+        if alive == self._alive:
+            return
+        ring = Ring(alive)
+        owners, relays = shards.plan(
+            self.checks, lambda check: ring.owner(Limits.target(check)))
+        owned = set(i for (i, owner) in enumerate(owners)
+                    if owner == self.address)
+        added = [self.checks[i] for i in sorted(owned - self._owned)]
+        removed = [self.checks[i] for i in sorted(self._owned - owned)]
+        if not scheduler.update(added, removed):
+            # no scheduler yet, retried on the next heartbeat
+            return
+        logging.info('Cluster nodes: %s, running %d check(s) of %d (%d '
+                     'taken over, %d handed over)' %
+                     (', '.join(alive), len(owned), len(self.checks),
+                      len(added), len(removed)))
+        self._alive = alive
+        self._owned = owned
+        self._relayed = set(i for i in relays if owners[i] == self.address)
+
+
+_node = None
+
+
+def start(address, nodes, checks, heartbeat, timeout, sync_every, secret):
+    """ Join the cluster as address, returns the node """
+    global _node
+    _node = Node(address, nodes, checks, heartbeat, timeout, sync_every,
+                 secret)
+    _node.start()
+    return _node
+
+
+def reset(checks, added):
+    """ Take the checks of a reloaded configuration, returns those of added
+    which this process runs """
+    if _node is None:
+        return added
+    return _node.reset(checks, added)
+
+
+def owns(check):
+    """ Whether check is run by this node (any node runs all of them outside
+    of a cluster) """
+    return _node is None or _node.owns(check)
+
+
+def leads():
+    """ Whether this node is the one sending reports """
+    return _node is None or _node.leads()
+
+
+def publish(check):
+    if _node is not None:
+        _node.publish(check)
@@ -0,0 +1,322 @@
+"""
+Control socket.
+
+With `control.path` set, picomon listens on a Unix socket there for requests
+and answers them, one JSON object per line each, e.g.:
+
+    $ echo '{"op": "list", "state": "failed"}' | nc -U /run/picomon.sock
+
+Requests have an `op`, and checks are designated by their ident (`id`):
+
+  * `list`: checks, filtered by `state` (ok, retrying, failed, unreachable),
+    `target` (name or address) and `class` (subclasses included);
+  * `get`: the state of a check, with its last error message;
+  * `counts`: the number of checks in each state;
+  * `run`: run a check now rather than on its next slot;
+  * `mute`, `unmute`: stop (or resume) sending alert emails about a check;
+  * `ack`: acknowledge the failure of a check, which is then left out of
+    report emails until it recovers and fails again;
+  * `history`: the availability, numbers of failures and flaps, duration
+    percentiles of checks (or of the check `id`) between `since` and `until`
+    (dates or durations ago, e.g. 30d), from the history of runs (see
+    picomon.history);
+  * `subscribe`: stream the state transitions of checks (with the same
+    filters as `list`) on the connection, until it is closed.
+
+Answers have `ok` set to true, or false with an `error`.  They are built from
+the checks and the index of failing ones (see picomon.report), without
+waiting for the scheduler.
+
+"""
+
+
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import socketserver
+import tempfile
+from datetime import datetime
+from threading import Thread
+from time import monotonic, time
+from . import cluster
+from . import history
+from . import report
+from . import scheduler
+from . import state
+
+# transitions a subscriber may lag behind before they are dropped
+_BACKLOG = 1000
+
+
+class ControlError(Exception):
+    """A request which can't be served"""
+
+
+_idents = (None, {})
+
+
+def find(ident):
+    """ Return the configured check with ident """
+    from . import config
+
+    global _idents
+    checks, by_ident = _idents
+    if checks is not config.checks:
+        # built again after a reload
+        checks = config.checks
+        by_ident = {}
+        for check in checks:
+            by_ident.setdefault(check.ident, check)
+        _idents = (checks, by_ident)
+    check = by_ident.get(ident)
+    if check is None:
+        raise ControlError('No check %r' % ident)
+    return check
+
+
+def _date(date):
+    return date.isoformat() if date is not None else None
+
+
+def summary(check):
+    """ Return the state of check as a dict """
+    return {'id': check.ident,
+            'class': type(check).__name__,
+            'target': check.target_name,
+            'addr': getattr(check, 'addr', None),
+            'state': report.state_of(check),
+            'retry_count': check.retry_count,
+            'failure_date': _date(getattr(check, 'failure_date', None))
+                            if not check.ok else None,
+            'muted': check.muted,
+            'acknowledged': check.acknowledged}
+
+
+def details(check):
+    """ Return the state of check as a dict, with its last error message and
+    scheduling figures """
+    now = monotonic()
+    result = summary(check)
+    result.update({
+        'errmsg': check.errmsg,
+        'checked_ago': now - check.checked_at
+                       if check.checked_at is not None else None,
+        'due_in': check.next_due - now if check.next_due is not None and
+                  not check.running else None,
+        'running': check.running,
+        'timeout': check.timeout,
+        'latency': check.stats.latency.mean
+                   if check.stats.latency.samples else None,
+        'successes': check.stats.successes,
+        'failures': check.stats.failures,
+        'owned': cluster.owns(check)})
+    return result
+
+
+def _matcher(request):
+    """ Return a function telling whether a check (in a given state) passes
+    the filters of request """
+    states = request.get('state')
+    if states is not None:
+        states = set([states] if isinstance(states, str) else states)
+        unknown = states.difference(report.STATES)
+        if unknown:
+            raise ControlError('Unknown state(s): %s' %
+                               ', '.join(sorted(unknown)))
+    target = request.get('target')
+    cls = request.get('class')
+
+    def match(check, state=None):
+        if states is not None and \
+                (state or report.state_of(check)) not in states:
+            return False
+        if target is not None and target not in (check.target_name,
+                                                 getattr(check, 'addr', None)):
+            return False
+        if cls is not None and cls not in (c.__name__ for c
+                                           in type(check).__mro__):
+            return False
+        return True
+    return match
+
+
+def _list(request):
+    from . import config
+
+    match = _matcher(request)
+    states = request.get('state')
+    if states is not None and report.OK not in states:
+        # failing checks are indexed
+        if isinstance(states, str):
+            states = [states]
+        checks = [check for state in sorted(set(states))
+                  for check in report.index.checks(state)]
+    else:
+        checks = config.checks
+    return {'checks': [summary(check) for check in checks if match(check)]}
+
+
+def _get(request):
+    return {'check': details(find(request.get('id')))}
+
+
+def _counts(request):
+    return {'counts': dict(report.index.counts)}
+
+
+def _run(request):
+    check = find(request.get('id'))
+    if not scheduler.run_now(check):
+        raise ControlError('Check not run by this process')
+    return {}
+
+
+def _set(check, **attrs):
+    for name, value in attrs.items():
+        setattr(check, name, value)
+    state.mark(check)
+    return {'check': summary(check)}
+
+
+def _mute(request):
+    return _set(find(request.get('id')), muted=True)
+
+
+def _unmute(request):
+    return _set(find(request.get('id')), muted=False)
+
+
+def _ack(request):
+    check = find(request.get('id'))
+    if check.ok:
+        raise ControlError('Check not failing')
+    return _set(check, ack_date=check.failure_date)
+
+
+def _history(request):
+    from . import config
+
+    if not config.history.path:
+        raise ControlError('No history kept (history.path)')
+    since = history.parse_time(request.get('since', '30d'))
+    until = history.parse_time(request['until']) \
+        if request.get('until') else None
+    ident = request.get('id')
+    match = (lambda other: other == ident) if ident is not None else None
+    return {'history': history.query(config.history.path, since, until,
+                                     match)}
+
+
+OPS = {'list': _list,
+       'get': _get,
+       'counts': _counts,
+       'run': _run,
+       'mute': _mute,
+       'unmute': _unmute,
+       'ack': _ack,
+       'history': _history}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def __write(self, answer):
+        self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ControlError('Requests are JSON objects')
+                op = request.get('op')
+                if op == 'subscribe':
+                    self.__subscribe(_matcher(request))
+                    return
+                if op not in OPS:
+                    raise ControlError('Unknown op %r' % op)
+                answer = OPS[op](request)
+                answer['ok'] = True
+            except (ControlError, ValueError) as e:
+                answer = {'ok': False, 'error': str(e)}
+            except Exception as e:
+                logging.exception('Control request failed')
+                answer = {'ok': False, 'error': 'Internal error: %s' % e}
+            self.__write(answer)
+
+    def __subscribe(self, match):
+        events = queue.Queue(_BACKLOG)
+
+        def listener(check, before, after):
+            if match(check, after):
+                try:
+                    events.put_nowait((time(), check, before, after))
+                except queue.Full:
+                    pass
+
+        report.index.listen(listener)
+        try:
+            self.__write({'ok': True})
+            while True:
+                try:
+                    when, check, before, after = events.get(timeout=1)
+                except queue.Empty:
+                    # the client closing the connection makes it readable
+                    if select.select([self.connection], [], [], 0)[0] and \
+                            not self.connection.recv(4096):
+                        return
+                    continue
+                self.__write({'event': 'transition',
+                              'time': datetime.fromtimestamp(when)
+                                      .isoformat(),
+                              'from': before, 'to': after,
+                              'check': summary(check)})
+        except OSError:
+            return
+        finally:
+            report.index.unlisten(listener)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, mode=0o600):
+    """ Serve control requests on a Unix socket at path, from a background
+    thread """
+    if os.path.exists(path):
+        # left behind by a previous run, unless another one still listens
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        finally:
+            probe.close()
+    # bound in a private directory and given its permissions there, not to
+    # be reachable with those of the umask meanwhile, then linked in place
+    # (which fails if another process listens there)
+    directory = tempfile.mkdtemp(prefix='.picomon-',
+                                 dir=os.path.dirname(path) or '.')
+    bound = os.path.join(directory, 'control')
+    try:
+        server = _Server(bound, _Handler)
+        try:
+            os.chmod(bound, mode)
+            os.link(bound, path)
+        except OSError:
+            server.server_close()
+            raise
+    finally:
+        if os.path.exists(bound):
+            os.unlink(bound)
+        os.rmdir(directory)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info('Control socket listening on %s' % path)
+    return server
@@ -0,0 +1,373 @@
+"""
+History of check runs.
+
+With `history.path` set, the outcome of every run (time, check, result,
+state, duration and retries) is appended to a memory-mapped ring file of
+`history.records` fixed-width records, the oldest ones being overwritten.
+Appending a record costs a few bytes written to memory, the kernel writing
+them to disk.  Checks are designated by a 64 bits hash of their ident, the
+idents being listed once in a companion file (path + '.idents').  Worker
+processes (`shards.processes`) each write a ring of their own, path + '.N'.
+
+`picomon-history path` computes the availability, the numbers of failures and
+of state changes (flaps) and duration percentiles of checks over a time
+window.  Records are streamed from the ring, the window being found by
+bisection on their times, so that queries only hold a summary per check in
+memory.
+
+"""
+
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+from datetime import datetime
+from threading import Lock
+from time import time
+
+MAGIC = b'PICOHIS1'
+# magic, record size, capacity, number of records ever appended
+HEADER = struct.Struct('<8sIxxxxQQ')
+HEADER_SIZE = 64
+# time, check id, duration, flags, retries
+RECORD = struct.Struct('<dQfBB2x')
+# flags of records
+SUCCESS = 1
+OK = 2
+UNREACHABLE = 4
+# records unpacked at once by queries
+_CHUNK = 4096
+
+
+def check_id(ident):
+    """ Return the id of the check with ident in history records """
+    return struct.unpack('<Q', hashlib.sha1(ident.encode('utf-8'))
+                         .digest()[:8])[0]
+
+
+def read_idents(path):
+    """ Return the idents of the checks of the ring at path, by id """
+    idents = {}
+    try:
+        with open(path + '.idents', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                idents[record['id']] = record['ident']
+    except FileNotFoundError:
+        pass
+    return idents
+
+
+class Ring(object):
+    """A ring file of run records, appended to by any thread"""
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self._lock = Lock()
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.read(fd, HEADER.size)
+            if len(header) == HEADER.size and \
+                    HEADER.unpack(header)[:3] == (MAGIC, RECORD.size,
+                                                  capacity):
+                self._count = HEADER.unpack(header)[3]
+            else:
+                if header:
+                    logging.warning('History %s has another format or size, '
+                                    'moved to %s.old' % (path, path))
+                    os.rename(path, path + '.old')
+                    os.close(fd)
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._count = 0
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, RECORD.size, capacity, 0), 0)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._known = set(read_idents(path))
+        self._idents = open(path + '.idents', 'a', encoding='utf-8')
+
+    def __register(self, ident):
+        hid = check_id(ident)
+        if hid not in self._known:
+            self._known.add(hid)
+            self._idents.write(json.dumps({'id': hid, 'ident': ident}) + '\n')
+            self._idents.flush()
+        return hid
+
+    def append(self, check, success, duration):
+        flags = (SUCCESS if success else 0) | (OK if check.ok else 0) | \
+            (UNREACHABLE if check.unreachable else 0)
+        with self._lock:
+            if self._map.closed:
+                return
+            hid = check.history_id
+            if hid is None:
+                hid = check.history_id = self.__register(check.ident)
+            RECORD.pack_into(self._map, HEADER_SIZE +
+                             self._count % self.capacity * RECORD.size,
+                             time(), hid, duration, flags,
+                             min(check.retry_count, 255))
+            self._count += 1
+            # last, so that readers only see whole records
+            HEADER.pack_into(self._map, 0, MAGIC, RECORD.size, self.capacity,
+                             self._count)
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._idents.close()
+
+
+class Reader(object):
+    """Read-only access to the records of a ring file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, self.capacity, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or size != RECORD.size:
+            raise ValueError('%s is not a history file' % path)
+
+    @property
+    def count(self):
+        return HEADER.unpack_from(self._map, 0)[3]
+
+    def __time(self, n):
+        return RECORD.unpack_from(self._map, HEADER_SIZE + n % self.capacity *
+                                  RECORD.size)[0]
+
+    def records(self, since=None, until=None):
+        """ Yield the records (time, id, duration, flags, retries) appended
+        between since and until (times in seconds since the epoch), oldest
+        first """
+        count = self.count
+        start = max(0, count - self.capacity)
+        if since is not None:
+            # records are appended in time order
+            low, high = start, count
+            while low < high:
+                middle = (low + high) // 2
+                if self.__time(middle) < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            start = low
+        n = start
+        while n < count:
+            i = n % self.capacity
+            end = min(count - n, self.capacity - i, _CHUNK)
+            chunk = self._map[HEADER_SIZE + i * RECORD.size:
+                              HEADER_SIZE + (i + end) * RECORD.size]
+            for record in RECORD.iter_unpack(chunk):
+                if until is not None and record[0] >= until:
+                    return
+                yield record
+            n += end
+
+    def close(self):
+        self._map.close()
+
+
+class Sketch(object):
+    """Counts of values in buckets growing by 2%, for percentiles within 1%
+    whatever the number of values"""
+
+    GROWTH = 1.02
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, value):
+        bucket = int(math.floor(math.log(max(value, 1e-6), self.GROWTH)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= q * self.count:
+                return self.GROWTH ** (bucket + 0.5)
+
+
+class Summary(object):
+    """Availability figures of a check over a window"""
+
+    def __init__(self):
+        self.runs = 0
+        self.successes = 0
+        self.failures = 0
+        self.flaps = 0
+        self.unreachable = 0
+        self.durations = Sketch()
+        self.first = None
+        self.last = None
+        self._ok = None
+
+    def add(self, when, duration, flags):
+        if self.first is None:
+            self.first = when
+        self.last = when
+        self.runs += 1
+        if flags & SUCCESS:
+            self.successes += 1
+            self.durations.add(duration)
+        if flags & UNREACHABLE:
+            self.unreachable += 1
+        ok = bool(flags & OK)
+        if self._ok is not None and ok != self._ok:
+            self.flaps += 1
+            if not ok:
+                self.failures += 1
+        self._ok = ok
+
+    def result(self):
+        return {'runs': self.runs,
+                'availability': 100.0 * self.successes / self.runs
+                                if self.runs else None,
+                'failures': self.failures,
+                'flaps': self.flaps,
+                'unreachable': self.unreachable,
+                'first': datetime.fromtimestamp(self.first).isoformat()
+                         if self.first is not None else None,
+                'last': datetime.fromtimestamp(self.last).isoformat()
+                        if self.last is not None else None,
+                'duration_p50': self.durations.percentile(0.5),
+                'duration_p90': self.durations.percentile(0.9),
+                'duration_p99': self.durations.percentile(0.99)}
+
+
+def rings(path):
+    """ Paths of the ring at path and of those of worker processes """
+    directory = os.path.dirname(path) or '.'
+    base = os.path.basename(path)
+    paths = [path] if os.path.exists(path) else []
+    for name in sorted(os.listdir(directory)):
+        if re.match(re.escape(base) + r'\.\d+$', name):
+            paths.append(os.path.join(directory, name))
+    return paths
+
+
+def query(path, since=None, until=None, match=None):
+    """ Return the availability figures of checks (whose ident match
+    accepts, if given) over a window, by ident """
+    paths = rings(path)
+    idents = {}
+    for ring in paths:
+        idents.update(read_idents(ring))
+    wanted = None
+    if match is not None:
+        wanted = set(hid for (hid, ident) in idents.items() if match(ident))
+    summaries = {}
+    for ring in paths:
+        reader = Reader(ring)
+        try:
+            for when, hid, duration, flags, _ in reader.records(since, until):
+                if wanted is not None and hid not in wanted:
+                    continue
+                summary = summaries.get(hid)
+                if summary is None:
+                    summary = summaries[hid] = Summary()
+                summary.add(when, duration, flags)
+        finally:
+            reader.close()
+    return dict((idents.get(hid, '%016x' % hid), summary.result())
+                for (hid, summary) in summaries.items())
+
+
+_ring = None
+
+
+def open_ring(path, capacity):
+    """ Append the runs of checks to the ring at path """
+    global _ring
+    _ring = Ring(path, capacity)
+    logging.info('Appending runs to %s (%d records)' % (path, capacity))
+    return _ring
+
+
+def append(check, success, duration):
+    """ Note a run of check, if history is kept at all """
+    if _ring is not None:
+        _ring.append(check, success, duration)
+
+
+def quit():
+    global _ring
+    ring, _ring = _ring, None
+    if ring is not None:
+        ring.close()
+
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_time(value, now=None):
+    """ Return the time (since the epoch) of an ISO date or of a duration
+    ago such as 30d """
+    now = time() if now is None else now
+    found = re.match(r'^(\d+(?:\.\d*)?)([smhdw])$', value)
+    if found:
+        return now - float(found.group(1)) * _UNITS[found.group(2)]
+    for layout in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M',
+                   '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, layout).timestamp()
+        except ValueError:
+            pass
+    raise ValueError('Invalid date or duration: %r' % value)
+
+
+def _format(value, spec):
+    return format(value, spec) if value is not None else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='history file (history.path)')
+    parser.add_argument('-s', '--since', default='30d',
+                        help='start of the window, a date or a duration ago '
+                             '(e.g. 2026-01-01, 12h, 30d), defaults to 30d')
+    parser.add_argument('-u', '--until',
+                        help='end of the window, defaults to now')
+    parser.add_argument('-c', '--check',
+                        help='only checks whose ident contains this')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args()
+
+    since = parse_time(args.since)
+    until = parse_time(args.until) if args.until else None
+    match = (lambda ident: args.check in ident) if args.check else None
+    results = query(args.path, since, until, match)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    print('%8s %9s %8s %6s %8s %8s %8s  %s' % (
+        'runs', 'avail%', 'failures', 'flaps', 'p50', 'p90', 'p99', 'check'))
+    for ident, result in sorted(results.items()):
+        print('%8d %9s %8d %6d %8s %8s %8s  %s' % (
+            result['runs'], _format(result['availability'], '.3f'),
+            result['failures'], result['flaps'],
+            _format(result['duration_p50'], '.3f'),
+            _format(result['duration_p90'], '.3f'),
+            _format(result['duration_p99'], '.3f'), ident))
@@ -2,12 +2,17 @@ import smtplib
 import logging
 from email.mime.text import MIMEText
 from email.utils import make_msgid
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from sys import stderr
 from time import strftime
 from datetime import datetime, timedelta
 import email.charset
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Timer
+from time import monotonic, time
+from uuid import uuid4
+import heapq
+import json
+import os
 import queue
 import atexit
 
@@ -16,74 +21,258 @@ import atexit
 email.charset.add_charset('utf-8', email.charset.QP, email.charset.QP, 'utf-8')
 
 
+class _Mail(object):
+    __slots__ = ('args', 'kwargs', 'attempts', 'next_try', 'path')
+
+    def __init__(self, args, kwargs, path=None):
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.next_try = 0
+        self.path = path
+
+    def __lt__(self, other):
+        return self.next_try < other.next_try
+
+
 class ThreadedSMTP(object):
-    """A helper class managing a thread sending emails through smtplib"""
+    """A helper class managing threads sending emails through smtplib.
 
-    def __init__(self):
-        self._queue = queue.Queue()
+    Each of the `senders` threads keeps its own SMTP connection and sends
+    up to `batch` queued emails in a row on it.  An email which couldn't be
+    sent is retried later with an exponential backoff, without holding back
+    the others.  At most `maxsize` emails are queued in memory, and with a
+    spool directory emails are also kept on disk until sent, so that they
+    are sent on next start if picomon exits before."""
+
+    def __init__(self, senders=1, maxsize=0, batch=20, spool=None):
+        self._queue = queue.Queue(maxsize)
         self._quit = Event()
-        self._thread = Thread(target=self.__loop)
-        self._thread.daemon = True
-        self._thread.start()
+        self._lock = Lock()
+        self._delayed = []
+        self._batch = batch
+        self._spool = spool
+        self.counters = dict.fromkeys(('queued', 'sent', 'retried', 'failed',
+                                       'dropped'), 0)
+        if spool:
+            os.makedirs(spool, exist_ok=True)
+            self.__replay()
+        self._threads = []
+        for _ in range(senders):
+            thread = Thread(target=self.__loop)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
         # properly clean up on quit
         atexit.register(self.quit)
 
     def quit(self):
         if not self._quit.is_set():
             self._quit.set()
-            self._queue.put(((), {}))  # put a dummy item to wake up the thread
-            self._queue.join()
-            self._thread.join()
+            for _ in self._threads:
+                self._queue.put(None)  # wake up the threads
+            for thread in self._threads:
+                thread.join()
+
+    def __count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def __spool(self, mail):
+        path = os.path.join(self._spool, '%.6f-%s.json' % (time(),
+                                                          uuid4().hex))
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'args': mail.args, 'kwargs': mail.kwargs}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + '.tmp', path)
+        except OSError as e:
+            logging.warning("Couldn't spool email: %s" % e)
+        else:
+            mail.path = path
+
+    def __unspool(self, mail):
+        if mail.path is not None:
+            try:
+                os.unlink(mail.path)
+            except OSError as e:
+                logging.warning("Couldn't remove spooled email: %s" % e)
+
+    def __replay(self):
+        for name in sorted(os.listdir(self._spool)):
+            path = os.path.join(self._spool, name)
+            if name.endswith('.tmp'):
+                os.unlink(path)  # never fully written
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning("Skipping spooled email %s: %s" % (path, e))
+                continue
+            self.__put(_Mail(data['args'], data['kwargs'], path))
+        if self._queue.qsize():
+            logging.info('Sending %d spooled email(s)' % self._queue.qsize())
+
+    def __put(self, mail):
+        try:
+            self._queue.put_nowait(mail)
+        except queue.Full:
+            # still spooled (if at all), so sent on next start
+            logging.warning("Email queue full, dropping email")
+            self.__count('dropped')
+        else:
+            self.__count('queued')
+
+    def __retry(self, mail, error):
+        from . import config
+
+        mail.attempts += 1
+        delay = min(config.emails.smtp_retry_timeout *
+                    2 ** (mail.attempts - 1), config.emails.smtp_retry_max)
+        logging.warning("Couldn't send email (will retry in %ds): %s" %
+                        (delay, str(error)))
+        mail.next_try = monotonic() + delay
+        with self._lock:
+            heapq.heappush(self._delayed, mail)
+        self.__count('retried')
+
+    def __next_retry(self):
+        """ Queue emails due for another try, returns the delay until the
+        next one or None """
+        while True:
+            with self._lock:
+                if not self._delayed:
+                    return None
+                delay = self._delayed[0].next_try - monotonic()
+                if delay > 0:
+                    return delay
+                mail = heapq.heappop(self._delayed)
+            self.__put(mail)
 
     def __server_quit(self, server=None):
         if server is not None:
-            server.quit()
+            try:
+                server.quit()
+            except (OSError, smtplib.SMTPException):
+                server.close()
         return None
 
+    def __send(self, server, mail):
+        from . import config
+
+        try:
+            if server is None:
+                server = smtplib.SMTP(config.emails.smtp_host)
+            server.sendmail(*mail.args, **mail.kwargs)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                smtplib.SMTPDataError) as e:
+            if isinstance(e, smtplib.SMTPRecipientsRefused):
+                codes = [code for (code, msg) in e.recipients.values()]
+            else:
+                codes = [e.smtp_code]
+            if all(500 <= code < 600 for code in codes):
+                # permanent error, most likely a configuration problem
+                logging.error("Couldn't send email: %s" % str(e))
+                self.__unspool(mail)
+                self.__count('failed')
+                return server
+            server = self.__server_quit(server)
+            self.__failed(mail, e)
+        except Exception as e:
+            # assume a temporary server error, the connection is unusable
+            if server is not None:
+                server.close()
+            server = None
+            self.__failed(mail, e)
+        else:
+            self.__unspool(mail)
+            self.__count('sent')
+        return server
+
+    def __failed(self, mail, error):
+        if self._quit.is_set():
+            # don't block when quitting, spooled emails are sent on next start
+            logging.warning("Couldn't send email: %s" % str(error))
+        else:
+            self.__retry(mail, error)
+
     def __loop(self):
         from . import config
 
         server = None
-        while not self._quit.is_set() or not self._queue.empty():
+        mail = False
+        while mail is not None:  # None wakes threads up to quit
+            timeout = config.emails.smtp_keepalive_timeout
+            delay = self.__next_retry()
+            if delay is not None:
+                timeout = min(timeout, delay)
             try:
-                timeout = config.emails.smtp_keepalive_timeout
-                args, kwargs = self._queue.get(timeout=timeout)
+                mail = self._queue.get(timeout=timeout)
             except queue.Empty:
-                server = self.__server_quit(server)
-            else:
-                if len(args) or len(kwargs):  # ignore empty items
-                    try:
-                        if server is None:
-                            server = smtplib.SMTP(config.emails.smtp_host)
-                        server.sendmail(*args, **kwargs)
-                    except Exception as e:
-                        # message couldn't be sent, but assume it's a temporary
-                        # server error and try again in a moment (unless when
-                        # we're quitting, not to block).  If it is a permanent
-                        # error it most likely means the configuration is wrong
-                        # anyway so the user has to fix it and restart.
-                        if self._quit.is_set():
-                            logging.warning("Couldn't send email: %s" % str(e))
-                        else:
-                            logging.warning(
-                                "Couldn't send email (will retry in %ds): %s" %
-                                (config.emails.smtp_retry_timeout, str(e)))
-                            # put the item back and wait
-                            self._queue.put_nowait((args, kwargs))
-                            self._quit.wait(
-                                timeout=config.emails.smtp_retry_timeout)
-                self._queue.task_done()
+                if delay is None or delay > timeout:
+                    server = self.__server_quit(server)
+                continue
+            # send a batch of emails on the same connection, only taking
+            # another one off the queue while the batch has room for it
+            sent = 0
+            while mail is not None:
+                server = self.__send(server, mail)
+                sent += 1
+                if sent >= self._batch:
+                    break
+                try:
+                    mail = self._queue.get_nowait()
+                except queue.Empty:
+                    break
         self.__server_quit(server)
 
     def sendmail(self, *args, **kwargs):
-        self._queue.put((args, kwargs))
+        mail = _Mail(args, kwargs)
+        if self._spool:
+            self.__spool(mail)
+        self.__put(mail)
+
+    def qsize(self):
+        """ Number of emails waiting to be sent """
+        with self._lock:
+            return self._queue.qsize() + len(self._delayed)
 
 
-_mailer = ThreadedSMTP()
+_mailer = None
+
+
+def start():
+    """ Start sending emails (emails sent before start it too) """
+    from . import config
+    global _mailer
+
+    if _mailer is None:
+        _mailer = ThreadedSMTP(config.emails.smtp_senders,
+                               config.emails.queue_size,
+                               config.emails.batch_size,
+                               config.emails.spool_dir or None)
+    return _mailer
 
 
 def quit():
-    _mailer.quit()
+    if _mailer is not None:
+        _mailer.quit()
+
+
+def queue_size():
+    return _mailer.qsize() if _mailer is not None else 0
+
+
+def counters():
+    """ Return the number of emails queued, sent, retried, failed for good
+    and dropped (because the queue was full) so far """
+    if _mailer is None:
+        return dict.fromkeys(('queued', 'sent', 'retried', 'failed',
+                              'dropped'), 0)
+    with _mailer._lock:
+        return dict(_mailer.counters)
 
 
 def send_email(subject, body, extra_headers={}):
@@ -101,7 +290,7 @@ def send_email(subject, body, extra_headers={}):
     for (key, val) in extra_headers.items():
         msg[key] = val
 
-    _mailer.sendmail(config.emails.addr_from, config.emails.to,
+    start().sendmail(config.emails.addr_from, config.emails.to,
                      msg.as_string())
 
 
@@ -119,7 +308,7 @@ def send_email_for_check(check):
         delta = datetime.now() - check.failure_date
         # remove microsec
         delta = delta - timedelta(microseconds=delta.microseconds)
-        n = check.retry_count + 1 - check.retry
+        n = check.recovered_after + 1 - check.retry
         msg_text += ("recovered after %s (%d %s)." %
                      (delta, n, "retry" if n == 1 else "retries"))
     else:
@@ -136,6 +325,170 @@ def send_email_for_check(check):
     send_email(subject, msg_text, extra_headers)
 
 
+class Coalescer(object):
+    """Collects state changes of checks for `window` seconds and notifies
+    them at once: a lone change gets its own email, several a digest.  A
+    check changing back within the window isn't notified at all, and checks
+    changing state at least flap_threshold times within flap_window seconds
+    are reported as flapping, their notifications being suppressed until
+    they settle down."""
+
+    # seconds between checks of whether flapping checks settled down,
+    # without a window
+    settle_every = 60
+
+    def __init__(self, window, flap_window=3600, flap_threshold=0):
+        self.window = window
+        self.flap_window = flap_window
+        self.flap_threshold = flap_threshold
+        self._lock = Lock()
+        self._timer = None
+        # check -> its state before the window, or None if it started
+        # flapping
+        self._pending = OrderedDict()
+        self._history = {}
+        self._notified = {}
+        self._flapping = set()
+
+    def notify(self, check):
+        """ Note that check changed state """
+        now = monotonic()
+        with self._lock:
+            if self.flap_threshold > 0:
+                history = self._history.setdefault(check, deque())
+                history.append(now)
+                while history[0] < now - self.flap_window:
+                    history.popleft()
+                if len(history) >= self.flap_threshold and \
+                        check not in self._flapping:
+                    logging.info('%s is flapping' % check)
+                    self._flapping.add(check)
+                    self._pending[check] = None
+            if check not in self._pending and check not in self._flapping:
+                self._pending[check] = not check.ok
+            if self.window <= 0:
+                self.__flush()
+                if self._flapping and self._timer is None:
+                    # see when flapping checks settle down
+                    self.__schedule()
+            elif self._timer is None:
+                self.__schedule()
+
+    def __schedule(self):
+        self._timer = Timer(self.window if self.window > 0
+                            else self.settle_every, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            self.__flush()
+            if self._flapping:
+                # see when flapping checks settle down
+                self.__schedule()
+
+    def __flush(self):
+        pending = self._pending
+        self._pending = OrderedDict()
+        changed = [check for (check, was_ok) in pending.items()
+                   if was_ok is not None and check.ok != was_ok]
+        flapping = [check for (check, was_ok) in pending.items()
+                    if was_ok is None]
+        now = monotonic()
+        for check, history in list(self._history.items()):
+            while history and history[0] < now - self.flap_window:
+                history.popleft()
+            if check in self._flapping and \
+                    len(history) < self.flap_threshold:
+                logging.info('%s stopped flapping' % check)
+                self._flapping.discard(check)
+                if check.ok != self._notified.get(check, True):
+                    changed.append(check)
+            if not history and check not in self._flapping:
+                # no change within flap_window, its next one is notified
+                # (and noted) before it can flap again
+                del self._history[check]
+                self._notified.pop(check, None)
+        for check in changed:
+            if check in self._history:
+                self._notified[check] = check.ok
+        if len(changed) == 1 and not flapping:
+            send_email_for_check(changed[0])
+        elif changed or flapping:
+            send_digest(changed, flapping)
+
+    def forget(self, checks):
+        """ Drop what is known of checks, removed from the configuration """
+        with self._lock:
+            for check in checks:
+                self._pending.pop(check, None)
+                self._history.pop(check, None)
+                self._notified.pop(check, None)
+                self._flapping.discard(check)
+
+
+_coalescer = None
+
+
+def notify(check):
+    """ Notify the state change of check, through the coalescing stage """
+    from . import config
+    global _coalescer
+
+    if check.muted:
+        logging.debug('%s muted, not notified' % check)
+        return
+    if _coalescer is None:
+        _coalescer = Coalescer(config.emails.coalesce.window,
+                               config.emails.flap.window,
+                               config.emails.flap.threshold)
+    _coalescer.notify(check)
+
+
+def forget(checks):
+    """ Forget checks removed from the configuration """
+    if _coalescer is not None:
+        _coalescer.forget(checks)
+
+
+def send_digest(changed, flapping):
+    """ Send a single email about the state changes of several checks,
+    grouped by target and check class """
+    from . import config
+
+    problems = sum(1 for check in changed if not check.ok)
+    subject = config.emails.coalesce.subject_tpl.format_map(
+        defaultdict(lambda: "<no substitution>",
+                    problems=problems,
+                    recoveries=len(changed) - problems,
+                    flapping=len(flapping)))
+
+    targets = OrderedDict()
+    for check in sorted(changed, key=lambda c: (c.target_name,
+                                                type(c).__name__)):
+        targets.setdefault(check.target_name, []).append(check)
+    lines = []
+    for target, checks in targets.items():
+        lines.append('%s:' % target)
+        for check in checks:
+            if check.ok:
+                lines.append('  OK: %s' % check)
+            else:
+                lines.append('  Problem: %s\n    %s' % (
+                    check, check.errmsg.strip().replace('\n', '\n    ')))
+        lines.append('')
+    if flapping:
+        lines.append('Flapping, notifications suppressed until they settle:')
+        lines += ['  %s' % check for check in flapping]
+
+    # later notifications about any of these checks follow up on the digest
+    msgid = make_msgid('digest')
+    for check in changed:
+        check.mails_msgid = msgid
+    send_email(subject, '\n'.join(lines), {'Message-ID': msgid})
+
+
 def send_email_report(text):
     from . import config
     send_email(config.emails.report.subject, text)
@@ -0,0 +1,247 @@
+"""
+Prometheus metrics.
+
+Checks keep their own counters and histograms, updated once per run with a
+few additions, and per-class and scheduler figures are only aggregated when
+the endpoint is scraped, so that metrics cost next to nothing when nobody
+looks at them.
+
+"""
+
+
+import logging
+import socket
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import monotonic
+
+
+# upper bounds (in seconds) of histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def add(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.sum += other.sum
+
+
+class Latency(object):
+    """Streaming estimate of the duration of successful runs: a smoothed mean
+    and mean deviation, as TCP estimates round-trip times (RFC 6298)"""
+
+    __slots__ = ('mean', 'deviation', 'samples')
+
+    def __init__(self):
+        self.mean = 0.0
+        self.deviation = 0.0
+        self.samples = 0
+
+    def observe(self, value):
+        if not self.samples:
+            self.mean = value
+            self.deviation = value / 2
+        else:
+            self.deviation += (abs(value - self.mean) - self.deviation) / 4
+            self.mean += (value - self.mean) / 8
+        self.samples += 1
+
+    def bound(self, deviations):
+        """ Duration that runs seldom exceed, deviations mean deviations over
+        the mean """
+        return self.mean + deviations * self.deviation
+
+
+class CheckStats(object):
+    """Counters and histograms of the runs of a check"""
+
+    __slots__ = ('duration', 'lateness', 'successes', 'failures', 'latency')
+
+    def __init__(self):
+        self.duration = Histogram()
+        self.lateness = Histogram()
+        self.successes = 0
+        self.failures = 0
+        self.latency = Latency()
+
+    def observe(self, success, duration, lateness):
+        self.duration.observe(duration)
+        self.lateness.observe(lateness)
+        if success:
+            self.latency.observe(duration)
+            self.successes += 1
+        else:
+            self.failures += 1
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (k, _escape(v)) for (k, v) in labels)
+
+
+class _Family(object):
+    def __init__(self, name, kind, doc):
+        self.name = name
+        self.kind = kind
+        self.doc = doc
+        self.lines = []
+
+    def sample(self, labels, value, suffix=''):
+        value = int(value) if isinstance(value, int) else repr(float(value))
+        self.lines.append('%s%s{%s} %s' % (self.name, suffix, _labels(labels),
+                                          value))
+
+    def histogram(self, labels, hist):
+        total = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), hist.counts):
+            total += n
+            self.sample(labels + [('le', bound)], total, '_bucket')
+        self.sample(labels, hist.sum, '_sum')
+        self.sample(labels, total, '_count')
+
+    def render(self):
+        return ['# HELP %s %s' % (self.name, self.doc),
+                '# TYPE %s %s' % (self.name, self.kind)] + self.lines
+
+
+def collect(checks):
+    """ Return the metrics of checks (and mails) in Prometheus text format """
+    from . import mails, sharing
+
+    families = OrderedDict()
+
+    def family(name, kind, doc):
+        if name not in families:
+            families[name] = _Family('picomon_' + name, kind, doc)
+        return families[name]
+
+    now = monotonic()
+    classes = OrderedDict()
+    in_flight = 0
+    queued = 0
+    for check in checks:
+        cls = type(check).__name__
+        labels = [('check', check.ident), ('class', cls),
+                  ('target', check.target_name)]
+        stats = check.stats
+        family('check_duration_seconds', 'histogram',
+               'Duration of check runs').histogram(labels, stats.duration)
+        family('check_successes_total', 'counter',
+               'Successful check runs').sample(labels, stats.successes)
+        family('check_failures_total', 'counter',
+               'Failed check runs').sample(labels, stats.failures)
+        family('check_retries', 'gauge',
+               'Consecutive failures of a check').sample(labels,
+                                                        check.retry_count)
+        family('check_up', 'gauge',
+               'Whether a check is in OK state').sample(labels, check.ok)
+        family('check_unreachable', 'gauge',
+               'Whether a check depends on a failing one').sample(
+                   labels, check.unreachable)
+        family('check_overruns_total', 'counter',
+               'Periods missed by a check still running').sample(
+                   labels, check.overruns)
+        family('check_latency_seconds', 'gauge',
+               'Smoothed duration of successful check runs').sample(
+                   labels, stats.latency.mean)
+        family('check_timeout_seconds', 'gauge',
+               'Timeout of the next check run').sample(labels, check.timeout)
+        agg = classes.get(cls)
+        if agg is None:
+            agg = classes[cls] = CheckStats()
+        agg.duration.add(stats.duration)
+        agg.lateness.add(stats.lateness)
+        agg.successes += stats.successes
+        agg.failures += stats.failures
+        if check.running:
+            in_flight += 1
+        elif check.next_due is not None and check.next_due <= now:
+            queued += 1
+
+    for cls, agg in classes.items():
+        labels = [('class', cls)]
+        family('class_duration_seconds', 'histogram',
+               'Duration of check runs per class').histogram(labels,
+                                                             agg.duration)
+        family('class_successes_total', 'counter',
+               'Successful check runs per class').sample(labels,
+                                                         agg.successes)
+        family('class_failures_total', 'counter',
+               'Failed check runs per class').sample(labels, agg.failures)
+        family('class_lateness_seconds', 'histogram',
+               'How late checks started after they were due').histogram(
+                   labels, agg.lateness)
+
+    family('checks_in_flight', 'gauge',
+           'Checks currently running').sample([], in_flight)
+    family('checks_queued', 'gauge',
+           'Checks due but not started yet').sample([], queued)
+    family('shared_results_total', 'counter',
+           'Check runs saved by sharing the result of an identical '
+           'check').sample([], sharing.shared().hits)
+    family('mail_queue_size', 'gauge',
+           'Emails waiting to be sent').sample([], mails.queue_size())
+    for counter, value in sorted(mails.counters().items()):
+        family('mails_%s_total' % counter, 'counter',
+               'Emails %s so far' % counter).sample([], value)
+
+    lines = []
+    for f in families.values():
+        lines += f.render()
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        from . import config
+
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = collect(list(config.checks)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: ' + format % args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(listen):
+    """ Serve metrics over HTTP on listen ('host:port') from a background
+    thread, returns the server """
+    host, port = listen.rsplit(':', 1)
+    host = host.strip('[]')
+
+    class Server(_Server):
+        address_family = socket.AF_INET6 if ':' in host else socket.AF_INET
+
+    server = Server((host, int(port)), _Handler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,96 @@
+"""
+In-process probe engines.
+
+Probes are started without blocking and return concurrent.futures.Future
+objects, all their I/O is multiplexed on a single shared IOLoop thread.
+
+"""
+
+
+import logging
+from threading import Lock
+from ._base import ProbeError, then, chain, gather
+from ._loop import IOLoop
+from ._icmp import Pinger
+from ._http import HTTPClient, HTTPResult
+from ._dns import DNSClient, DNSError, Message, system_resolvers
+from ._zone import ZoneChecker, ServerSOA
+from ._stream import StreamClient, StreamResult, Send, Read
+from ._smtp import smtp_dialog
+from ._xmpp import xmpp_dialog
+from ._udp import UDPProber
+from ._process import ProcessReactor, ProcessResult
+
+
+_lock = Lock()
+_loop = None
+_engines = {}
+
+
+def get_loop():
+    """ Return the shared IOLoop, starting it on first use """
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = IOLoop()
+        return _loop
+
+
+def _engine(key, factory):
+    # engines failing to initialise are remembered as None so that callers
+    # fall back to external commands without retrying on every probe
+    loop = get_loop()
+    with _lock:
+        if key not in _engines:
+            try:
+                _engines[key] = factory(loop)
+            except OSError as e:
+                logging.warning("In-process %s probes unavailable: %s" %
+                                (key[0], e))
+                _engines[key] = None
+        return _engines[key]
+
+
+def pinger(family):
+    """ Return the shared Pinger for family, or None if ICMP sockets can't be
+    opened (no unprivileged ICMP nor raw socket permission) """
+    return _engine(('ICMP', family), lambda loop: Pinger(family, loop))
+
+
+def http_client():
+    """ Return the shared HTTPClient """
+    from .. import config
+    return _engine(('HTTP',), lambda loop: HTTPClient(
+        config.probes.http.workers, config.probes.http.keepalive))
+
+
+def dns_client():
+    """ Return the shared DNSClient """
+    return _engine(('DNS',), DNSClient)
+
+
+def zone_checker():
+    """ Return the shared ZoneChecker, or None if DNS is unavailable """
+    from .. import config
+    dns = dns_client()
+    if dns is None:
+        return None
+    return _engine(('SOA',), lambda loop: ZoneChecker(
+        dns, config.probes.dns.resolvers or system_resolvers()))
+
+
+def stream_client():
+    """ Return the shared StreamClient """
+    return _engine(('TCP',), StreamClient)
+
+
+def udp_prober():
+    """ Return the shared UDPProber """
+    return _engine(('UDP',), UDPProber)
+
+
+def process_reactor():
+    """ Return the shared ProcessReactor """
+    from .. import config
+    return _engine(('process',), lambda loop: ProcessReactor(
+        loop, config.probes.exec.max_output))
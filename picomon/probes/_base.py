@@ -0,0 +1,64 @@
+from concurrent.futures import Future
+from threading import Lock
+
+
+class ProbeError(Exception):
+    """Raised (through futures) by probe engines when a probe fails, its
+    message ends up in the check's errmsg"""
+    pass
+
+
+def then(future, fn):
+    """ Return a Future of fn(future), computed once future is done """
+    chained = Future()
+
+    def done(f):
+        try:
+            chained.set_result(fn(f))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def chain(future, fn):
+    """ Like then(), for a fn returning a Future itself """
+    chained = Future()
+
+    def inner_done(f):
+        try:
+            chained.set_result(f.result())
+        except Exception as e:
+            chained.set_exception(e)
+
+    def done(f):
+        try:
+            fn(f).add_done_callback(inner_done)
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def gather(futures):
+    """ Return a Future of the list of futures, set once all of them are
+    done (whether they failed or not) """
+    gathered = Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def done(f):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        gathered.set_result(futures)
+
+    if not futures:
+        gathered.set_result(futures)
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
@@ -0,0 +1,323 @@
+import errno
+import random
+import socket
+import struct
+from collections import namedtuple
+from concurrent.futures import Future
+from time import monotonic
+from ._base import ProbeError
+
+
+TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15,
+         'TXT': 16, 'AAAA': 28, 'SRV': 33, 'ANY': 255}
+TYPE_NAMES = dict((v, k) for (k, v) in TYPES.items())
+RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN',
+          4: 'NOTIMP', 5: 'REFUSED'}
+CLASS_IN = 1
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+Record = namedtuple('Record', 'name type ttl data')
+SOA = namedtuple('SOA', 'mname rname serial refresh retry expire minimum')
+
+
+class DNSError(ProbeError):
+    pass
+
+
+def system_resolvers(path='/etc/resolv.conf'):
+    """ Return the name servers listed in resolv.conf """
+    resolvers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == 'nameserver':
+                    resolvers.append(fields[1].split('%')[0])
+    except OSError:
+        pass
+    return resolvers or ['127.0.0.1']
+
+
+def encode_name(name):
+    """ Encode a domain name in wire format (without compression) """
+    labels = name.rstrip('.').encode('idna').split(b'.') \
+        if name.strip('.') else []
+    wire = b''
+    for label in labels:
+        if not 0 < len(label) < 64:
+            raise DNSError("Invalid domain name '%s'" % name)
+        wire += struct.pack('!B', len(label)) + label
+    return wire + b'\0'
+
+
+def build_query(ident, qname, qtype, rd=True):
+    if not isinstance(qtype, int):
+        try:
+            qtype = TYPES[qtype.upper()]
+        except KeyError:
+            raise DNSError("Unknown query type '%s'" % qtype)
+    return struct.pack('!HHHHHH', ident, FLAG_RD if rd else 0, 1, 0, 0, 0) + \
+        encode_name(qname) + struct.pack('!HH', qtype, CLASS_IN)
+
+
+def read_name(data, offset):
+    """ Read a possibly compressed name at offset, returns it along with the
+    offset of what follows """
+    labels = []
+    end = None
+    for _ in range(128):  # bounded, to survive compression loops
+        length = data[offset]
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = (length & 0x3f) << 8 | data[offset + 1]
+        elif length == 0:
+            name = '.'.join(labels) + '.'
+            return name, offset + 1 if end is None else end
+        else:
+            labels.append(data[offset + 1:offset + 1 + length]
+                          .decode('ascii', errors='replace'))
+            offset += 1 + length
+    raise DNSError('Malformed name in DNS reply')
+
+
+def _read_rdata(data, offset, rtype, rdlength):
+    rdata = data[offset:offset + rdlength]
+    if rtype == TYPES['A'] and rdlength == 4:
+        return socket.inet_ntop(socket.AF_INET, rdata)
+    if rtype == TYPES['AAAA'] and rdlength == 16:
+        return socket.inet_ntop(socket.AF_INET6, rdata)
+    if rtype in (TYPES['NS'], TYPES['CNAME'], TYPES['PTR']):
+        return read_name(data, offset)[0]
+    if rtype == TYPES['MX']:
+        return (struct.unpack('!H', rdata[:2])[0],
+                read_name(data, offset + 2)[0])
+    if rtype == TYPES['SOA']:
+        mname, pos = read_name(data, offset)
+        rname, pos = read_name(data, pos)
+        return SOA(mname, rname, *struct.unpack('!IIIII', data[pos:pos + 20]))
+    return rdata
+
+
+class Message(object):
+    """A parsed DNS reply"""
+
+    def __init__(self, data):
+        try:
+            (self.ident, self.flags, qdcount, ancount, nscount,
+             arcount) = struct.unpack('!HHHHHH', data[:12])
+            offset = 12
+            for _ in range(qdcount):
+                offset = read_name(data, offset)[1] + 4
+            self.question = data[12:offset]
+            self.answers, offset = self.__records(data, offset, ancount)
+            self.authority, offset = self.__records(data, offset, nscount)
+            self.additional, offset = self.__records(data, offset, arcount)
+        except (IndexError, struct.error, ValueError):
+            raise DNSError('Malformed DNS reply')
+
+    @staticmethod
+    def __records(data, offset, count):
+        records = []
+        for _ in range(count):
+            name, offset = read_name(data, offset)
+            rtype, rclass, ttl, rdlength = struct.unpack(
+                '!HHIH', data[offset:offset + 10])
+            offset += 10
+            if offset + rdlength > len(data):
+                raise DNSError('Truncated record in DNS reply')
+            records.append(Record(name, TYPE_NAMES.get(rtype, rtype), ttl,
+                                  _read_rdata(data, offset, rtype, rdlength)))
+            offset += rdlength
+        return records, offset
+
+    @property
+    def rcode(self):
+        return self.flags & 0x000f
+
+    @property
+    def rcode_name(self):
+        return RCODES.get(self.rcode, str(self.rcode))
+
+    @property
+    def truncated(self):
+        return bool(self.flags & FLAG_TC)
+
+    @property
+    def authoritative(self):
+        return bool(self.flags & FLAG_AA)
+
+
+class _Query(object):
+    __slots__ = ('future', 'family', 'server', 'port', 'ident', 'query',
+                 'deadline', 'timer', 'sock', 'buf')
+
+    def __init__(self, future, family, server, port, ident, query, deadline):
+        self.future = future
+        self.family = family
+        self.server = server
+        self.port = port
+        self.ident = ident
+        self.query = query
+        self.deadline = deadline
+        self.timer = None
+        self.sock = None
+        self.buf = b''
+
+
+class DNSClient(object):
+    """Sends DNS queries to any number of servers from one UDP socket per
+    address family, demultiplexing replies by query id and source, and
+    retrying over TCP when replies are truncated"""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._socks = {}
+        self._pending = {}
+
+    def query(self, server, qname, qtype='A', timeout=2, port=53, rd=True):
+        """ Query server for qname/qtype, returns a Future of the reply as a
+        Message, failing with DNSError on network errors or timeout """
+        future = Future()
+        try:
+            family = socket.AF_INET6 if ':' in server else socket.AF_INET
+            socket.inet_pton(family, server)
+            query = build_query(0, qname, qtype, rd)
+        except (OSError, ValueError) as e:
+            future.set_exception(DNSError('Invalid query: %s' % e))
+            return future
+        except DNSError as e:
+            future.set_exception(e)
+            return future
+        q = _Query(future, family, server, port, None, query,
+                   monotonic() + timeout)
+        self._loop.call_soon(self.__send, q)
+        return future
+
+    def __socket(self, family):
+        sock = self._socks.get(family)
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._loop.add_reader(sock, lambda: self.__read(sock, family))
+            self._socks[family] = sock
+        return sock
+
+    def __send(self, q):
+        for _ in range(0x10000):
+            q.ident = random.getrandbits(16)
+            if (q.family, q.ident) not in self._pending:
+                break
+        q.query = struct.pack('!H', q.ident) + q.query[2:]
+        try:
+            self.__socket(q.family).sendto(q.query, (q.server, q.port))
+        except OSError as e:
+            self.__fail(q, 'Cannot send DNS query to %s: %s' %
+                        (q.server, e.strerror))
+            return
+        self._pending[(q.family, q.ident)] = q
+        q.timer = self._loop.call_later(q.deadline - monotonic(),
+                                        self.__expire, q)
+
+    def __expire(self, q):
+        if q.sock is not None:
+            self.__close_tcp(q)
+        else:
+            self._pending.pop((q.family, q.ident), None)
+        self.__fail(q, 'No DNS reply from %s' % q.server)
+
+    def __fail(self, q, msg):
+        if not q.future.done():
+            q.future.set_exception(DNSError(msg))
+
+    def __read(self, sock, family):
+        while True:
+            try:
+                data, src = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return  # ICMP errors, the query will time out
+            if len(data) < 12:
+                continue
+            q = self._pending.get((family, struct.unpack('!H', data[:2])[0]))
+            if q is None or src[1] != q.port or \
+                    socket.inet_pton(family, src[0].split('%')[0]) != \
+                    socket.inet_pton(family, q.server):
+                continue
+            try:
+                reply = Message(data)
+            except DNSError:
+                continue
+            if reply.question != q.query[12:]:
+                continue  # not an answer to our question
+            del self._pending[(family, q.ident)]
+            if reply.truncated:
+                self.__start_tcp(q)
+                continue
+            q.timer.cancel()
+            if not q.future.done():
+                q.future.set_result(reply)
+
+    def __start_tcp(self, q):
+        q.sock = socket.socket(q.family, socket.SOCK_STREAM)
+        q.sock.setblocking(False)
+        err = q.sock.connect_ex((q.server, q.port))
+        if err not in (0, errno.EINPROGRESS):
+            self.__close_tcp(q)
+            q.timer.cancel()
+            self.__fail(q, 'Cannot connect to %s over TCP: %s' %
+                        (q.server, errno.errorcode.get(err, err)))
+            return
+        q.buf = struct.pack('!H', len(q.query)) + q.query
+        self._loop.add_writer(q.sock, lambda: self.__tcp_write(q))
+
+    def __tcp_write(self, q):
+        try:
+            sent = q.sock.send(q.buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.__tcp_error(q, e)
+            return
+        q.buf = q.buf[sent:]
+        if not q.buf:
+            self._loop.remove_writer(q.sock)
+            self._loop.add_reader(q.sock, lambda: self.__tcp_read(q))
+
+    def __tcp_read(self, q):
+        try:
+            data = q.sock.recv(65537)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.__tcp_error(q, e)
+            return
+        if not data:
+            self.__tcp_error(q, 'connection closed')
+            return
+        q.buf += data
+        if len(q.buf) < 2 or len(q.buf) < 2 + struct.unpack('!H',
+                                                            q.buf[:2])[0]:
+            return
+        self.__close_tcp(q)
+        q.timer.cancel()
+        try:
+            reply = Message(q.buf[2:])
+        except DNSError as e:
+            self.__fail(q, str(e))
+            return
+        if not q.future.done():
+            q.future.set_result(reply)
+
+    def __tcp_error(self, q, e):
+        self.__close_tcp(q)
+        q.timer.cancel()
+        self.__fail(q, 'DNS over TCP to %s failed: %s' % (q.server, e))
+
+    def __close_tcp(self, q):
+        self._loop.remove_reader(q.sock)
+        self._loop.remove_writer(q.sock)
+        q.sock.close()
@@ -0,0 +1,152 @@
+import http.client
+import socket
+import ssl
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+from ._base import ProbeError
+
+
+class HTTPResult(object):
+    """The outcome of an HTTP request, with timings (in seconds) of its
+    'connect', 'tls', 'first_byte' and 'total' phases.  Connection phases
+    are None when a kept-alive connection was reused."""
+
+    def __init__(self, version, status, reason, body, timings, reused):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.timings = timings
+        self.reused = reused
+
+    @property
+    def status_line(self):
+        return 'HTTP/%s %d %s' % ('1.0' if self.version == 10 else '1.1',
+                                  self.status, self.reason)
+
+
+class _Connection(http.client.HTTPConnection):
+    """An HTTP(S) connection recording its connect/TLS timings and resuming
+    TLS sessions"""
+
+    def __init__(self, addr, port, timeout, context=None,
+                 server_hostname=None, session=None):
+        super().__init__(addr, port, timeout=timeout)
+        self.context = context
+        self.server_hostname = server_hostname
+        self.session = session
+        self.timings = {'connect': None, 'tls': None}
+
+    def connect(self):
+        start = monotonic()
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.timings['connect'] = monotonic() - start
+        if self.context is not None:
+            start = monotonic()
+            try:
+                sock = self.context.wrap_socket(
+                    sock, server_hostname=self.server_hostname,
+                    session=self.session)
+            except Exception:
+                sock.close()
+                raise
+            self.timings['tls'] = monotonic() - start
+        self.sock = sock
+
+
+class HTTPClient(object):
+    """Runs HTTP(S) requests in a pool of threads, keeping connections alive
+    and TLS sessions per target across requests so that most probes don't
+    pay for TCP and TLS handshakes"""
+
+    def __init__(self, workers, keepalive):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._keepalive = keepalive
+        self._lock = Lock()
+        self._idle = defaultdict(list)
+        self._sessions = {}
+        # like check_http, don't validate certificates: we check that the
+        # service answers, not its PKI
+        self._context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self._context.check_hostname = False
+        self._context.verify_mode = ssl.CERT_NONE
+
+    def get(self, addr, timeout, tls=False, vhost=None, url='/', port=None):
+        """ GET url from addr, returns a Future of an HTTPResult, failing
+        with ProbeError on network errors """
+        if port is None:
+            port = 443 if tls else 80
+        key = (addr, port, tls, vhost)
+        return self._executor.submit(self.__get, key, url, timeout)
+
+    def __connection(self, key, timeout):
+        # reuse the most recently used connection, dropping those which were
+        # idle for too long as the server most likely closed them
+        now = monotonic()
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self._keepalive:
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+            session = self._sessions.get(key)
+        addr, port, tls, vhost = key
+        if tls:
+            return _Connection(addr, port, timeout, self._context,
+                               vhost or None, session), False
+        return _Connection(addr, port, timeout), False
+
+    def __release(self, key, conn, response):
+        # with TLS 1.3 session tickets only come after the handshake, so the
+        # session is only saved once a response went through
+        session = getattr(conn.sock, 'session', None)
+        if session is not None:
+            with self._lock:
+                self._sessions[key] = session
+        if response.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle[key].append((conn, monotonic()))
+
+    def __get(self, key, url, timeout):
+        addr, port, tls, vhost = key
+        headers = {'Host': vhost or (addr if ':' not in addr
+                                     else '[%s]' % addr),
+                   'User-Agent': 'picomon',
+                   'Connection': 'keep-alive'}
+        for attempt in range(2):
+            start = monotonic()
+            conn, reused = self.__connection(key, timeout)
+            try:
+                conn.request('GET', url, headers=headers)
+                sent = monotonic()
+                response = conn.getresponse()
+                first_byte = monotonic() - sent
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError) as e:
+                conn.close()
+                # a kept-alive connection may have been closed by the server
+                # meanwhile, only that case deserves another try
+                if reused and attempt == 0:
+                    continue
+                raise ProbeError('Connection closed by %s: %s' % (addr, e))
+            except socket.timeout:
+                conn.close()
+                raise ProbeError('Operation timed out')
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise ProbeError('HTTP request to %s failed: %s' % (addr, e))
+            timings = dict(conn.timings) if not reused else \
+                {'connect': None, 'tls': None}
+            timings['first_byte'] = first_byte
+            timings['total'] = monotonic() - start
+            self.__release(key, conn, response)
+            return HTTPResult(response.version, response.status,
+                              response.reason, body, timings, reused)
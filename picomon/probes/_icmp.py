@@ -0,0 +1,129 @@
+import os
+import socket
+import struct
+import logging
+from concurrent.futures import Future
+from time import monotonic
+from ._base import ProbeError
+
+
+ICMP_ECHO_REQUEST = {socket.AF_INET: 8, socket.AF_INET6: 128}
+ICMP_ECHO_REPLY = {socket.AF_INET: 0, socket.AF_INET6: 129}
+ICMP_PROTO = {socket.AF_INET: socket.IPPROTO_ICMP,
+              socket.AF_INET6: socket.IPPROTO_ICMPV6}
+
+_PAYLOAD = b'picomon-icmp-echo-payload-56bytes' + b'\0' * 23
+
+
+def checksum(data):
+    """ RFC 1071 internet checksum """
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class Pinger(object):
+    """Sends ICMP echo requests for any number of targets from a single
+    socket and matches replies by identifier and sequence number.
+
+    Unprivileged datagram ICMP sockets are used when the system allows them
+    (see net.ipv4.ping_group_range), raw sockets otherwise."""
+
+    def __init__(self, family, loop):
+        self.family = family
+        self._loop = loop
+        self._reply_type = ICMP_ECHO_REPLY[family]
+        try:
+            self._sock = socket.socket(family, socket.SOCK_DGRAM,
+                                       ICMP_PROTO[family])
+            self._raw = False
+        except OSError:
+            self._sock = socket.socket(family, socket.SOCK_RAW,
+                                       ICMP_PROTO[family])
+            self._raw = True
+        self._sock.setblocking(False)
+        # datagram sockets get their identifier rewritten by the kernel, which
+        # also filters replies for us, so only raw sockets check it
+        self._ident = os.getpid() & 0xffff
+        self._seq = 0
+        self._pending = {}
+        loop.call_soon(loop.add_reader, self._sock, self.__read)
+
+    def ping(self, addr, timeout):
+        """ Send an echo request to addr, returns a Future of the round-trip
+        time in seconds, failing with ProbeError after timeout seconds """
+        future = Future()
+        self._loop.call_soon(self.__send, addr, timeout, future)
+        return future
+
+    def __send(self, addr, timeout, future):
+        try:
+            packed = socket.inet_pton(self.family, addr)
+        except (OSError, ValueError):
+            future.set_exception(ProbeError('Invalid address %s' % addr))
+            return
+        # find a free sequence number, there would have to be 65536 probes
+        # in flight for this to loop
+        for _ in range(0x10000):
+            self._seq = (self._seq + 1) & 0xffff
+            if self._seq not in self._pending:
+                break
+        seq = self._seq
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST[self.family], 0, 0,
+                             self._ident, seq)
+        packet = header + _PAYLOAD
+        if self.family == socket.AF_INET:
+            # the kernel computes ICMPv6 checksums itself
+            packet = header[:2] + struct.pack('!H', checksum(packet)) + \
+                     packet[4:]
+        try:
+            self._sock.sendto(packet, (addr, 0))
+        except OSError as e:
+            future.set_exception(ProbeError('Cannot send ICMP echo to %s: %s'
+                                            % (addr, e.strerror)))
+            return
+        timer = self._loop.call_later(timeout, self.__expire, seq, addr,
+                                      timeout)
+        self._pending[seq] = (future, packed, monotonic(), timer)
+
+    def __expire(self, seq, addr, timeout):
+        future = self._pending.pop(seq)[0]
+        if not future.done():
+            future.set_exception(ProbeError(
+                'No ICMP echo reply from %s within %ss' % (addr, timeout)))
+
+    def __read(self):
+        while True:
+            try:
+                data, src = self._sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug('ICMP receive error: %s' % e)
+                return
+            if self._raw and self.family == socket.AF_INET:
+                data = data[(data[0] & 0x0f) * 4:]  # strip IPv4 header
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+            if icmp_type != self._reply_type:
+                continue
+            if self._raw and ident != self._ident:
+                continue
+            pending = self._pending.get(seq)
+            if pending is None:
+                continue
+            future, packed, sent, timer = pending
+            try:
+                if socket.inet_pton(self.family, src[0].split('%')[0]) \
+                        != packed:
+                    continue
+            except (OSError, ValueError):
+                continue
+            del self._pending[seq]
+            timer.cancel()
+            if not future.done():
+                future.set_result(monotonic() - sent)
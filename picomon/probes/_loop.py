@@ -0,0 +1,139 @@
+import selectors
+import socket
+import logging
+import heapq
+from collections import deque
+from itertools import count
+from threading import Thread, Lock
+from time import monotonic
+
+
+class Timer(object):
+    """A handle on a callback scheduled with IOLoop.call_later()"""
+
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class IOLoop(object):
+    """A helper class running a selectors loop in a thread.
+
+    All in-process probe engines share this loop: their sockets are
+    registered here and all their timeouts live in a single timer heap, so
+    that any number of probes can be in flight without blocking threads.
+    Apart from call_soon(), methods must be called from the loop thread."""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._timers = []
+        self._seq = count()
+        self._calls = deque()
+        self._lock = Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ,
+                                (self.__drain_wakeup, None))
+        self._thread = Thread(target=self.__loop, name='picomon-probes')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call_soon(self, callback, *args):
+        """ Schedule callback(*args) in the loop thread, thread-safe """
+        with self._lock:
+            self._calls.append((callback, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass  # a wakeup is already pending
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(monotonic() + delay, callback, args)
+        heapq.heappush(self._timers, (timer.deadline, next(self._seq), timer))
+        return timer
+
+    def add_reader(self, fileobj, callback):
+        self.__modify(fileobj, selectors.EVENT_READ, callback, 0)
+
+    def remove_reader(self, fileobj):
+        self.__modify(fileobj, selectors.EVENT_READ, None, 0)
+
+    def add_writer(self, fileobj, callback):
+        self.__modify(fileobj, selectors.EVENT_WRITE, callback, 1)
+
+    def remove_writer(self, fileobj):
+        self.__modify(fileobj, selectors.EVENT_WRITE, None, 1)
+
+    def __modify(self, fileobj, event, callback, slot):
+        try:
+            key = self._selector.get_key(fileobj)
+        except KeyError:
+            if callback is None:
+                return
+            callbacks = [None, None]
+            callbacks[slot] = callback
+            self._selector.register(fileobj, event, callbacks)
+            return
+        callbacks = key.data
+        callbacks[slot] = callback
+        events = key.events | event if callback else key.events & ~event
+        if events:
+            self._selector.modify(fileobj, events, callbacks)
+        else:
+            self._selector.unregister(fileobj)
+
+    def __drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def __run_calls(self):
+        with self._lock:
+            calls, self._calls = self._calls, deque()
+        for callback, args in calls:
+            self.__call(callback, args)
+
+    def __run_timers(self):
+        now = monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self.__call(timer.callback, timer.args)
+
+    def __call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('Unhandled error in probe engine callback')
+
+    def __loop(self):
+        while True:
+            self.__run_calls()
+            self.__run_timers()
+            # drop cancelled timers lazily, they only cost a heap slot
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - monotonic())
+            for key, events in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_r:
+                    key.data[0]()
+                    continue
+                # callbacks is updated in place, so a reader removing the
+                # writer of the same file object is honoured
+                callbacks = key.data
+                if events & selectors.EVENT_READ and callbacks[0] is not None:
+                    self.__call(callbacks[0], ())
+                if events & selectors.EVENT_WRITE and callbacks[1] is not None:
+                    self.__call(callbacks[1], ())
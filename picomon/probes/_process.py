@@ -0,0 +1,210 @@
+import fcntl
+import os
+import signal
+import subprocess
+from concurrent.futures import Future
+from time import monotonic
+
+
+class ProcessResult(object):
+    """The outcome of an external command.  timings holds the time (in
+    seconds) it took to 'spawn' it and the time it then 'run' for, checks
+    adding the time they took to 'parse' its output."""
+
+    def __init__(self, returncode, out, err, timed_out, truncated, timings):
+        self.returncode = returncode
+        self.out = out
+        self.err = err
+        self.timed_out = timed_out
+        self.truncated = truncated
+        self.timings = timings
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _decode_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class _Child(object):
+    """A child process in its own process group, with its stdout and stderr
+    piped and stdin on /dev/null"""
+
+    def __init__(self, command):
+        self.popen = None
+        if hasattr(os, 'posix_spawnp'):
+            out_r, out_w = os.pipe()
+            err_r, err_w = os.pipe()
+            try:
+                # posix_spawn vforks, which is much cheaper than fork()ing a
+                # process with a large heap like ours
+                self.pid = os.posix_spawnp(
+                    command[0], command, os.environ, setpgroup=0,
+                    file_actions=[
+                        (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                        (os.POSIX_SPAWN_DUP2, out_w, 1),
+                        (os.POSIX_SPAWN_DUP2, err_w, 2)])
+            except Exception:
+                os.close(out_r)
+                os.close(err_r)
+                raise
+            finally:
+                os.close(out_w)
+                os.close(err_w)
+            self.fds = [out_r, err_r]
+        else:
+            self.popen = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          start_new_session=True)
+            self.pid = self.popen.pid
+            self.fds = [self.popen.stdout.fileno(),
+                        self.popen.stderr.fileno()]
+
+    def poll(self):
+        """ Reap the child if it exited, returns its exit status or None """
+        if self.popen is not None:
+            return self.popen.poll()
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            return -1
+        return _decode_status(status) if pid else None
+
+    def kill(self):
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass  # already gone
+
+    def close(self, fd):
+        if self.popen is not None:
+            for f in (self.popen.stdout, self.popen.stderr):
+                if f.fileno() == fd:
+                    f.close()
+        else:
+            os.close(fd)
+
+
+class _Process(object):
+    def __init__(self, loop, command, timeout, max_output, future):
+        self.loop = loop
+        self.future = future
+        self.max_output = max_output
+        self.output = {}
+        self.truncated = False
+        self.returncode = None
+        self.pidfd = None
+        self.poll_delay = 0.005
+        start = monotonic()
+        self.child = _Child(command)
+        self.started = monotonic()
+        self.timings = {'spawn': self.started - start}
+        for fd in self.child.fds:
+            self.output[fd] = []
+            _set_nonblocking(fd)
+            loop.add_reader(fd, lambda fd=fd: self.on_pipe(fd))
+        if hasattr(os, 'pidfd_open'):
+            try:
+                self.pidfd = os.pidfd_open(self.child.pid)
+            except OSError:
+                pass  # kernel < 5.3, fall back to polling
+        if self.pidfd is not None:
+            loop.add_reader(self.pidfd, self.on_exit)
+        self.timer = loop.call_later(timeout, self.on_timeout)
+
+    def on_pipe(self, fd):
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self.loop.remove_reader(fd)
+                self.child.close(fd)
+                self.child.fds.remove(fd)
+                if not self.child.fds and self.pidfd is None:
+                    self.poll_exit()
+                self.maybe_finish()
+                return
+            # keep draining pipes beyond max_output, so that the child
+            # doesn't block, but don't buffer it
+            size = sum(len(chunk) for chunk in self.output[fd])
+            if size < self.max_output:
+                self.output[fd].append(data[:self.max_output - size])
+            if size + len(data) > self.max_output:
+                self.truncated = True
+
+    def on_exit(self):
+        self.loop.remove_reader(self.pidfd)
+        os.close(self.pidfd)
+        self.pidfd = None
+        self.poll_exit()
+
+    def poll_exit(self):
+        self.returncode = self.child.poll()
+        if self.returncode is None:
+            # usually the child exits right after closing its output
+            self.loop.call_later(self.poll_delay, self.poll_exit)
+            self.poll_delay = min(self.poll_delay * 2, 0.1)
+        else:
+            self.maybe_finish()
+
+    def maybe_finish(self):
+        if self.returncode is None or self.child.fds:
+            return
+        self.timer.cancel()
+        self.finish(False)
+
+    def on_timeout(self):
+        # kill the whole process group, not to leave grand-children behind
+        self.child.kill()
+        for fd in list(self.child.fds):
+            self.loop.remove_reader(fd)
+            self.child.close(fd)
+        self.child.fds = []
+        if self.returncode is None and self.pidfd is None:
+            self.poll_exit()  # reap it
+        self.finish(True)
+
+    def finish(self, timed_out):
+        self.timings['run'] = monotonic() - self.started
+        out, err = [b''.join(self.output[fd]) for fd in sorted(self.output)]
+        if not self.future.done():
+            self.future.set_result(ProcessResult(
+                self.returncode, out, err, timed_out, self.truncated,
+                self.timings))
+
+
+class ProcessReactor(object):
+    """Runs external commands from the shared probe loop: their pipes and
+    exits (through pidfds when available) are watched there, so that any
+    number of commands can run without a thread each.
+
+    Commands are started in their own process group, which is killed as a
+    whole on timeout, and at most max_output bytes of each of their stdout
+    and stderr are kept."""
+
+    def __init__(self, loop, max_output):
+        self._loop = loop
+        self._max_output = max_output
+
+    def spawn(self, command, timeout):
+        """ Run command, returns a Future of a ProcessResult, failing with
+        OSError if it can't be started """
+        future = Future()
+        self._loop.call_soon(self.__spawn, command, timeout, future)
+        return future
+
+    def __spawn(self, command, timeout, future):
+        try:
+            _Process(self._loop, command, timeout, self._max_output, future)
+        except OSError as e:
+            future.set_exception(e)
@@ -0,0 +1,47 @@
+import re
+from ._base import ProbeError
+from ._stream import Send, Read
+
+
+def read_reply(buf):
+    """ Parse a complete, possibly multi-line, SMTP reply from buf """
+    pos = 0
+    text = []
+    while True:
+        end = buf.find(b'\n', pos)
+        if end < 0:
+            return None
+        line = buf[pos:end].rstrip(b'\r').decode('utf-8', errors='replace')
+        pos = end + 1
+        text.append(line[4:])
+        if len(line) < 4 or line[3] != '-':
+            try:
+                return (int(line[:3]), '\n'.join(text)), pos
+            except ValueError:
+                raise ProbeError("Invalid SMTP reply '%s'" % line)
+
+
+def smtp_dialog(helo, from_addr=None, command=None, response=None):
+    """ Check the banner, greet the server and optionally send MAIL FROM and
+    a command, whose reply has to match the response regex.  Like
+    check_smtp, only the banner and the command reply are checked. """
+    code, text = yield Read('banner', read_reply)
+    if code != 220:
+        raise ProbeError('Unexpected SMTP banner: %d %s' % (code, text))
+    yield Send(('EHLO %s\r\n' % helo).encode('ascii'))
+    code, text = yield Read('ehlo', read_reply)
+    if code != 250:
+        # ancient servers only know about HELO
+        yield Send(('HELO %s\r\n' % helo).encode('ascii'))
+        code, text = yield Read('helo', read_reply)
+    if from_addr:
+        yield Send(('MAIL FROM:<%s>\r\n' % from_addr).encode('utf-8'))
+        code, text = yield Read('mail_from', read_reply)
+    if command:
+        yield Send(('%s\r\n' % command).encode('utf-8'))
+        code, text = yield Read('command', read_reply)
+        reply = '%d %s' % (code, text)
+        if response and re.search(response, reply, flags=re.M) is None:
+            raise ProbeError("Unexpected reply to '%s': %s" % (command, reply))
+    yield Send(b'QUIT\r\n')
+    return code, text
@@ -0,0 +1,208 @@
+import errno
+import socket
+from concurrent.futures import Future
+from time import monotonic
+from ._base import ProbeError
+
+
+class Send(object):
+    """Dialog step queuing data to send"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Read(object):
+    """Dialog step waiting for a reply.  parser(buffer) returns None while
+    the reply is incomplete, else the parsed reply and the number of bytes
+    it used.  The time spent waiting is recorded as the `name` phase."""
+
+    __slots__ = ('name', 'parser')
+
+    def __init__(self, name, parser):
+        self.name = name
+        self.parser = parser
+
+
+# refuse to buffer more than this while waiting for a reply
+MAX_BUFFER = 65536
+
+
+class StreamResult(object):
+    """The outcome of a dialog: the value it returned and the timings (in
+    seconds) of its 'connect', Read steps and 'total' phases"""
+
+    def __init__(self, value, timings):
+        self.value = value
+        self.timings = timings
+
+
+class _Conversation(object):
+    def __init__(self, loop, addr, port, dialog, timeout, future):
+        self.loop = loop
+        self.addr = addr
+        self.port = port
+        self.dialog = dialog
+        self.future = future
+        self.start = self.mark = monotonic()
+        self.timings = {}
+        self.inbuf = b''
+        self.outbuf = b''
+        self.reading = None
+        self.sock = None
+        self.timer = loop.call_later(timeout, self.fail,
+                                     'Operation timed out')
+
+    def connect(self):
+        family = socket.AF_INET6 if ':' in self.addr else socket.AF_INET
+        try:
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.setblocking(False)
+            err = self.sock.connect_ex((self.addr, self.port))
+        except OSError as e:
+            self.fail('Cannot connect to %s: %s' % (self.addr, e))
+            return
+        if err not in (0, errno.EINPROGRESS):
+            self.fail('Cannot connect to %s: %s' % (self.addr,
+                                                    errno.errorcode.get(err)))
+            return
+        self.loop.add_writer(self.sock, self.on_connect)
+
+    def on_connect(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.fail('Cannot connect to %s: %s' % (self.addr,
+                                                    errno.errorcode.get(err)))
+            return
+        self.loop.remove_writer(self.sock)
+        self.loop.add_reader(self.sock, self.on_read)
+        self.phase('connect')
+        self.advance(None)
+
+    def phase(self, name):
+        now = monotonic()
+        self.timings[name] = now - self.mark
+        self.mark = now
+
+    def advance(self, value):
+        # run the dialog until it waits for a reply which isn't there yet
+        while True:
+            try:
+                step = self.dialog.send(value)
+            except StopIteration as e:
+                self.finish(getattr(e, 'value', None))
+                return
+            except ProbeError as e:
+                self.fail(str(e))
+                return
+            if isinstance(step, Send):
+                self.outbuf += step.data
+                self.on_write()
+                if self.sock is None:
+                    return  # failed to send
+                value = None
+            else:
+                self.reading = step
+                value = self.parse()
+                if value is None:
+                    return
+
+    def parse(self):
+        try:
+            parsed = self.reading.parser(self.inbuf)
+        except ProbeError as e:
+            self.fail(str(e))
+            return None
+        if parsed is None:
+            return None
+        value, used = parsed
+        self.inbuf = self.inbuf[used:]
+        self.phase(self.reading.name)
+        self.reading = None
+        return value
+
+    def on_read(self):
+        try:
+            data = self.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.fail('Connection to %s failed: %s' % (self.addr, e))
+            return
+        if not data:
+            self.fail('Connection closed by %s' % self.addr)
+            return
+        self.inbuf += data
+        if self.reading is None:
+            return
+        value = self.parse()
+        if value is not None:
+            self.advance(value)
+        elif len(self.inbuf) > MAX_BUFFER:
+            self.fail('Reply from %s too long' % self.addr)
+
+    def on_write(self):
+        if self.sock is None:
+            return
+        try:
+            sent = self.sock.send(self.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            self.fail('Connection to %s failed: %s' % (self.addr, e))
+            return
+        self.outbuf = self.outbuf[sent:]
+        if self.outbuf:
+            self.loop.add_writer(self.sock, self.on_write)
+        else:
+            self.loop.remove_writer(self.sock)
+            if self.future.done():
+                self.close()  # the dialog was over, only waiting to flush
+
+    def finish(self, value):
+        self.timer.cancel()
+        self.timings['total'] = monotonic() - self.start
+        if not self.future.done():
+            self.future.set_result(StreamResult(value, self.timings))
+        if self.sock is None:
+            return
+        self.loop.remove_reader(self.sock)
+        if not self.outbuf:
+            self.close()
+        else:
+            # let a last command (QUIT...) go, but not forever
+            self.timer = self.loop.call_later(1, self.close)
+
+    def fail(self, msg):
+        self.timer.cancel()
+        self.close()
+        if not self.future.done():
+            self.future.set_exception(ProbeError(msg))
+
+    def close(self):
+        self.dialog.close()
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+            self.loop.remove_writer(self.sock)
+            self.sock.close()
+            self.sock = None
+
+
+class StreamClient(object):
+    """Runs TCP dialogs with any number of servers at once on non-blocking
+    sockets.  A dialog is a generator yielding Send and Read steps, the
+    latter being resumed with the parsed reply; it fails by raising
+    ProbeError."""
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def converse(self, addr, port, dialog, timeout):
+        """ Run dialog with addr:port, returns a Future of a StreamResult,
+        failing with ProbeError """
+        future = Future()
+        self._loop.call_soon(lambda: _Conversation(
+            self._loop, addr, port, dialog, timeout, future).connect())
+        return future
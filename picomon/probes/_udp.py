@@ -0,0 +1,111 @@
+import heapq
+import socket
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from itertools import count
+from time import monotonic
+from ._base import ProbeError
+
+
+class _Probe(object):
+    __slots__ = ('future', 'key', 'addr', 'timeout', 'deadline')
+
+    def __init__(self, future, key, addr, timeout):
+        self.future = future
+        self.key = key
+        self.addr = addr
+        self.timeout = timeout
+        self.deadline = monotonic() + timeout
+
+
+class UDPProber(object):
+    """Sends datagrams to any number of targets from one UDP socket per
+    address family and demultiplexes replies by source address.
+
+    Probes to the same address and port are answered in order.  All
+    timeouts are kept in a heap behind a single loop timer."""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._socks = {}
+        self._pending = defaultdict(deque)
+        self._deadlines = []
+        self._seq = count()
+        self._timer = None
+
+    def probe(self, addr, port, payload, timeout):
+        """ Send payload to addr:port, returns a Future of the first reply
+        from there, failing with ProbeError after timeout seconds """
+        future = Future()
+        self._loop.call_soon(self.__send, addr, port, payload, timeout,
+                             future)
+        return future
+
+    def __socket(self, family):
+        sock = self._socks.get(family)
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._loop.add_reader(sock, lambda: self.__read(sock, family))
+            self._socks[family] = sock
+        return sock
+
+    def __send(self, addr, port, payload, timeout, future):
+        family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+        try:
+            key = (family, socket.inet_pton(family, addr), port)
+            self.__socket(family).sendto(payload, (addr, port))
+        except (OSError, ValueError) as e:
+            future.set_exception(ProbeError('Cannot send datagram to %s: %s'
+                                            % (addr, e)))
+            return
+        probe = _Probe(future, key, addr, timeout)
+        self._pending[key].append(probe)
+        heapq.heappush(self._deadlines, (probe.deadline, next(self._seq),
+                                         probe))
+        if self._deadlines[0][2] is probe:
+            self.__arm()
+
+    def __arm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._deadlines:
+            self._timer = self._loop.call_later(
+                self._deadlines[0][0] - monotonic(), self.__expire)
+
+    def __expire(self):
+        self._timer = None
+        now = monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            probe = heapq.heappop(self._deadlines)[2]
+            if probe.future.done():
+                continue  # answered meanwhile
+            self._pending[probe.key].remove(probe)
+            if not self._pending[probe.key]:
+                del self._pending[probe.key]
+            probe.future.set_exception(ProbeError(
+                'No reply from %s within %ss' % (probe.addr, probe.timeout)))
+        self.__arm()
+
+    def __read(self, sock, family):
+        while True:
+            try:
+                data, src = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # ICMP errors, the probe will time out
+            try:
+                key = (family, socket.inet_pton(family, src[0].split('%')[0]),
+                       src[1])
+            except (OSError, ValueError):
+                continue
+            pending = self._pending.get(key)
+            if not pending:
+                continue
+            probe = pending.popleft()
+            if not pending:
+                del self._pending[key]
+            # the deadline stays in the heap, it's skipped once due
+            probe.future.set_result(data)
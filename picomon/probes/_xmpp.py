@@ -0,0 +1,31 @@
+from ._base import ProbeError
+from ._stream import Send, Read
+
+
+STREAM_OPEN = ("<?xml version='1.0'?><stream:stream to='%s' "
+               "xmlns='jabber:client' "
+               "xmlns:stream='http://etherx.jabber.org/streams' "
+               "version='1.0'>")
+
+
+def read_stream_header(buf):
+    """ Parse the opening tag of the server's stream from buf """
+    start = buf.find(b'<stream:stream')
+    if start < 0:
+        if b'</stream:stream>' in buf or b'<stream:error' in buf:
+            raise ProbeError('XMPP stream refused: %s' %
+                             buf.decode('utf-8', errors='replace'))
+        return None
+    end = buf.find(b'>', start)
+    if end < 0:
+        return None
+    return buf[start:end + 1].decode('utf-8', errors='replace'), end + 1
+
+
+def xmpp_dialog(domain):
+    """ Open an XMPP client stream to domain and close it once the server
+    opened its own """
+    yield Send((STREAM_OPEN % domain).encode('utf-8'))
+    header = yield Read('stream', read_stream_header)
+    yield Send(b'</stream:stream>')
+    return header
@@ -0,0 +1,149 @@
+from collections import namedtuple
+from functools import partial
+from threading import Lock
+from time import monotonic
+from concurrent.futures import Future
+from ._base import then, chain, gather
+from ._dns import DNSError
+
+
+ServerSOA = namedtuple('ServerSOA', 'name addr serial error')
+
+# how long empty answers are cached
+NEGATIVE_TTL = 60
+# rcodes telling that a resolver failed (SERVFAIL, REFUSED), rather than
+# answering about the name
+RESOLVER_FAILURES = (2, 5)
+
+
+class ZoneChecker(object):
+    """Checks that all authoritative servers of a zone serve the same SOA
+    serial.
+
+    NS sets and name server addresses are looked up through recursive
+    resolvers (the next one being asked when one fails or times out) and
+    cached according to their TTL, so that zones sharing name servers don't
+    look them up again, and concurrent lookups of the same name are only
+    sent once.  SOA queries to all servers are sent at once."""
+
+    def __init__(self, dns, resolvers):
+        self._dns = dns
+        self._resolvers = resolvers
+        self._lock = Lock()
+        self._cache = {}
+        self._inflight = {}
+
+    def lookup(self, name, qtype, deadline):
+        """ Return a Future of the qtype records data of name """
+        key = (name.lower().rstrip('.') + '.', qtype)
+        now = monotonic()
+        future = Future()
+        with self._lock:
+            if key in self._cache and self._cache[key][0] > now:
+                future.set_result(self._cache[key][1])
+                return future
+            if key in self._inflight:
+                return self._inflight[key]
+            self._inflight[key] = future
+        self.__ask(key, future, 0, deadline)
+        return future
+
+    def __ask(self, key, future, i, deadline):
+        # resolvers left share the time left, so that one timing out leaves
+        # time to the next ones
+        timeout = (deadline - monotonic()) / (len(self._resolvers) - i)
+        # the query may be done before the callback is added, which then runs
+        # right away: this has to be outside of the lock
+        query = self._dns.query(self._resolvers[i], key[0], key[1],
+                                timeout=max(timeout, 0.1))
+        query.add_done_callback(partial(self.__answer, key, future, i,
+                                        deadline))
+
+    def __answer(self, key, future, i, deadline, query):
+        error = None
+        try:
+            reply = query.result()
+        except DNSError as e:
+            error, failed = e, True
+        else:
+            if reply.rcode != 0:
+                error = DNSError('%s lookup of %s failed: %s' %
+                                 (key[1], key[0], reply.rcode_name))
+                failed = reply.rcode in RESOLVER_FAILURES
+        if error is not None:
+            if failed and i + 1 < len(self._resolvers) and \
+                    monotonic() < deadline:
+                # the next resolver may do better
+                self.__ask(key, future, i + 1, deadline)
+                return
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(error)
+            return
+        records = [r for r in reply.answers if r.type == key[1]]
+        ttl = min(r.ttl for r in records) if records else NEGATIVE_TTL
+        values = [r.data for r in records]
+        with self._lock:
+            del self._inflight[key]
+            self._cache[key] = (monotonic() + ttl, values)
+            # drop expired entries now and then, not to grow forever
+            if len(self._cache) % 1024 == 0:
+                now = monotonic()
+                for k in [k for (k, v) in self._cache.items() if v[0] <= now]:
+                    del self._cache[k]
+        future.set_result(values)
+
+    def check(self, zone, ip_version=0, timeout=2):
+        """ Query the SOA of zone on all its name servers (only over IPv4 or
+        IPv6 if ip_version is 4 or 6), returns a Future of the list of
+        ServerSOA, which have either a serial or an error """
+        deadline = monotonic() + timeout
+        qtypes = {4: ['A'], 6: ['AAAA']}.get(ip_version, ['A', 'AAAA'])
+        return chain(self.lookup(zone, 'NS', deadline),
+                     lambda f: self.__resolve_servers(zone, f.result(),
+                                                      qtypes, deadline))
+
+    def __resolve_servers(self, zone, names, qtypes, deadline):
+        if not names:
+            raise DNSError('No NS records for zone %s' % zone)
+        lookups = [(name, [self.lookup(name, qtype, deadline)
+                           for qtype in qtypes]) for name in sorted(names)]
+        return chain(gather(f for (_, fs) in lookups for f in fs),
+                     lambda f: self.__query_servers(zone, lookups, deadline))
+
+    def __query_servers(self, zone, lookups, deadline):
+        servers = []
+        queries = []
+        timeout = max(deadline - monotonic(), 0.1)
+        for name, futures in lookups:
+            addrs = []
+            errors = []
+            for future in futures:
+                try:
+                    addrs += future.result()
+                except DNSError as e:
+                    errors.append(str(e))
+            if not addrs:
+                servers.append(ServerSOA(name, None, None, '; '.join(errors)
+                                         or 'no address found'))
+            for addr in addrs:
+                queries.append((name, addr,
+                                self._dns.query(addr, zone, 'SOA',
+                                                timeout=timeout, rd=False)))
+        return then(gather(q[2] for q in queries),
+                    lambda f: servers + [self.__server_soa(*q)
+                                         for q in queries])
+
+    def __server_soa(self, name, addr, future):
+        try:
+            reply = future.result()
+        except DNSError as e:
+            return ServerSOA(name, addr, None, str(e))
+        if reply.rcode != 0:
+            return ServerSOA(name, addr, None, 'status: ' + reply.rcode_name)
+        if not reply.authoritative:
+            return ServerSOA(name, addr, None, 'not authoritative')
+        soas = [r.data for r in reply.answers if r.type == 'SOA']
+        if not soas:
+            return ServerSOA(name, addr, None, 'no SOA in answer')
+        return ServerSOA(name, addr, soas[0].serial, None)
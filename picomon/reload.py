@@ -0,0 +1,155 @@
+"""
+Configuration reloads.
+
+On SIGHUP the configuration file is evaluated again, against a new config
+tree holding the default settings, while the running one is left untouched.
+Its checks are then compared by ident with the running ones: running checks
+which are still configured are kept, along with their state and schedule,
+only added checks are scheduled and removed ones dropped (their runs in
+flight being left to finish).  Settings then take their new values, those
+only read on startup (scheduler, metrics endpoint, state file, SMTP pool)
+being ignored until a restart.
+
+"""
+
+
+import builtins
+import gc
+import logging
+import os
+import queue
+import types
+from threading import Thread
+from time import monotonic
+from . import cluster
+from . import mails
+from . import report
+from . import scheduler
+from . import state
+from .checks import CheckIP, Checks, loading, resolve_dependencies
+
+
+def evaluate(configfile):
+    """ Evaluate configfile against a new config tree, returns the tree """
+    import picomon
+
+    tree = picomon.default_config()
+    # the configuration imports the config tree from the picomon package:
+    # hand it the new tree without swapping the one of the running threads
+    package = types.ModuleType(picomon.__name__, picomon.__doc__)
+    package.__dict__.update(picomon.__dict__)
+    package.config = tree
+
+    def __import__(name, globals=None, locals=None, fromlist=(), level=0):
+        module = builtins.__import__(name, globals, locals, fromlist, level)
+        return package if module is picomon else module
+
+    with open(configfile, 'rb') as f:
+        code = compile(f.read(), configfile, 'exec')
+    namespace = {'__name__': os.path.splitext(os.path.basename(configfile))[0],
+                 '__file__': configfile,
+                 '__builtins__': dict(builtins.__dict__,
+                                      __import__=__import__)}
+    # checks take their defaults (default_every...) from the new tree too,
+    # while those of other threads still read the running one
+    loading.config = tree
+    try:
+        exec(code, namespace)
+    finally:
+        loading.config = None
+    return tree
+
+
+def merge(running, fresh):
+    """ Return the checks of fresh (whose dependencies are resolved), running
+    checks with the same ident taking the place of theirs, followed by the
+    added and the removed checks """
+    by_ident = {}
+    for check in running:
+        by_ident.setdefault(check.ident, []).append(check)
+    kept = {}
+    merged = Checks()
+    added = []
+    for check in fresh:
+        same = by_ident.get(check.ident)
+        if same:
+            old = same.pop()
+            kept[id(check)] = old
+            if isinstance(check, CheckIP):
+                # for dependencies on the (new) parents of its host
+                old.host = check.host
+            merged.append(old)
+        else:
+            added.append(check)
+            merged.append(check)
+    removed = [check for same in by_ident.values() for check in same]
+    # dependencies (resolved on the new checks) refer to new checks
+    for check, new in zip(merged, fresh):
+        check.depends = tuple(kept.get(id(parent), parent)
+                              for parent in new.depends)
+        check.parents = [kept.get(id(parent), parent)
+                         for parent in new.parents]
+    return merged, added, removed
+
+
+def reload(configfile):
+    """ Reload configfile, returns the numbers of added, removed and kept
+    checks """
+    from . import config
+
+    # collections would be triggered over and over by the creation of tens
+    # of thousands of checks, to find nothing
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        tree = evaluate(configfile)
+        # before touching running checks, as it may fail on cycles
+        resolve_dependencies(tree.checks, tree.dependencies.auto)
+        checks, added, removed = merge(config.checks, tree.checks)
+    finally:
+        if enabled:
+            gc.enable()
+    state.restore(added)
+    # in a cluster, only the added checks this node owns are run
+    scheduler.update(cluster.reset(checks, added), removed)
+    tree.checks = checks
+    config.update(tree)
+    report.index.reset(checks, removed)
+    mails.forget(removed)
+    return len(added), len(removed), len(checks) - len(added)
+
+
+class Reloader(object):
+    """A worker thread reloading the configuration on request, calling then
+    (if given) after each reload"""
+
+    def __init__(self, configfile, then=None):
+        self.configfile = configfile
+        self.then = then
+        # SimpleQueue is reentrant, so that requests can be queued from
+        # signal handlers
+        self._queue = queue.SimpleQueue() if hasattr(queue, 'SimpleQueue') \
+            else queue.Queue()
+        self._thread = Thread(target=self.__loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reload(self):
+        self._queue.put(None)
+
+    def __loop(self):
+        while True:
+            self._queue.get()
+            start = monotonic()
+            try:
+                added, removed, kept = reload(self.configfile)
+            except Exception:
+                logging.exception("Couldn't reload '%s', keeping the "
+                                  "running configuration" % self.configfile)
+                continue
+            logging.info('Reloaded %s in %.3fs: %d check(s) added, %d '
+                         'removed, %d kept' % (self.configfile,
+                                               monotonic() - start, added,
+                                               removed, kept))
+            if self.then is not None:
+                self.then()
@@ -0,0 +1,185 @@
+"""
+Reports on the state of checks.
+
+Checks update a StateIndex on each transition, which keeps failing checks
+ordered by failure date, retrying and unreachable ones, and counts per state,
+so that reports only cost as much as the number of failures.  Reports are
+built by a worker thread: signal handlers only queue a request.
+
+"""
+
+
+import logging
+import queue
+import sys
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+OK = 'ok'
+RETRYING = 'retrying'
+FAILED = 'failed'
+UNREACHABLE = 'unreachable'
+STATES = (OK, RETRYING, FAILED, UNREACHABLE)
+
+
+def state_of(check):
+    if not check.ok:
+        return FAILED
+    if check.unreachable:
+        return UNREACHABLE
+    return RETRYING if check.retry_count else OK
+
+
+class StateIndex(object):
+    """Failing, retrying and unreachable checks, and the number of checks in
+    each state"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counts = dict.fromkeys(STATES, 0)
+        # ordered by failure date, as checks are added when they fail
+        self._checks = dict((state, OrderedDict()) for state in STATES
+                            if state != OK)
+        # checks removed from the configuration, whose runs in flight may
+        # still report
+        self._removed = set()
+        # called with each check changing state, its previous and new ones
+        self._listeners = []
+
+    def reset(self, checks, removed=()):
+        """ Index checks from scratch (after their state was restored, or
+        the configuration reloaded without the removed checks...) """
+        with self._lock:
+            self._removed = set(removed)
+            self.counts = dict.fromkeys(STATES, 0)
+            for indexed in self._checks.values():
+                indexed.clear()
+            failed = []
+            for check in checks:
+                state = state_of(check)
+                self.counts[state] += 1
+                if state == FAILED:
+                    failed.append(check)
+                elif state != OK:
+                    self._checks[state][id(check)] = check
+            failed.sort(key=lambda c: c.failure_date)
+            for check in failed:
+                self._checks[FAILED][id(check)] = check
+
+    def update(self, check, before):
+        """ Note that check went from the before state to its current one """
+        after = state_of(check)
+        if after == before:
+            return
+        with self._lock:
+            if check in self._removed:
+                return
+            self.counts[before] -= 1
+            self.counts[after] += 1
+            if before != OK:
+                self._checks[before].pop(id(check), None)
+            if after != OK:
+                self._checks[after][id(check)] = check
+            # listeners come and go from other threads
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(check, before, after)
+
+    def listen(self, listener):
+        """ Call listener with each check changing state, its previous and
+        new ones, from the thread reporting the change """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unlisten(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def checks(self, state):
+        """ Return checks in state (but OK), failing ones by failure date """
+        with self._lock:
+            return list(self._checks[state].values())
+
+
+index = StateIndex()
+
+
+def create_report(older_than=None, acknowledged=True):
+    """ Return the report of failing checks (only those failing for more
+    than older_than, a timedelta, if given, and not acknowledged ones unless
+    acknowledged) and whether there are any """
+    failed = index.checks(FAILED)
+    if older_than is not None:
+        limit = datetime.now() - older_than
+        failed = [check for check in failed if check.failure_date < limit]
+    if not acknowledged:
+        failed = [check for check in failed if not check.acknowledged]
+    parts = ["\n    Checks in error:\n"]
+    for check in failed:
+        parts.append('-+' * 40 + '\n')
+        parts.append("%s: %s\nSince %s%s%s\n\t%s\n" % (
+                     check.target_name, check, check.failure_date,
+                     ' (acknowledged)' if check.acknowledged else '',
+                     ' (muted)' if check.muted else '',
+                     check.errmsg.strip()))
+    parts.append('-+' * 40 + "\n\n")
+    parts.append("    Checks in retry mode:\n")
+    for check in index.checks(RETRYING):
+        parts.append("Check %s is retrying\n" % check)
+    parts.append("\n    Checks unreachable (because of a failing "
+                 "dependency):\n")
+    for check in index.checks(UNREACHABLE):
+        parts.append("Check %s is unreachable\n" % check)
+    counts = index.counts
+    parts.append("\n%d check(s) OK, %d retrying, %d in error, "
+                 "%d unreachable\n" % (counts[OK], counts[RETRYING],
+                                        counts[FAILED], counts[UNREACHABLE]))
+    return ''.join(parts), bool(failed)
+
+
+class Reporter(object):
+    """A worker thread building reports on request"""
+
+    def __init__(self):
+        # SimpleQueue is reentrant, so that requests can be queued from
+        # signal handlers
+        self._queue = queue.SimpleQueue() if hasattr(queue, 'SimpleQueue') \
+            else queue.Queue()
+        self._thread = Thread(target=self.__loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def dump(self):
+        """ Print the state of checks on stdout """
+        self._queue.put(self.__dump)
+
+    def mail(self, every):
+        """ Mail a report of checks failing for more than every seconds """
+        self._queue.put(lambda: self.__mail(every))
+
+    def __loop(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job()
+            except Exception:
+                logging.exception('Report failed')
+
+    @staticmethod
+    def __dump():
+        report, err = create_report()
+        sys.stdout.write("Signal SIGUSR1 caught, printing state of checks. "
+                         "(%s)\n%s\n" % (datetime.now(), report))
+        sys.stdout.flush()
+
+    @staticmethod
+    def __mail(every):
+        from . import mails
+
+        report, err = create_report(older_than=timedelta(seconds=every),
+                                    acknowledged=False)
+        if err:
+            mails.send_email_report(
+                "Following entries have failed for more than %ss:\n" % every +
+                report)
@@ -0,0 +1,307 @@
+"""
+Deadline ordered scheduling of checks.
+
+Checks sit in a heap keyed on their next due time, so that each wakeup only
+touches checks which actually have to run.  Each check gets a stable phase
+offset within its period (derived from its identity) so that checks sharing
+the same `every` don't all fire at once.
+
+A check is never run twice at once, and checks may be capped per target and
+per class: due checks over a cap wait (in order) for a slot to free up.
+Checks depending on a failing check are skipped until it recovers.
+
+Checks can be added to and removed from running schedulers (on configuration
+reloads) without disturbing the others.
+
+"""
+
+
+import concurrent.futures
+import heapq
+import logging
+import traceback
+import zlib
+from collections import Counter, deque
+from itertools import count
+from threading import Condition
+from time import monotonic
+
+
+class Limits(object):
+    """Caps on the number of checks in flight at once against the same target
+    (its address, or its target name) and per check class (keyed by class
+    name, applying to subclasses too).  0 or None means no cap."""
+
+    def __init__(self, per_target=0, per_class=None):
+        self.per_target = per_target
+        self.per_class = dict(per_class or {})
+        self._targets = Counter()
+        self._classes = Counter()
+
+    @staticmethod
+    def target(check):
+        return getattr(check, 'addr', None) or check.target_name
+
+    def __classes(self, check):
+        return [cls.__name__ for cls in type(check).__mro__
+                if self.per_class.get(cls.__name__)]
+
+    def acquire(self, check):
+        """ Take a slot for check, returns False if a cap is reached """
+        target = self.target(check)
+        classes = self.__classes(check)
+        if self.per_target and self._targets[target] >= self.per_target:
+            return False
+        if any(self._classes[c] >= self.per_class[c] for c in classes):
+            return False
+        self._targets[target] += 1
+        for c in classes:
+            self._classes[c] += 1
+        return True
+
+    def release(self, check):
+        target = self.target(check)
+        self._targets[target] -= 1
+        if not self._targets[target]:
+            del self._targets[target]
+        for c in self.__classes(check):
+            self._classes[c] -= 1
+
+
+class Scheduler(object):
+    """A heap of checks keyed on their next due time.
+
+    A check is popped when due and only pushed back once its run is over,
+    on the next slot of its period after completion.  Slots which went by
+    while the check was still running are counted as overruns.  Due checks
+    over a cap of limits are held back until a running check is done."""
+
+    def __init__(self, tick, now=None, limits=None, dependencies=True):
+        self.tick = tick
+        self.dependencies = dependencies
+        self.epoch = monotonic() if now is None else now
+        self.limits = limits if limits is not None else Limits()
+        self._heap = []
+        self._seq = count()
+        self._cond = Condition()
+        self._held = deque()
+        self._released = False
+        # removed checks still running, not to be rescheduled
+        self._removed = set()
+        # called when checks are added from another thread, for schedulers
+        # not waiting through wait()
+        self.wakeup = None
+
+    @staticmethod
+    def phase(check):
+        """ Stable offset of check within its period, in [0, 1) """
+        return zlib.crc32(check.ident.encode('utf-8')) / 2.0 ** 32
+
+    def period(self, check):
+        return self.tick * (check.every if check.ok else check.error_every)
+
+    def next_slot(self, check, after, strict=True):
+        """ Return the first slot of check after (or at, if not strict) the
+        given time """
+        period = self.period(check)
+        slots = (after - self.epoch) / period - check.phase
+        k = int(slots // 1) + 1 if strict else -int(-slots // 1)
+        return self.epoch + (check.phase + k) * period
+
+    def add(self, check, now):
+        check.phase = self.phase(check)
+        self.push(check, self.next_slot(check, now, strict=False))
+
+    def push(self, check, due):
+        with self._cond:
+            check.next_due = due
+            heapq.heappush(self._heap, (due, next(self._seq), check))
+            if self._heap[0][2] is check:
+                self._cond.notify()
+
+    def update(self, added, removed, now):
+        """ Start scheduling added checks and stop scheduling removed ones,
+        letting those running finish """
+        removed = set(removed)
+        with self._cond:
+            if removed:
+                self._heap = [entry for entry in self._heap
+                              if entry[2] not in removed]
+                heapq.heapify(self._heap)
+                self._held = deque(check for check in self._held
+                                   if check not in removed)
+                self._removed.update(check for check in removed
+                                     if check.running)
+            for check in added:
+                if check in self._removed:
+                    # added back while still running, done() reschedules it
+                    self._removed.discard(check)
+                else:
+                    self.add(check, now)
+            self._cond.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def run_now(self, check, now):
+        """ Have check, if waiting for its next slot, run at now.  Returns
+        whether it is scheduled here """
+        with self._cond:
+            if check.running or check in self._held:
+                return True
+            for i, entry in enumerate(self._heap):
+                if entry[2] is check:
+                    break
+            else:
+                return False
+            self._heap[i] = self._heap[-1]
+            self._heap.pop()
+            heapq.heapify(self._heap)
+            self.push(check, now)
+        if self.wakeup is not None:
+            self.wakeup()
+        return True
+
+    def pop_due(self, now):
+        """ Pop all checks due at now which can start, recording how late
+        they start.  They have to be released through done() or release() """
+        due = []
+        with self._cond:
+            self._released = False
+            while self._heap and self._heap[0][0] <= now:
+                self._held.append(heapq.heappop(self._heap)[2])
+            held = self._held
+            self._held = deque()
+            for check in held:
+                if check.running:
+                    # still running, done() reschedules it anyway
+                    logging.debug('%s still running, skipped' % check)
+                elif self.dependencies and check.blocked() is not None:
+                    # don't waste a run (and its timeout) on it
+                    logging.debug('%s unreachable, skipped' % check)
+                    check.set_unreachable(True)
+                    self.push(check, self.next_slot(check, now))
+                elif self.limits.acquire(check):
+                    check.running = True
+                    check.lateness = now - check.next_due
+                    due.append(check)
+                else:
+                    self._held.append(check)
+        return due
+
+    def release(self, check):
+        """ Mark the run of check as over, letting held checks start """
+        with self._cond:
+            if check.running:
+                check.running = False
+                self.limits.release(check)
+            self._released = True
+            self._cond.notify()
+
+    def done(self, check, now):
+        """ Reschedule check after its run finished at now """
+        with self._cond:
+            self.release(check)
+            if check in self._removed:
+                self._removed.discard(check)
+                return
+            missed = int((now - check.next_due) // self.period(check))
+            if missed > 0:
+                check.overruns += missed
+                logging.debug('%s overran %d slot(s)' % (check, missed))
+            self.push(check, self.next_slot(check, now))
+
+    def next_due(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def wait(self, now):
+        """ Block until the next check is due, a closer one is pushed or a
+        running one is released """
+        with self._cond:
+            if self._released or self._heap and self._heap[0][0] <= now:
+                return
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._cond.wait(timeout)
+
+
+# schedulers running checks forever
+_running = []
+
+
+def register(scheduler):
+    """ Have update() apply to scheduler """
+    _running.append(scheduler)
+
+
+def update(added, removed):
+    """ Start running added checks and stop running removed ones, in all
+    registered schedulers, returns False if there is none yet """
+    for scheduler in list(_running):
+        scheduler.update(added, removed, monotonic())
+    return bool(_running)
+
+
+def run_now(check):
+    """ Have check run now, returns whether a registered scheduler runs it """
+    now = monotonic()
+    return any([scheduler.run_now(check, now) for scheduler in list(_running)])
+
+
+def run_threads(checks, tick, workers, once=False, limits=None):
+    """ Run checks forever (or only once, returning their results), those
+    without an in-process probe running in a pool of workers threads """
+    scheduler = Scheduler(tick, limits=limits, dependencies=not once)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) \
+            as executor:
+        if once:
+            results = {}
+
+            def record(check, future):
+                try:
+                    results[check] = check.finish(future, immediate=True)
+                except Exception:
+                    traceback.print_exc()
+                    results[check] = False
+                finally:
+                    scheduler.release(check)
+
+            for check in checks:
+                scheduler.push(check, scheduler.epoch)
+            while len(results) < len(checks):
+                for check in scheduler.pop_due(monotonic()):
+                    try:
+                        future = check.start(executor)
+                    except Exception:
+                        traceback.print_exc()
+                        results[check] = False
+                        scheduler.release(check)
+                    else:
+                        future.add_done_callback(
+                            lambda f, c=check: record(c, f))
+                scheduler.wait(monotonic())
+            return [results[check] for check in checks]
+
+        for check in checks:
+            scheduler.add(check, scheduler.epoch)
+        register(scheduler)
+
+        # Since we never reclaim finished tasks, exceptions raised during
+        # run are never seen. Using a callback we can at least display them.
+        def finish(check, future):
+            try:
+                check.finish(future)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                scheduler.done(check, monotonic())
+
+        while True:
+            for check in scheduler.pop_due(monotonic()):
+                try:
+                    future = check.start(executor)
+                except Exception:
+                    traceback.print_exc()
+                    scheduler.done(check, monotonic())
+                else:
+                    future.add_done_callback(lambda f, c=check: finish(c, f))
+            scheduler.wait(monotonic())
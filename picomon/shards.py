@@ -0,0 +1,355 @@
+"""
+Sharded execution of checks over several processes.
+
+With `shards.processes` set, checks are split between that many worker
+processes by a stable hash of their target (address or target name), so that
+checks against the same target (and so their caps, shared results and
+dependencies on the ping of their host) land in the same process.  Workers
+load the configuration on their own and run their checks, while the main
+process, the coordinator, keeps a copy of all of them and owns emails,
+reports, state saving and metrics.
+
+Workers stream compact records of the state changes of their checks back to
+the coordinator over pipes, which applies them to its copies and notifies as
+a single process would.  Records of checks other shards depend on are sent
+after every run and relayed to these shards.  Run statistics are sent every
+`shards.sync_every` seconds, for metrics.
+
+"""
+
+
+import logging
+import multiprocessing
+import os
+import signal
+import zlib
+from datetime import datetime
+from multiprocessing.connection import wait
+from threading import Lock, Thread
+from time import monotonic, sleep
+from . import history
+from . import mails
+from . import report
+from . import state
+from .scheduler import Limits
+
+
+def shard_of(check, shards):
+    """ Return the shard of check, in [0, shards) """
+    return zlib.crc32(Limits.target(check).encode('utf-8')) % shards
+
+
+def plan(checks, owner_of):
+    """ Return the owner (shard, node...) of each of checks, and the owners
+    each check has to be relayed to (by index), those of the checks
+    depending on it """
+    owners = [owner_of(check) for check in checks]
+    indexes = dict((id(check), i) for (i, check) in enumerate(checks))
+    relays = {}
+    for i, check in enumerate(checks):
+        for parent in check.parents:
+            j = indexes.get(id(parent))
+            if j is not None and owners[j] != owners[i]:
+                relays.setdefault(j, set()).add(owners[i])
+    return owners, relays
+
+
+def digest(checks):
+    """ Checksum of the identities of checks, for processes to agree on their
+    configuration """
+    crc = 0
+    for check in checks:
+        crc = zlib.crc32(check.ident.encode('utf-8'), crc)
+    return crc, len(checks)
+
+
+def state_record(i, check, now=None):
+    """ Return a record of the state of check, the i-th one.  With now (the
+    monotonic time), times are given as ages, for processes not sharing a
+    clock """
+    failure_date = getattr(check, 'failure_date', None)
+    checked_at, failing_since = check.checked_at, check.failing_since
+    if now is not None:
+        checked_at = now - checked_at if checked_at is not None else None
+        failing_since = now - failing_since \
+            if failing_since is not None else None
+    return (i, check.ok, check.retry_count, check.unreachable, checked_at,
+            failing_since,
+            failure_date.timestamp() if failure_date is not None else None,
+            check.errmsg, check.recovered_after)
+
+
+def apply_state(check, record, now=None):
+    """ Set the state of check from record, made by state_record() """
+    (_, check.ok, check.retry_count, check.unreachable, checked_at,
+     failing_since, failure_date, check.errmsg,
+     check.recovered_after) = record
+    if now is not None:
+        checked_at = now - checked_at if checked_at is not None else None
+        failing_since = now - failing_since \
+            if failing_since is not None else None
+    check.checked_at, check.failing_since = checked_at, failing_since
+    if failure_date is not None:
+        check.failure_date = datetime.fromtimestamp(failure_date)
+
+
+def _stats(i, check):
+    stats = check.stats
+    return (i, list(stats.duration.counts), stats.duration.sum,
+            list(stats.lateness.counts), stats.lateness.sum,
+            stats.successes, stats.failures, check.overruns, check.running,
+            check.next_due, stats.latency.mean, stats.latency.deviation,
+            stats.latency.samples)
+
+
+def _apply_stats(check, record):
+    stats = check.stats
+    (_, stats.duration.counts, stats.duration.sum, stats.lateness.counts,
+     stats.lateness.sum, stats.successes, stats.failures, check.overruns,
+     check.running, check.next_due, stats.latency.mean,
+     stats.latency.deviation, stats.latency.samples) = record
+
+
+class Worker(object):
+    """The end of a worker process talking to the coordinator"""
+
+    def __init__(self, conn, checks, shard, shards, sync_every):
+        owners, relays = plan(checks, lambda c: shard_of(c, shards))
+        self.checks = checks
+        self.local = [check for (check, owner) in zip(checks, owners)
+                      if owner == shard]
+        self.sync_every = sync_every
+        self._conn = conn
+        self._lock = Lock()
+        self._indexes = dict((id(check), i) for (i, check)
+                             in enumerate(checks) if owners[i] == shard)
+        self._relayed = set(i for i in relays if owners[i] == shard)
+        self._sent = {}
+        self._runs = {}
+
+    def start(self):
+        """ Wait for the coordinator to send the state of checks, then start
+        exchanging records with it """
+        self.__send(('hello', digest(self.checks)))
+        kind, records = self._conn.recv()
+        for record in records:
+            apply_state(self.checks[record[0]], record)
+        for target in (self.__receive, self.__sync):
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def __send(self, message):
+        with self._lock:
+            self._conn.send(message)
+
+    def forward(self, check):
+        i = self._indexes[id(check)]
+        key = (check.ok, check.retry_count, check.unreachable)
+        # checks of other shards depending on this one need to know when it
+        # last reported
+        if i in self._relayed or self._sent.get(i) != key:
+            self._sent[i] = key
+            self.__send(('records', [state_record(i, check)]))
+
+    def __receive(self):
+        # records of the checks local ones depend on
+        try:
+            while True:
+                kind, records = self._conn.recv()
+                for record in records:
+                    apply_state(self.checks[record[0]], record)
+        except (EOFError, OSError):
+            logging.info('Coordinator gone, exiting')
+            os._exit(0)
+
+    def __sync(self):
+        while True:
+            sleep(self.sync_every)
+            stats = []
+            for check in self.local:
+                i = self._indexes[id(check)]
+                runs = (check.stats.successes + check.stats.failures,
+                        check.running)
+                if self._runs.get(i) != runs:
+                    self._runs[i] = runs
+                    stats.append(_stats(i, check))
+            if stats:
+                self.__send(('stats', stats))
+
+
+_worker = None
+
+
+def forward(check):
+    """ In a worker process, send the state of check to the coordinator and
+    return True, otherwise return False """
+    if _worker is None:
+        return False
+    _worker.forward(check)
+    return True
+
+
+def _worker_main(configfile, shard, shards, sync_every, level, conn):
+    from . import config
+    from .__main__ import import_config
+    from .checks import resolve_dependencies
+    from .scheduler import run_threads
+    global _worker
+
+    # signals are for the coordinator, a worker exits with it
+    for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1,
+                   signal.SIGALRM):
+        signal.signal(signum, signal.SIG_IGN)
+    logging.basicConfig(format='%%(asctime)s shard %d %%(levelname)s: '
+                               '%%(message)s' % shard, level=level)
+    import_config(configfile)
+    resolve_dependencies(config.checks, config.dependencies.auto)
+    if config.history.path:
+        # a ring per worker, read along with the others by queries
+        history.open_ring('%s.%d' % (config.history.path, shard),
+                          config.history.records)
+    _worker = Worker(conn, config.checks, shard, shards, sync_every)
+    _worker.start()
+    logging.info('Running %d check(s) of %d' % (len(_worker.local),
+                                                len(config.checks)))
+
+    limits = Limits(config.scheduler.max_per_target,
+                    config.scheduler.max_per_class)
+    if config.scheduler.mode == 'asyncio':
+        from . import aio
+        aio.run(_worker.local, config.base_tick, config.scheduler.concurrency,
+                config.scheduler.workers, limits=limits)
+    else:
+        run_threads(_worker.local, config.base_tick, config.scheduler.workers,
+                    limits=limits)
+
+
+class Coordinator(object):
+    """Runs checks in worker processes, applying the state changes they
+    report to its own copy of the checks"""
+
+    # seconds before restarting a worker which exited
+    restart_delay = 1
+
+    def __init__(self, configfile, processes, sync_every, level):
+        self.configfile = configfile
+        self.processes = processes
+        self.sync_every = sync_every
+        self.level = level
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = {}
+        self._conns = {}
+        self._pending = {}
+        self._reload = False
+        self._wakeup_r, self._wakeup_w = self._context.Pipe(duplex=False)
+
+    def __plan(self):
+        from . import config
+
+        self.checks = list(config.checks)
+        self._owners, self._relays = plan(
+            self.checks, lambda c: shard_of(c, self.processes))
+        self._digest = digest(self.checks)
+
+    def __start(self, shard):
+        conn, child = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, name='picomon shard %d' % shard,
+            args=(self.configfile, shard, self.processes, self.sync_every,
+                  self.level, child))
+        process.daemon = True
+        process.start()
+        child.close()
+        self._processes[shard] = process
+        self._conns[conn] = shard
+
+    def __stop(self, conn):
+        shard = self._conns.pop(conn)
+        process = self._processes.pop(shard)
+        process.terminate()
+        process.join()
+        conn.close()
+        return shard, process.exitcode
+
+    def restart(self):
+        """ Restart all workers, with the configuration just reloaded """
+        self._reload = True
+        self._wakeup_w.send(None)
+
+    def __handle(self, conn, kind, payload):
+        shard = self._conns[conn]
+        if kind == 'hello':
+            if payload != self._digest:
+                logging.error('Shard %d loaded another configuration than '
+                              'this process, send SIGHUP to reload it' %
+                              shard)
+                self.__stop(conn)
+                self._pending[shard] = monotonic() + self.restart_delay
+                return
+            # the state of its checks, and of those they depend on
+            conn.send(('start', [
+                state_record(i, check) for (i, check) in enumerate(self.checks)
+                if self._owners[i] == shard or
+                shard in self._relays.get(i, ())]))
+        elif kind == 'records':
+            relays = {}
+            for record in payload:
+                self.__apply(record)
+                for other in self._relays.get(record[0], ()):
+                    relays.setdefault(other, []).append(record)
+            for other_conn, other in list(self._conns.items()):
+                if other in relays:
+                    other_conn.send(('records', relays[other]))
+        elif kind == 'stats':
+            for record in payload:
+                _apply_stats(self.checks[record[0]], record)
+
+    def __apply(self, record):
+        check = self.checks[record[0]]
+        before = (check.ok, check.retry_count)
+        before_state = report.state_of(check)
+        apply_state(check, record)
+        if check.ok != before[0]:
+            mails.notify(check)
+        if (check.ok, check.retry_count) != before:
+            state.mark(check)
+        report.index.update(check, before_state)
+
+    def run(self):
+        """ Start the workers and apply their records, forever """
+        self.__plan()
+        for shard in range(self.processes):
+            self.__start(shard)
+        while True:
+            timeout = None
+            if self._pending:
+                timeout = max(0, min(self._pending.values()) - monotonic())
+            for conn in wait(list(self._conns) + [self._wakeup_r], timeout):
+                if conn is self._wakeup_r:
+                    conn.recv()
+                    continue
+                if conn not in self._conns:
+                    continue
+                try:
+                    kind, payload = conn.recv()
+                except (EOFError, OSError):
+                    shard, code = self.__stop(conn)
+                    logging.error('Shard %d exited (%s), restarting it' %
+                                  (shard, code))
+                    self._pending[shard] = monotonic() + self.restart_delay
+                    continue
+                self.__handle(conn, kind, payload)
+            if self._reload:
+                self._reload = False
+                for conn in list(self._conns):
+                    self.__stop(conn)
+                self._pending.clear()
+                self.__plan()
+                for shard in range(self.processes):
+                    self.__start(shard)
+            now = monotonic()
+            for shard, when in list(self._pending.items()):
+                if when <= now:
+                    del self._pending[shard]
+                    self.__start(shard)
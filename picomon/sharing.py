@@ -0,0 +1,102 @@
+"""
+Sharing of probe results between identical checks.
+
+Checks doing the same work (same class, address and probe options, whatever
+their target name, period or retries) share their runs: while one of them
+runs, or for `sharing.ttl` seconds after it finished, the others get its
+result instead of running their own probe.
+
+"""
+
+
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+
+
+class _Run(object):
+    __slots__ = ('owner', 'future', 'values', 'done_at')
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.future = Future()
+        self.values = None
+        self.done_at = None
+
+
+class SharedResults(object):
+    """Runs of checks by probe key, with their results for ttl seconds"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._runs = {}
+        self._pruned_at = monotonic()
+        self.hits = 0
+
+    def subscribe(self, check):
+        """ Return a Future of the result of a run of an identical check,
+        in flight or recent enough, or None if check has to run itself """
+        key = check.probe_key
+        with self._lock:
+            run = self._runs.get(key)
+            if run is None or run.owner is check or \
+                    (run.done_at is not None and
+                     monotonic() - run.done_at > self.ttl):
+                return None
+            self.hits += 1
+        future = Future()
+
+        def share(f):
+            # copy what the run of the owner left on it (error message...)
+            if run.values is not None:
+                for attr, value in run.values.items():
+                    setattr(check, attr, value)
+            try:
+                future.set_result(f.result())
+            except Exception as e:
+                future.set_exception(e)
+
+        run.future.add_done_callback(share)
+        return future
+
+    def publish(self, check, future):
+        """ Share future, the result of a run of check, with identical
+        checks, returns it """
+        run = _Run(check)
+        now = monotonic()
+        with self._lock:
+            self._runs[check.probe_key] = run
+            # drop expired runs once per ttl, not to keep those of checks
+            # which don't run anymore (removed, or depending on a failing one)
+            if now - self._pruned_at > self.ttl:
+                self._pruned_at = now
+                for key in [key for (key, r) in self._runs.items()
+                            if r.done_at is not None and
+                            now - r.done_at > self.ttl]:
+                    del self._runs[key]
+
+        def done(f):
+            run.values = dict((attr, getattr(check, attr))
+                              for attr in check.result_attrs)
+            run.done_at = monotonic()
+            try:
+                run.future.set_result(f.result())
+            except Exception as e:
+                run.future.set_exception(e)
+
+        future.add_done_callback(done)
+        return future
+
+
+_shared = None
+
+
+def shared():
+    """ Return the SharedResults of all checks """
+    from . import config
+    global _shared
+
+    if _shared is None:
+        _shared = SharedResults(config.sharing.ttl)
+    return _shared
@@ -0,0 +1,211 @@
+"""
+Persistent check state.
+
+The alerting state of checks (ok, retries, failure date, error message and
+Message-ID of the alert mail) is saved to disk so that a restart neither
+forgets ongoing outages nor sends their alerts again, along with the
+estimate of the duration of their runs adaptive timeouts are derived from,
+and whether they were muted or their failure acknowledged.  Checks are keyed by
+their ident, which is stable across restarts.
+
+Changes are only noted in memory by the checks, and written by a background
+thread every `state.flush_every` seconds to an append-only journal, one JSON
+record per line.  Once the journal grows past the number of known checks it
+is compacted into a snapshot holding the last record of each check, written
+atomically next to it.
+
+"""
+
+
+import json
+import logging
+import os
+from datetime import datetime
+from threading import Event, Lock, Thread
+import atexit
+
+
+def _dump(check):
+    failure_date = getattr(check, 'failure_date', None)
+    return {'id': check.ident,
+            'ok': check.ok,
+            'retry_count': check.retry_count,
+            'failure_date': failure_date.timestamp()
+                            if failure_date is not None else None,
+            'errmsg': check.errmsg,
+            'mails_msgid': getattr(check, 'mails_msgid', None),
+            'latency': [check.stats.latency.mean,
+                        check.stats.latency.deviation,
+                        check.stats.latency.samples],
+            'muted': check.muted,
+            'ack_date': check.ack_date.timestamp()
+                        if check.ack_date is not None else None}
+
+
+def _restore(check, record):
+    check.ok = record['ok']
+    check.retry_count = record['retry_count']
+    check.errmsg = record['errmsg']
+    if record['failure_date'] is not None:
+        check.failure_date = datetime.fromtimestamp(record['failure_date'])
+    if record['mails_msgid'] is not None:
+        check.mails_msgid = record['mails_msgid']
+    # missing from records saved by older versions
+    if record.get('latency') is not None:
+        latency = check.stats.latency
+        latency.mean, latency.deviation, latency.samples = record['latency']
+    check.muted = record.get('muted', False)
+    if record.get('ack_date') is not None:
+        check.ack_date = datetime.fromtimestamp(record['ack_date'])
+
+
+def _read(path):
+    """ Yield the records of a snapshot or journal file, skipping a partly
+    written last line """
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.warning('Skipping corrupted state record in %s'
+                                    % path)
+    except FileNotFoundError:
+        return
+
+
+class StateStore(object):
+    """The state of checks in a snapshot file and its journal"""
+
+    def __init__(self, path, flush_every):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.flush_every = flush_every
+        self._lock = Lock()
+        self._dirty = {}
+        self._records = {}
+        self._journal = None
+        self._journal_size = 0
+        self._quit = Event()
+        self._thread = None
+
+    def load(self, checks):
+        """ Restore the saved state of checks, returns how many were """
+        for record in _read(self.path):
+            self._records[record['id']] = record
+        for record in _read(self.journal_path):
+            self._records[record['id']] = record
+        restored = 0
+        idents = set()
+        for check in checks:
+            ident = check.ident
+            idents.add(ident)
+            record = self._records.get(ident)
+            if record is not None:
+                _restore(check, record)
+                restored += 1
+        # forget checks which were removed from the configuration
+        for ident in list(self._records):
+            if ident not in idents:
+                del self._records[ident]
+        self.compact()
+        return restored
+
+    def restore(self, checks):
+        """ Restore the last saved state of checks added after load() """
+        for check in checks:
+            record = self._records.get(check.ident)
+            if record is not None:
+                _restore(check, record)
+
+    def mark(self, check):
+        """ Note that check changed, to be saved on next flush """
+        with self._lock:
+            self._dirty[check.ident] = check
+
+    def flush(self):
+        """ Append changed checks to the journal, compacting it if needed """
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+        if not dirty:
+            return
+        lines = []
+        for ident, check in dirty.items():
+            record = _dump(check)
+            self._records[ident] = record
+            lines.append(json.dumps(record) + '\n')
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal.write(''.join(lines))
+        self._journal.flush()
+        self._journal_size += len(lines)
+        if self._journal_size > max(len(self._records), 1000):
+            self.compact()
+
+    def compact(self):
+        """ Write all records to a new snapshot and empty the journal """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record) + '\n'
+                            for record in self._records.values()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, 'w', encoding='utf-8')
+        self._journal_size = 0
+
+    def start(self):
+        """ Flush periodically from a background thread, and on exit """
+        self._thread = Thread(target=self.__loop)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.quit)
+
+    def __loop(self):
+        while not self._quit.wait(self.flush_every):
+            try:
+                self.flush()
+            except OSError as e:
+                logging.warning("Couldn't save state of checks: %s" % e)
+
+    def quit(self):
+        if not self._quit.is_set():
+            self._quit.set()
+            self._thread.join()
+            self.flush()
+
+
+_store = None
+
+
+def open_store(path, flush_every, checks):
+    """ Restore the state of checks from path and keep saving it there """
+    global _store
+    store = StateStore(path, flush_every)
+    restored = store.load(checks)
+    logging.info('Restored the state of %d check(s) from %s' %
+                 (restored, path))
+    store.start()
+    _store = store
+    return store
+
+
+def restore(checks):
+    """ Restore the saved state of checks added to the configuration, if
+    state is saved at all """
+    if _store is not None:
+        _store.restore(checks)
+
+
+def mark(check):
+    """ Note a state change of check, if state is saved at all """
+    if _store is not None:
+        _store.mark(check)
+
+
+def quit():
+    if _store is not None:
+        _store.quit()
@@ -8,7 +8,8 @@ setup(name='Picomon',
       author='Jonathan Michalon',
       license='GNU GPLv3',
       url='http://gitlab.netlib.re/arn/picomon/',
-      packages=['picomon', 'picomon.subprocess_compat'],
-      scripts=['bin/picomon', 'bin/picomon-watchdog'],
+      packages=['picomon', 'picomon.probes', 'picomon.subprocess_compat'],
+      scripts=['bin/picomon', 'bin/picomon-watchdog',
+               'bin/picomon-history'],
       data_files=[('etc/picomon/', ['config-sample.py'])],
      )
@@ -0,0 +1,79 @@
+import gc
+import unittest
+
+from picomon import checks
+from picomon.checks import Check
+from picomon.metrics import Latency
+
+
+class OptionsTest(unittest.TestCase):
+    def test_shared_between_identical_checks(self):
+        check = Check(target_name='a', retry=3)
+        other = Check(target_name='a', retry=3)
+        self.assertIs(check._options, other._options)
+        self.assertIsNot(check._options, Check(target_name='a')._options)
+        # not hashable, not shared
+        check = Check(target_name='a', status=[200])
+        other = Check(target_name='a', status=[200])
+        self.assertEqual(check._options, other._options)
+        self.assertIsNot(check._options, other._options)
+
+    def test_forgotten_with_checks(self):
+        before = len(checks._option_sets)
+        created = [Check(target_name='gone %d' % i) for i in range(100)]
+        self.assertEqual(len(checks._option_sets), before + 100)
+        del created
+        gc.collect()
+        self.assertEqual(len(checks._option_sets), before)
+
+
+class TimeoutTest(unittest.TestCase):
+    def check(self, mean, deviation=0.0, samples=10, **options):
+        options.setdefault('adaptive_timeout', True)
+        check = Check(target_name='timed', timeout=3, **options)
+        latency = check.stats.latency
+        latency.mean, latency.deviation, latency.samples = \
+            mean, deviation, samples
+        return check
+
+    def test_option_without_adaptive_timeouts(self):
+        check = self.check(1, adaptive_timeout=False)
+        self.assertEqual(check.timeout, 3)
+        # before enough successful runs
+        self.assertEqual(self.check(1, samples=4).timeout, 3)
+
+    def test_bound_on_duration(self):
+        # 4 mean deviations over the mean
+        self.assertEqual(self.check(1, 0.25).timeout, 2)
+        self.assertEqual(self.check(1, 0.25).command_timeout, 2)
+        self.assertEqual(self.check(1, 0.3).command_timeout, 3)
+
+    def test_bounds(self):
+        self.assertEqual(self.check(0.01).timeout, 0.5)
+        self.assertEqual(self.check(60).timeout, 10)
+        self.assertEqual(self.check(0.01, min_timeout=0.1).timeout, 0.1)
+        self.assertEqual(self.check(60, max_timeout=30).timeout, 30)
+
+    def test_doubled_while_retrying(self):
+        check = self.check(1, 0.25)
+        check.retry_count = 2
+        self.assertEqual(check.timeout, 8)
+        check.retry_count = 20
+        self.assertEqual(check.timeout, 10)
+        # not once failing
+        check.ok = False
+        self.assertEqual(check.timeout, 2)
+
+    def test_latency_estimate(self):
+        latency = Latency()
+        latency.observe(2)
+        self.assertEqual((latency.mean, latency.deviation), (2, 1))
+        for _ in range(100):
+            latency.observe(1)
+        self.assertAlmostEqual(latency.mean, 1, places=4)
+        self.assertAlmostEqual(latency.deviation, 0, places=4)
+        self.assertEqual(latency.samples, 101)
+
+
+if __name__ == '__main__':
+    unittest.main()
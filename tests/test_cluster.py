@@ -0,0 +1,140 @@
+import hashlib
+import hmac
+import json
+import socket
+import time
+import unittest
+
+from picomon import cluster
+from picomon.checks import Check4, Host
+from picomon.scheduler import Limits
+
+
+def _free_addresses(n):
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+             for _ in range(n)]
+    for sock in socks:
+        sock.bind(('127.0.0.1', 0))
+    addresses = ['127.0.0.1:%d' % sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return addresses
+
+
+def _checks(n, first=1):
+    return [Check4(Host(ipv4='10.0.%d.%d' % (i // 250, i % 250 + 1)))
+            for i in range(first, first + n)]
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class RingTest(unittest.TestCase):
+    nodes = ['10.1.0.1:7400', '10.1.0.2:7400', '10.1.0.3:7400']
+
+    def test_spreads_keys(self):
+        ring = cluster.Ring(self.nodes)
+        owners = [ring.owner('192.0.2.%d' % i) for i in range(255)]
+        for node in self.nodes:
+            self.assertGreater(owners.count(node), 255 // 6)
+
+    def test_leaving_node_only_moves_its_keys(self):
+        keys = ['192.0.2.%d' % i for i in range(255)]
+        before = cluster.Ring(self.nodes)
+        after = cluster.Ring(self.nodes[:2])
+        for key in keys:
+            if before.owner(key) != self.nodes[2]:
+                self.assertEqual(before.owner(key), after.owner(key))
+            else:
+                self.assertIn(after.owner(key), self.nodes[:2])
+
+    def test_order_of_nodes_doesnt_matter(self):
+        ring = cluster.Ring(self.nodes)
+        other = cluster.Ring(list(reversed(self.nodes)))
+        for i in range(255):
+            key = '192.0.2.%d' % i
+            self.assertEqual(ring.owner(key), other.owner(key))
+
+    def test_parse_address(self):
+        self.assertEqual(cluster.parse_address('[::1]:7400'), ('::1', 7400))
+        self.assertEqual(cluster.parse_address('10.1.0.1:7400'),
+                         ('10.1.0.1', 7400))
+
+
+class NodeTest(unittest.TestCase):
+    def setUp(self):
+        self.addresses = _free_addresses(2)
+
+    def node(self, address, start=False):
+        # each node with checks of its own, built from the same configuration
+        node = cluster.Node(address, self.addresses, _checks(20),
+                            heartbeat=0.05, timeout=60, sync_every=0,
+                            secret='s3cret')
+        if start:
+            # left listening, by a daemon thread
+            node.start()
+        else:
+            self.addCleanup(node._sock.close)
+        return node
+
+    def test_drops_invalid_messages(self):
+        node = self.node(self.addresses[0], start=True)
+        peer = self.node(self.addresses[1])
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        target = cluster.parse_address(self.addresses[0])
+        unsigned = json.dumps({'from': self.addresses[1]}).encode('utf-8')
+        heartbeat = json.dumps({'from': self.addresses[1],
+                                'digest': peer._digest, 'kind': 'heartbeat',
+                                'records': []}).encode('utf-8')
+        forged = hmac.new(b'wrong', heartbeat, hashlib.sha256).digest() + \
+            heartbeat
+        for data in (b'garbage', unsigned, heartbeat, forged,
+                     peer._Node__sign(b'[1, 2]'),
+                     peer._Node__sign(b'{"from": ["x"]}'),
+                     peer._Node__sign(unsigned)):
+            sock.sendto(data, target)
+        self.assertFalse(_wait_for(lambda: self.addresses[1] in node.alive(),
+                                   timeout=0.5))
+        # still listening
+        peer._Node__send('heartbeat')
+        self.assertTrue(_wait_for(lambda: self.addresses[1] in node.alive()))
+
+    def test_applies_signed_records(self):
+        node = self.node(self.addresses[0], start=True)
+        peer = self.node(self.addresses[1])
+        check = peer.checks[3]
+        check.ok = False
+        check.errmsg = 'down'
+        peer._Node__send_records([cluster.shards.state_record(
+            3, check, time.monotonic())])
+        self.assertTrue(_wait_for(lambda: not node.checks[3].ok))
+        self.assertEqual(node.checks[3].errmsg, 'down')
+
+    def test_reset_assigns_added_checks(self):
+        node = self.node(self.addresses[0])
+        node._alive = sorted(self.addresses)
+        added = _checks(30, first=100)
+        owned = node.reset(node.checks + added, added)
+        ring = cluster.Ring(sorted(self.addresses))
+        expected = [check for check in added
+                    if ring.owner(Limits.target(check)) == node.address]
+        self.assertEqual(owned, expected)
+        self.assertTrue(0 < len(owned) < len(added))
+        for check in added:
+            self.assertEqual(node.owns(check), check in expected)
+
+    def test_nothing_owned_before_first_rebalance(self):
+        node = self.node(self.addresses[0])
+        checks = node.checks
+        added = _checks(5, first=100)
+        self.assertEqual(node.reset(checks + added, added), [])
+        self.assertFalse(any(node.owns(check) for check in checks + added))
+
+
+if __name__ == '__main__':
+    unittest.main()
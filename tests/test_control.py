@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+from picomon import control
+from picomon import report
+from picomon.checks import Check
+
+
+class ServeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'picomon.sock')
+
+    def serve(self, mode=0o600):
+        server = control.serve(self.path, mode)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def request(self, request):
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(self.path)
+        with sock, sock.makefile('rwb') as f:
+            f.write(json.dumps(request).encode('utf-8') + b'\n')
+            f.flush()
+            return json.loads(f.readline().decode('utf-8'))
+
+    def test_socket_has_mode(self):
+        self.serve(0o640)
+        mode = os.stat(self.path).st_mode
+        self.assertTrue(stat.S_ISSOCK(mode))
+        self.assertEqual(stat.S_IMODE(mode), 0o640)
+        # the private directory it was bound in is gone
+        self.assertEqual(os.listdir(self.directory), ['picomon.sock'])
+
+    def test_answers_requests(self):
+        self.serve()
+        answer = self.request({'op': 'counts'})
+        self.assertTrue(answer['ok'])
+        self.assertEqual(set(answer['counts']), set(report.STATES))
+        self.assertEqual(self.request({'op': 'nope'})['ok'], False)
+
+    def test_doesnt_replace_a_listening_socket(self):
+        self.serve()
+        with self.assertRaises(OSError):
+            control.serve(self.path)
+        self.assertTrue(self.request({'op': 'counts'})['ok'])
+        self.assertEqual(os.listdir(self.directory), ['picomon.sock'])
+
+    def test_replaces_a_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(self.path)
+        stale.close()
+        self.serve()
+        self.assertTrue(self.request({'op': 'counts'})['ok'])
+
+
+class ListenersTest(unittest.TestCase):
+    def test_listeners_come_and_go_during_updates(self):
+        index = report.StateIndex()
+        check = Check(target_name='x')
+        index.reset([check])
+        errors = []
+        stop = threading.Event()
+
+        def churn():
+            while not stop.is_set():
+                listener = lambda check, before, after: None
+                index.listen(listener)
+                index.unlisten(listener)
+
+        threads = [threading.Thread(target=churn) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        seen = []
+        index.listen(lambda check, before, after: seen.append(after))
+        try:
+            for _ in range(2000):
+                check.ok = not check.ok
+                index.update(check, report.OK if not check.ok
+                             else report.FAILED)
+        except RuntimeError as e:
+            errors.append(e)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(seen), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
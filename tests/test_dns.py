@@ -0,0 +1,211 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from picomon import probes
+from picomon.probes import DNSClient, DNSError, Message
+from picomon.probes._dns import FLAG_TC, build_query
+from picomon.probes._zone import ZoneChecker
+
+
+def _reply(query, rcode=0, answers=(), truncated=False):
+    """ Return a reply to query with A records for answers """
+    ident, flags = struct.unpack('!HH', query[:4])
+    flags |= 0x8000 | rcode | (FLAG_TC if truncated else 0)
+    data = struct.pack('!HHHHHH', ident, flags, 1, len(answers), 0, 0)
+    data += query[12:]
+    for address in answers:
+        # name compressed as a pointer to the question
+        data += struct.pack('!HHHIH', 0xc00c, 1, 1, 300, 4) + \
+            socket.inet_aton(address)
+    return data
+
+
+class _Server(object):
+    """A name server answering on UDP and TCP on the same loopback port"""
+
+    def __init__(self):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(('127.0.0.1', self.port))
+        self.tcp.listen(5)
+        # query -> list of UDP datagrams to send back
+        self.answer = lambda query: [_reply(query, answers=['192.0.2.1'])]
+        self.tcp_answer = lambda query: _reply(query,
+                                               answers=['192.0.2.1',
+                                                        '192.0.2.2'])
+        for target in (self.__udp, self.__tcp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def __udp(self):
+        while True:
+            try:
+                query, src = self.udp.recvfrom(512)
+            except OSError:
+                return
+            for data in self.answer(query):
+                self.udp.sendto(data, src)
+
+    def __tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            with conn:
+                data = b''
+                while len(data) < 2 or \
+                        len(data) < 2 + struct.unpack('!H', data[:2])[0]:
+                    data += conn.recv(4096)
+                reply = self.tcp_answer(data[2:])
+                conn.sendall(struct.pack('!H', len(reply)) + reply)
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+
+class DNSClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server()
+        self.addCleanup(self.server.close)
+        self.client = DNSClient(probes.get_loop())
+
+    def query(self, qtype='A', timeout=2):
+        return self.client.query('127.0.0.1', 'www.example.org', qtype,
+                                 timeout=timeout,
+                                 port=self.server.port).result()
+
+    def test_answer(self):
+        reply = self.query()
+        self.assertEqual(reply.rcode_name, 'NOERROR')
+        self.assertEqual([(r.name, r.type, r.ttl, r.data)
+                          for r in reply.answers],
+                         [('www.example.org.', 'A', 300, '192.0.2.1')])
+
+    def test_rcode(self):
+        self.server.answer = lambda query: [_reply(query, rcode=3)]
+        reply = self.query()
+        self.assertEqual(reply.rcode_name, 'NXDOMAIN')
+        self.assertEqual(reply.answers, [])
+
+    def test_truncated_reply_is_retried_over_tcp(self):
+        self.server.answer = lambda query: [_reply(query, truncated=True)]
+        reply = self.query()
+        self.assertEqual([r.data for r in reply.answers],
+                         ['192.0.2.1', '192.0.2.2'])
+
+    def test_ignores_unrelated_replies(self):
+        def answer(query):
+            other = build_query(struct.unpack('!H', query[:2])[0],
+                                'other.example.org', 'A')
+            wrong_id = struct.pack('!H', (struct.unpack('!H', query[:2])[0] +
+                                          1) & 0xffff) + query[2:]
+            return [b'short', _reply(other, answers=['192.0.2.66']),
+                    _reply(wrong_id, answers=['192.0.2.66']),
+                    _reply(query, answers=['192.0.2.1'])]
+        self.server.answer = answer
+        self.assertEqual([r.data for r in self.query().answers],
+                         ['192.0.2.1'])
+
+    def test_timeout(self):
+        self.server.answer = lambda query: []
+        with self.assertRaisesRegex(DNSError, 'No DNS reply'):
+            self.query(timeout=0.2)
+
+    def test_concurrent_queries(self):
+        futures = [self.client.query('127.0.0.1', 'www.example.org',
+                                     port=self.server.port)
+                   for _ in range(50)]
+        for future in futures:
+            self.assertEqual(future.result().answers[0].data, '192.0.2.1')
+
+    def test_invalid_query(self):
+        future = self.client.query('not an address', 'www.example.org')
+        with self.assertRaises(DNSError):
+            future.result()
+        future = self.client.query('127.0.0.1', 'www.example.org', 'BOGUS')
+        with self.assertRaises(DNSError):
+            future.result()
+
+
+class _StubDNS(object):
+    """Answers queries to each resolver as told by replies: an rcode, or
+    None for a timeout"""
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.asked = []
+
+    def query(self, server, name, qtype='A', timeout=2, **kwargs):
+        self.asked.append(server)
+        future = Future()
+        rcode = self.replies[server]
+        if rcode is None:
+            future.set_exception(DNSError('No DNS reply from %s' % server))
+        else:
+            query = build_query(1, name, qtype)
+            future.set_result(Message(_reply(
+                query, rcode, answers=['192.0.2.1'] if rcode == 0 else [])))
+        return future
+
+
+class ZoneCheckerTest(unittest.TestCase):
+    resolvers = ['192.0.2.53', '198.51.100.53']
+
+    def lookup(self, *rcodes):
+        dns = _StubDNS(dict(zip(self.resolvers, rcodes)))
+        checker = ZoneChecker(dns, self.resolvers)
+        future = checker.lookup('ns1.example.org', 'A', time.monotonic() + 2)
+        return dns.asked, future
+
+    def test_first_resolver_answers(self):
+        asked, future = self.lookup(0, 0)
+        self.assertEqual(future.result(), ['192.0.2.1'])
+        self.assertEqual(asked, self.resolvers[:1])
+
+    def test_next_resolver_after_failure(self):
+        for failure in (None, 2, 5):
+            asked, future = self.lookup(failure, 0)
+            self.assertEqual(future.result(), ['192.0.2.1'])
+            self.assertEqual(asked, self.resolvers)
+
+    def test_all_resolvers_fail(self):
+        asked, future = self.lookup(2, None)
+        with self.assertRaisesRegex(DNSError, 'No DNS reply'):
+            future.result()
+        self.assertEqual(asked, self.resolvers)
+
+    def test_negative_answer_is_final(self):
+        asked, future = self.lookup(3, 0)
+        with self.assertRaisesRegex(DNSError, 'NXDOMAIN'):
+            future.result()
+        self.assertEqual(asked, self.resolvers[:1])
+
+
+class MessageTest(unittest.TestCase):
+    def test_compression_loop(self):
+        query = build_query(1, 'www.example.org', 'A')
+        # an answer whose name points to itself
+        data = struct.pack('!HHHHHH', 1, 0x8000, 0, 1, 0, 0) + \
+            struct.pack('!HHHIH', 0xc00c, 1, 1, 300, 4) + b'\0' * 4
+        with self.assertRaises(DNSError):
+            Message(data)
+        self.assertEqual(Message(_reply(query)).question, query[12:])
+
+    def test_truncated_record(self):
+        query = build_query(1, 'www.example.org', 'A')
+        with self.assertRaises(DNSError):
+            Message(_reply(query, answers=['192.0.2.1'])[:-2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from picomon import history
+from picomon.checks import Check
+
+
+class _Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, 'history')
+        self.clock = _Clock(1000.0)
+        patch = mock.patch.object(history, 'time', self.clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def ring(self, capacity, path=None):
+        ring = history.Ring(path or self.path, capacity)
+        self.addCleanup(lambda: ring._map.closed or ring.close())
+        return ring
+
+    def records(self, since=None, until=None, path=None):
+        reader = history.Reader(path or self.path)
+        try:
+            return list(reader.records(since, until))
+        finally:
+            reader.close()
+
+    def append(self, ring, check, results, every=1.0):
+        """ Append runs of check with results, a string of '+' (success)
+        and '-' (failure) """
+        for result in results:
+            check.ok = result == '+'
+            ring.append(check, check.ok, 0.1)
+            self.clock.now += every
+
+    def test_records(self):
+        ring = self.ring(10)
+        check = Check(target_name='check')
+        check.retry_count = 2
+        check.unreachable = True
+        self.append(ring, check, '+-')
+        hid = history.check_id(check.ident)
+        self.assertEqual(
+            [(when, i, round(duration, 3), flags, retries)
+             for (when, i, duration, flags, retries) in self.records()],
+            [(1000.0, hid, 0.1, history.SUCCESS | history.OK |
+              history.UNREACHABLE, 2),
+             (1001.0, hid, 0.1, history.UNREACHABLE, 2)])
+        self.assertEqual(history.read_idents(self.path),
+                         {hid: check.ident})
+
+    def test_wrapped_ring(self):
+        ring = self.ring(10)
+        self.append(ring, Check(target_name='check'), '+' * 25)
+        reader = history.Reader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.count, 25)
+        times = [record[0] for record in self.records()]
+        # the oldest ones overwritten
+        self.assertEqual(times, [1015.0 + i for i in range(10)])
+        for since, until, expected in ((1018, None, range(1018, 1025)),
+                                       (1017.5, 1021, range(1018, 1021)),
+                                       (0, 1016, range(1015, 1016)),
+                                       (1024.5, None, ()),
+                                       (None, 1015, ())):
+            self.assertEqual([record[0] for record
+                              in self.records(since, until)],
+                             list(map(float, expected)), (since, until))
+
+    def test_records_across_chunks(self):
+        ring = self.ring(history._CHUNK + 100)
+        check = Check(target_name='check')
+        for _ in range(2 * history._CHUNK):
+            ring.append(check, True, 0.1)
+            self.clock.now += 1
+        times = [record[0] for record in self.records(since=1100 +
+                                                      history._CHUNK)]
+        self.assertEqual(times, [1100.0 + history._CHUNK + i
+                                 for i in range(history._CHUNK - 100)])
+
+    def test_reopened(self):
+        ring = self.ring(10)
+        self.append(ring, Check(target_name='check'), '++')
+        ring.close()
+        ring = self.ring(10)
+        self.append(ring, Check(target_name='check'), '+')
+        self.assertEqual(len(self.records()), 3)
+        ring.close()
+        # of another size
+        with self.assertLogs(level='WARNING'):
+            self.ring(20)
+        self.assertEqual(self.records(), [])
+        self.assertEqual(len(self.records(path=self.path + '.old')), 3)
+
+    def test_query_over_wrapped_ring(self):
+        ring = self.ring(20)
+        gone = Check(target_name='gone')
+        flappy = Check(target_name='flappy')
+        steady = Check(target_name='steady')
+        self.append(ring, gone, '-' * 10)
+        self.append(ring, flappy, '++--++-+++')
+        self.append(ring, steady, '+++++++++-')
+        # the runs of gone were overwritten
+        results = history.query(self.path)
+        self.assertEqual(set(results), {flappy.ident, steady.ident})
+        result = results[flappy.ident]
+        self.assertEqual((result['runs'], result['availability']), (10, 70.0))
+        self.assertEqual((result['failures'], result['flaps']), (2, 4))
+        self.assertEqual((result['first'], result['last']),
+                         (datetime.fromtimestamp(1010).isoformat(),
+                          datetime.fromtimestamp(1019).isoformat()))
+        result = results[steady.ident]
+        self.assertEqual((result['runs'], result['availability']), (10, 90.0))
+        self.assertEqual((result['failures'], result['flaps']), (1, 1))
+        # a window of the ring, of a single check
+        results = history.query(self.path, since=1012, until=1016,
+                                match=lambda ident: 'flappy' in ident)
+        self.assertEqual(list(results), [flappy.ident])
+        self.assertEqual(results[flappy.ident]['runs'], 4)
+        self.assertEqual(results[flappy.ident]['availability'], 50.0)
+
+    def test_percentiles(self):
+        ring = self.ring(2000)
+        check = Check(target_name='check')
+        for i in range(1, 1001):
+            ring.append(check, True, i / 1000)
+        result = history.query(self.path)[check.ident]
+        for name, exact in (('duration_p50', 0.5), ('duration_p90', 0.9),
+                            ('duration_p99', 0.99)):
+            self.assertAlmostEqual(result[name], exact, delta=exact * 0.02)
+
+    def test_rings_of_workers(self):
+        ring = self.ring(10)
+        other = self.ring(10, path=self.path + '.1')
+        first, second = Check(target_name='a'), Check(target_name='b')
+        self.append(ring, first, '+')
+        self.append(other, second, '-')
+        self.assertEqual(history.rings(self.path),
+                         [self.path, self.path + '.1'])
+        results = history.query(self.path)
+        self.assertEqual(results[first.ident]['availability'], 100.0)
+        self.assertEqual(results[second.ident]['availability'], 0.0)
+
+    def test_parse_time(self):
+        self.assertEqual(history.parse_time('30d', now=10 ** 7),
+                         10 ** 7 - 30 * 86400)
+        self.assertEqual(history.parse_time('1.5h', now=10 ** 7),
+                         10 ** 7 - 5400)
+        self.assertEqual(history.parse_time('2026-01-02T03:04'),
+                         history.parse_time('2026-01-02 03:04:00'))
+        with self.assertRaises(ValueError):
+            history.parse_time('yesterday')
+
+
+if __name__ == '__main__':
+    unittest.main()
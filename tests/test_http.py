@@ -0,0 +1,118 @@
+import http.server
+import socket
+import threading
+import unittest
+
+from picomon.probes import HTTPClient, ProbeError
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        body = ('%s %s' % (self.headers['Host'], self.path)).encode('utf-8')
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # closed without telling the client, as servers expiring kept-alive
+        # connections do
+        self.close_connection = self.server.drop
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0),
+                                                 _Handler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.status = 200
+        self.drop = False
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class HTTPClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.port = self.server.server_address[1]
+
+    def client(self, keepalive=60):
+        client = HTTPClient(2, keepalive)
+        self.addCleanup(client._executor.shutdown)
+        return client
+
+    def get(self, client, **kwargs):
+        return client.get('127.0.0.1', 2, port=self.port, **kwargs).result()
+
+    def test_keeps_connections_alive(self):
+        client = self.client()
+        first = self.get(client, url='/a')
+        second = self.get(client, url='/b')
+        self.assertEqual((first.status, first.body),
+                         (200, b'127.0.0.1 /a'))
+        self.assertEqual(second.body, b'127.0.0.1 /b')
+        self.assertFalse(first.reused)
+        self.assertTrue(second.reused)
+        self.assertIsNotNone(first.timings['connect'])
+        self.assertIsNone(second.timings['connect'])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_retries_connections_closed_by_server(self):
+        client = self.client()
+        self.server.drop = True
+        self.get(client)
+        result = self.get(client, url='/again')
+        self.assertEqual(result.body, b'127.0.0.1 /again')
+        self.assertFalse(result.reused)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_drops_idle_connections(self):
+        client = self.client(keepalive=0)
+        self.get(client)
+        self.assertFalse(self.get(client).reused)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_vhost_and_status(self):
+        self.server.status = 503
+        result = self.get(self.client(), vhost='www.example.org')
+        self.assertEqual(result.status, 503)
+        self.assertTrue(result.status_line.startswith('HTTP/1.1 503'))
+        self.assertEqual(result.body, b'www.example.org /')
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        future = self.client().get('127.0.0.1', 2, port=port)
+        with self.assertRaises(ProbeError):
+            future.result()
+
+    def test_timeout(self):
+        # accepts connections but never answers
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        self.addCleanup(sock.close)
+        future = self.client().get('127.0.0.1', 0.2,
+                                   port=sock.getsockname()[1])
+        with self.assertRaisesRegex(ProbeError, 'timed out'):
+            future.result()
+
+
+if __name__ == '__main__':
+    unittest.main()
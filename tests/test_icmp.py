@@ -0,0 +1,129 @@
+import socket
+import struct
+import time
+import unittest
+
+from picomon import probes
+from picomon.probes import Pinger, ProbeError
+from picomon.probes._icmp import checksum
+
+
+def _pinger(family):
+    try:
+        return Pinger(family, _StubLoop())
+    except OSError:
+        raise unittest.SkipTest('ICMP sockets not allowed')
+
+
+class _Timer(object):
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        self.callback(*self.args)
+
+
+class _StubLoop(object):
+    """Keeps the callbacks scheduled by a Pinger, for tests to run them"""
+
+    def __init__(self):
+        self.soon = []
+        self.timers = []
+
+    def call_soon(self, callback, *args):
+        self.soon.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        timer = _Timer(callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def add_reader(self, fd, callback):
+        pass
+
+    def run_soon(self):
+        soon, self.soon = self.soon, []
+        for callback, args in soon:
+            callback(*args)
+
+
+class ChecksumTest(unittest.TestCase):
+    def test_rfc1071(self):
+        # example of RFC 1071, section 3
+        data = bytes([0x00, 0x01, 0xf2, 0x03, 0xf4, 0xf5, 0xf6, 0xf7])
+        self.assertEqual(checksum(data), 0x220d)
+
+    def test_packet_with_checksum_sums_to_zero(self):
+        for packet in (b'\x08\0\0\0\x12\x34\0\x01payload',
+                       b'\x08\0\0\0\x12\x34\0\x01odd'):
+            packet = packet[:2] + struct.pack('!H', checksum(packet)) + \
+                packet[4:]
+            self.assertEqual(checksum(packet), 0)
+
+
+class PingerTest(unittest.TestCase):
+    def setUp(self):
+        self.pinger = _pinger(socket.AF_INET)
+        self.addCleanup(self.pinger._sock.close)
+        self.loop = self.pinger._loop
+
+    def read(self, future):
+        deadline = time.monotonic() + 2
+        while not future.done() and time.monotonic() < deadline:
+            time.sleep(0.01)
+            self.pinger._Pinger__read()
+
+    def test_reply(self):
+        future = self.pinger.ping('127.0.0.1', 0.5)
+        self.loop.run_soon()
+        self.read(future)
+        self.assertGreaterEqual(future.result(), 0)
+        self.assertTrue(self.loop.timers[0].cancelled)
+        self.assertEqual(self.pinger._pending, {})
+
+    def test_timeout(self):
+        future = self.pinger.ping('127.0.0.1', 0.5)
+        self.loop.run_soon()
+        self.loop.timers[0].fire()
+        with self.assertRaisesRegex(ProbeError, 'No ICMP echo reply from '
+                                    '127.0.0.1 within 0.5s'):
+            future.result()
+        # a late reply is ignored
+        time.sleep(0.05)
+        self.pinger._Pinger__read()
+        self.assertEqual(self.pinger._pending, {})
+
+    def test_sequence_numbers_in_flight_are_skipped(self):
+        futures = [self.pinger.ping('127.0.0.1', 0.5) for _ in range(3)]
+        self.pinger._seq = 0xffff
+        self.loop.run_soon()
+        self.assertEqual(sorted(self.pinger._pending), [0, 1, 2])
+        for future in futures:
+            self.read(future)
+            self.assertGreaterEqual(future.result(), 0)
+
+    def test_invalid_address(self):
+        future = self.pinger.ping('not an address', 0.5)
+        self.loop.run_soon()
+        with self.assertRaisesRegex(ProbeError, 'Invalid address'):
+            future.result()
+        self.assertEqual(self.loop.timers, [])
+
+
+class SharedPingerTest(unittest.TestCase):
+    def test_concurrent_pings(self):
+        pinger = probes.pinger(socket.AF_INET)
+        if pinger is None:
+            self.skipTest('ICMP sockets not allowed')
+        futures = [pinger.ping('127.0.0.1', 2) for _ in range(50)]
+        for future in futures:
+            self.assertGreaterEqual(future.result(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from picomon import config
+from picomon import mails
+from picomon import shards
+from picomon.checks import Check
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of SMTP for smtplib to send emails"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost')
+        for line in self.rfile:
+            command = line.decode('ascii').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 localhost')
+            elif command.startswith('MAIL'):
+                self.reply('250 ok')
+            elif command.startswith('RCPT'):
+                self.reply(server.rcpt_reply)
+            elif command == 'DATA':
+                self.reply('354 go on')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.received.append(b''.join(data))
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class _SMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), _SMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.received = []
+        self.rcpt_reply = '250 ok'
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def address(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ThreadedSMTPTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _SMTPServer()
+        self.addCleanup(self.server.stop)
+        self.spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool)
+        for name, value in (('smtp_host', self.server.address),
+                            ('smtp_retry_timeout', 0.05),
+                            ('smtp_retry_max', 0.2)):
+            self.addCleanup(config.emails.__setattr__, name,
+                            config.emails[name])
+            config.emails[name] = value
+
+    def mailer(self, **kwargs):
+        mailer = mails.ThreadedSMTP(**kwargs)
+        self.addCleanup(mailer.quit)
+        return mailer
+
+    def send(self, mailer, n):
+        for i in range(n):
+            mailer.sendmail('picomon@localhost', ['root@localhost'],
+                            'Subject: %d\r\n\r\nbody %d\r\n' % (i, i))
+
+    def test_sends_all_batches(self):
+        mailer = self.mailer(senders=2, batch=5)
+        self.send(mailer, 30)
+        self.assertTrue(_wait_for(lambda: mailer.counters['sent'] == 30))
+        mailer.quit()
+        self.assertEqual(len(self.server.received), 30)
+        self.assertEqual(mailer.counters['queued'], 30)
+        self.assertEqual(mailer.qsize(), 0)
+        # connections are kept open between emails
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_spooled_until_sent(self):
+        self.server.rcpt_reply = '451 try again later'
+        mailer = self.mailer(batch=5, spool=self.spool)
+        self.send(mailer, 3)
+        self.assertTrue(_wait_for(lambda: mailer.counters['retried'] >= 3))
+        mailer.quit()
+        self.assertEqual(self.server.received, [])
+        self.assertEqual(len(os.listdir(self.spool)), 3)
+        # sent on next start
+        self.server.rcpt_reply = '250 ok'
+        mailer = self.mailer(batch=5, spool=self.spool)
+        self.assertTrue(_wait_for(lambda: mailer.counters['sent'] == 3))
+        self.assertEqual(len(self.server.received), 3)
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_retries_temporary_failures(self):
+        self.server.rcpt_reply = '451 try again later'
+        mailer = self.mailer(spool=self.spool)
+        self.send(mailer, 2)
+        self.assertTrue(_wait_for(lambda: mailer.counters['retried'] >= 2))
+        self.server.rcpt_reply = '250 ok'
+        self.assertTrue(_wait_for(lambda: mailer.counters['sent'] == 2))
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_drops_permanent_failures(self):
+        self.server.rcpt_reply = '550 no such user'
+        mailer = self.mailer(spool=self.spool)
+        self.send(mailer, 2)
+        self.assertTrue(_wait_for(lambda: mailer.counters['failed'] == 2))
+        self.assertEqual(mailer.counters['retried'], 0)
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_drops_when_queue_full(self):
+        mailer = self.mailer(senders=0, maxsize=2)
+        self.send(mailer, 3)
+        self.assertEqual(mailer.counters['dropped'], 1)
+        self.assertEqual(mailer.qsize(), 2)
+
+
+class CheckEmailTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        patches = [
+            mock.patch.object(mails, 'send_email',
+                              lambda subject, text, headers:
+                              self.sent.append(text)),
+            mock.patch.object(mails, '_coalescer', mails.Coalescer(0))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_recovery_counts_retries_of_failing_streak(self):
+        check = Check(target_name='flappy', retry=3)
+        for success in (False, False, False, False, True):
+            check.record(success)
+        self.assertEqual(len(self.sent), 2)
+        self.assertIn('failure', self.sent[0])
+        self.assertTrue(self.sent[1].endswith('(2 retries).'), self.sent[1])
+        # once more, with the state given by a worker process
+        self.sent = []
+        for success in (False, False, False, True):
+            check.record(success)
+        other = Check(target_name='flappy', retry=3)
+        other.ok = False
+        shards.apply_state(other, shards.state_record(0, check))
+        mails.send_email_for_check(other)
+        self.assertTrue(self.sent[-1].endswith('(1 retry).'), self.sent[-1])
+
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.digests = []
+        patches = [
+            mock.patch.object(mails, 'send_email_for_check',
+                              lambda check: self.sent.append(check.ok)),
+            mock.patch.object(mails, 'send_digest',
+                              lambda changed, flapping: self.digests.append(
+                                  ([c.ok for c in changed], len(flapping))))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.check = Check(target_name='flappy')
+
+    def change(self, coalescer, ok):
+        self.check.ok = ok
+        coalescer.notify(self.check)
+
+    def test_lone_changes_without_window(self):
+        coalescer = mails.Coalescer(0)
+        self.change(coalescer, False)
+        self.change(coalescer, True)
+        self.assertEqual(self.sent, [False, True])
+        self.assertEqual(self.digests, [])
+
+    def test_flapping_settles_to_failed_without_window(self):
+        coalescer = mails.Coalescer(0, flap_window=0.3, flap_threshold=3)
+        coalescer.settle_every = 0.05
+        self.change(coalescer, False)
+        self.change(coalescer, True)
+        self.change(coalescer, False)
+        self.assertEqual(self.sent, [False, True])
+        # reported as flapping, then nothing until it settles
+        self.assertEqual(self.digests, [([], 1)])
+        self.assertTrue(_wait_for(lambda: len(self.sent) == 3))
+        self.assertEqual(self.sent[-1], False)
+
+    def test_flapping_settles_to_failed_with_window(self):
+        coalescer = mails.Coalescer(0.05, flap_window=0.3, flap_threshold=3)
+        for ok in (False, True, False):
+            self.change(coalescer, ok)
+            time.sleep(0.1)
+        self.assertTrue(_wait_for(lambda: self.sent and
+                                  self.sent[-1] is False and
+                                  not coalescer._flapping))
+
+    def test_flapping_settles_to_last_notified_state(self):
+        coalescer = mails.Coalescer(0, flap_window=0.3, flap_threshold=3)
+        coalescer.settle_every = 0.05
+        for ok in (False, True, False, True):
+            self.change(coalescer, ok)
+        self.assertEqual(self.sent, [False, True])
+        self.assertTrue(_wait_for(lambda: not coalescer._flapping))
+        # back ok, as last notified
+        self.assertEqual(self.sent, [False, True])
+
+    def test_settled_checks_are_forgotten(self):
+        coalescer = mails.Coalescer(0, flap_window=0.1, flap_threshold=3)
+        coalescer.settle_every = 0.05
+        others = [Check(target_name='other %d' % i) for i in range(50)]
+        for check in others:
+            check.ok = False
+            coalescer.notify(check)
+        for ok in (False, True, False):
+            self.change(coalescer, ok)
+        self.assertEqual(len(coalescer._history), 51)
+        self.assertTrue(_wait_for(lambda: not coalescer._flapping))
+        time.sleep(0.15)
+        coalescer.flush()
+        self.assertEqual(coalescer._history, {})
+        self.assertEqual(coalescer._notified, {})
+
+    def test_forgets_removed_checks(self):
+        coalescer = mails.Coalescer(60, flap_window=60, flap_threshold=3)
+        for ok in (False, True, False):
+            self.change(coalescer, ok)
+        self.assertIn(self.check, coalescer._flapping)
+        coalescer.forget([self.check])
+        self.assertEqual(coalescer._history, {})
+        self.assertEqual(coalescer._notified, {})
+        self.assertEqual(coalescer._flapping, set())
+        self.assertEqual(len(coalescer._pending), 0)
+        coalescer._timer.cancel()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+from picomon import probes
+from picomon.checks import Check
+from picomon.probes import ProcessReactor
+
+
+def _gone(pid):
+    """ Whether process pid exited (and may wait to be reaped) """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] == 'Z'
+    except FileNotFoundError:
+        return True
+
+
+class ProcessReactorTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = ProcessReactor(probes.get_loop(), 1000)
+
+    def run_command(self, command, timeout=5):
+        return self.reactor.spawn(command, timeout).result(timeout + 5)
+
+    def test_output_and_status(self):
+        result = self.run_command(
+            ['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual((result.returncode, result.out, result.err),
+                         (3, b'out\n', b'err\n'))
+        self.assertFalse(result.timed_out)
+        self.assertFalse(result.truncated)
+        self.assertEqual(sorted(result.timings), ['run', 'spawn'])
+
+    def test_output_is_truncated(self):
+        result = self.run_command(['head', '-c', '100000', '/dev/zero'])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.out, b'\0' * 1000)
+        self.assertTrue(result.truncated)
+
+    def test_timeout_kills_process_group(self):
+        start = time.monotonic()
+        result = self.run_command(
+            ['sh', '-c', 'sleep 30 & echo $!; wait'], timeout=0.3)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(result.timed_out)
+        # the grand-child too
+        pid = int(result.out)
+        deadline = time.monotonic() + 5
+        while not _gone(pid) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(_gone(pid))
+
+    def test_without_pidfd(self):
+        with mock.patch.object(os, 'pidfd_open', side_effect=OSError,
+                               create=True):
+            result = self.run_command(['sh', '-c', 'exit 2'])
+        self.assertEqual(result.returncode, 2)
+
+    def test_missing_command(self):
+        future = self.reactor.spawn(['/nonexistent/command'], 1)
+        with self.assertRaises(OSError):
+            future.result(5)
+
+    def test_concurrent_commands(self):
+        futures = [self.reactor.spawn(['sh', '-c', 'echo %d' % i], 5)
+                   for i in range(50)]
+        self.assertEqual([future.result(10).out for future in futures],
+                         [b'%d\n' % i for i in range(50)])
+
+
+class SpawnTest(unittest.TestCase):
+    def test_result_and_timings(self):
+        check = Check(target_name='spawned')
+        self.assertTrue(check.exec_with_timeout(['sh', '-c', 'echo ok'],
+                                                pattern='ok'))
+        self.assertEqual(sorted(check.timings), ['parse', 'run', 'spawn'])
+        self.assertFalse(check.exec_with_timeout(['sh', '-c', 'exit 1']))
+        self.assertFalse(check.exec_with_timeout(['sleep', '5'], timeout=0.2))
+        self.assertEqual(check.errmsg, 'Operation timed out\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
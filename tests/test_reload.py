@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+from picomon import checks
+from picomon import config
+from picomon import reload
+
+CONFIG = '''
+from picomon import config
+from picomon.checks import Check4, Host
+config.default_every = 7
+config.default_native = False
+config.checks.add(Check4, [Host(ipv4='192.0.2.7')])
+'''
+
+
+class EvaluateTest(unittest.TestCase):
+    def write(self, text):
+        fd, path = tempfile.mkstemp(suffix='.py')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def test_checks_take_defaults_of_new_tree(self):
+        every, native = config.default_every, config.default_native
+        tree = reload.evaluate(self.write(CONFIG))
+        self.assertEqual([(c.every, c.native) for c in tree.checks],
+                         [(7, False)])
+        # the running tree is left untouched
+        self.assertEqual((config.default_every, config.default_native),
+                         (every, native))
+        self.assertIsNone(checks.loading.config)
+
+    def test_failed_evaluation_restores_defaults(self):
+        path = self.write(CONFIG + 'raise RuntimeError("broken")\n')
+        with self.assertRaises(RuntimeError):
+            reload.evaluate(path)
+        self.assertIsNone(checks.loading.config)
+        self.assertEqual(checks.Check(target_name='x').every,
+                         config.default_every)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import io
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from picomon import mails
+from picomon import report
+from picomon.checks import Check
+from picomon.report import (FAILED, OK, RETRYING, UNREACHABLE, Reporter,
+                            StateIndex)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def _set_failed(check, ago=0):
+    check.ok = False
+    check.retry_count = 1
+    check.errmsg = 'down'
+    check.failure_date = datetime.now() - timedelta(seconds=ago)
+
+
+class StateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.checks = [Check(target_name='check %d' % i) for i in range(4)]
+        self.index = StateIndex()
+
+    def change(self, check, **attrs):
+        before = report.state_of(check)
+        for name, value in attrs.items():
+            setattr(check, name, value)
+        self.index.update(check, before)
+
+    def test_reset(self):
+        _set_failed(self.checks[0], ago=10)
+        _set_failed(self.checks[1], ago=20)
+        self.checks[2].retry_count = 1
+        self.index.reset(self.checks)
+        self.assertEqual(self.index.counts, {OK: 1, RETRYING: 1, FAILED: 2,
+                                             UNREACHABLE: 0})
+        # oldest failure first
+        self.assertEqual(self.index.checks(FAILED),
+                         [self.checks[1], self.checks[0]])
+        self.assertEqual(self.index.checks(RETRYING), [self.checks[2]])
+
+    def test_transitions(self):
+        self.index.reset(self.checks)
+        check = self.checks[0]
+        self.change(check, retry_count=1)
+        self.assertEqual(self.index.checks(RETRYING), [check])
+        self.change(check, ok=False, failure_date=datetime.now())
+        self.change(self.checks[1], ok=False, failure_date=datetime.now())
+        self.assertEqual(self.index.checks(RETRYING), [])
+        self.assertEqual(self.index.checks(FAILED), self.checks[:2])
+        self.change(check, ok=True, retry_count=0)
+        self.change(self.checks[2], unreachable=True)
+        self.assertEqual(self.index.checks(FAILED), [self.checks[1]])
+        self.assertEqual(self.index.checks(UNREACHABLE), [self.checks[2]])
+        self.assertEqual(self.index.counts, {OK: 2, RETRYING: 0, FAILED: 1,
+                                             UNREACHABLE: 1})
+
+    def test_removed_checks_are_ignored(self):
+        self.index.reset(self.checks[1:], removed=self.checks[:1])
+        self.change(self.checks[0], ok=False, failure_date=datetime.now())
+        self.assertEqual(self.index.checks(FAILED), [])
+        self.assertEqual(self.index.counts[OK], 3)
+
+    def test_listeners(self):
+        self.index.reset(self.checks)
+        changes = []
+
+        def listener(*change):
+            changes.append(change)
+
+        self.index.listen(listener)
+        self.change(self.checks[0], retry_count=1)
+        self.change(self.checks[0], retry_count=2)
+        self.index.unlisten(listener)
+        self.change(self.checks[0], retry_count=0)
+        self.assertEqual(changes, [(self.checks[0], OK, RETRYING)])
+
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self.checks = [Check(target_name='check %d' % i) for i in range(4)]
+        _set_failed(self.checks[0], ago=600)
+        _set_failed(self.checks[1], ago=10)
+        self.checks[2].retry_count = 1
+        index = StateIndex()
+        index.reset(self.checks)
+        patch = mock.patch.object(report, 'index', index)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_create_report(self):
+        text, err = report.create_report()
+        self.assertTrue(err)
+        self.assertEqual(text.count('check 0: '), 1)
+        self.assertEqual(text.count('check 1: '), 1)
+        self.assertIn('Check %s is retrying' % self.checks[2], text)
+        self.assertIn('1 check(s) OK, 1 retrying, 2 in error, '
+                      '0 unreachable', text)
+
+    def test_old_and_acknowledged_failures(self):
+        text, err = report.create_report(older_than=timedelta(seconds=60))
+        self.assertIn('check 0: ', text)
+        self.assertNotIn('check 1: ', text)
+        self.checks[0].ack_date = self.checks[0].failure_date
+        text, err = report.create_report(older_than=timedelta(seconds=60),
+                                         acknowledged=False)
+        self.assertFalse(err)
+        self.assertNotIn('check 0: ', text)
+
+    def test_reporter(self):
+        reporter = Reporter()
+        mailed = []
+        stdout = io.StringIO()
+        with mock.patch.object(report.sys, 'stdout', stdout), \
+                mock.patch.object(mails, 'send_email_report', mailed.append):
+            reporter.dump()
+            reporter.mail(60)
+            self.assertTrue(_wait_for(lambda: mailed))
+        self.assertIn('printing state of checks', stdout.getvalue())
+        self.assertIn('failed for more than 60s', mailed[0])
+        self.assertIn('check 0: ', mailed[0])
+        self.assertNotIn('check 1: ', mailed[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
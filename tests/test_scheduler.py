@@ -0,0 +1,38 @@
+import unittest
+from unittest import mock
+
+from picomon import scheduler
+from picomon.checks import Check
+
+
+class _Check(Check):
+    def __init__(self, result, **options):
+        super().__init__(**options)
+        self.result = result
+
+    def check(self):
+        return self.result
+
+
+class _BrokenCheck(Check):
+    def setup(self):
+        raise RuntimeError('broken')
+
+
+class RunThreadsTest(unittest.TestCase):
+    def test_once(self):
+        checks = [_Check(True, target_name='up'),
+                  _Check(False, target_name='down')]
+        self.assertEqual(scheduler.run_threads(checks, 1, 2, once=True),
+                         [True, False])
+
+    def test_once_survives_checks_failing_to_start(self):
+        checks = [_Check(True, target_name='up'),
+                  _BrokenCheck(target_name='broken')]
+        with mock.patch('traceback.print_exc'):
+            self.assertEqual(scheduler.run_threads(checks, 1, 2, once=True),
+                             [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing import Pipe
+from unittest import mock
+
+from picomon import config
+from picomon import mails
+from picomon import reload
+from picomon import report
+from picomon import shards
+from picomon.checks import Check, Check4, Host
+
+CONFIG = '''
+import os
+from picomon import config
+from picomon.checks import Check
+
+
+class Flag(Check):
+    """Fails while its flag file exists"""
+    __slots__ = ()
+
+    def check(self):
+        self.errmsg = 'flag set'
+        return not os.path.exists(%(flag)r)
+
+
+config.base_tick = 0.05
+config.checks += [Flag(target_name='target %%d' %% i, retry=2)
+                  for i in range(4)]
+'''
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class PlanTest(unittest.TestCase):
+    def test_shards_by_target(self):
+        host = Host(ipv4='192.0.2.1')
+        checks = [Check4(host), Check4(host, retry=3),
+                  Check4(Host(ipv4='192.0.2.2'))]
+        owners = [shards.shard_of(check, 4) for check in checks]
+        self.assertEqual(owners[0], owners[1])
+        self.assertTrue(all(0 <= owner < 4 for owner in owners))
+
+    def test_relays_to_owners_of_dependent_checks(self):
+        parent = Check(target_name='parent')
+        child = Check(target_name='child', depends=[parent])
+        other = Check(target_name='other', depends=[parent])
+        owners = {'parent': 0, 'child': 1, 'other': 0}
+        self.assertEqual(shards.plan([parent, child, other],
+                                     lambda c: owners[c.target_name]),
+                         ([0, 1, 0], {0: {1}}))
+
+    def test_digest(self):
+        checks = [Check(target_name='check %d' % i) for i in range(3)]
+        self.assertEqual(shards.digest(checks),
+                         shards.digest([Check(target_name='check %d' % i)
+                                        for i in range(3)]))
+        self.assertNotEqual(shards.digest(checks),
+                            shards.digest(checks[::-1]))
+
+
+class RecordTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(mails, 'notify')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_round_trip(self):
+        check = Check(target_name='check', retry=3)
+        for success in (False, False, False, False, True, False):
+            check.record(success)
+        other = Check(target_name='check', retry=3)
+        shards.apply_state(other, shards.state_record(0, check))
+        for attr in ('ok', 'retry_count', 'recovered_after', 'unreachable',
+                     'checked_at', 'failing_since', 'failure_date', 'errmsg'):
+            self.assertEqual(getattr(other, attr), getattr(check, attr))
+
+    def test_times_as_ages(self):
+        check = Check(target_name='check')
+        check.record(False)
+        record = shards.state_record(0, check, now=check.checked_at + 5)
+        other = Check(target_name='check')
+        shards.apply_state(other, record, now=100)
+        self.assertAlmostEqual(other.checked_at, 95)
+        self.assertAlmostEqual(other.failing_since, 95)
+
+
+class WorkerTest(unittest.TestCase):
+    def test_forwards_changes_only(self):
+        checks = [Check(target_name='check %d' % i) for i in range(8)]
+        coordinator, conn = Pipe()
+        self.addCleanup(coordinator.close)
+        self.addCleanup(conn.close)
+        worker = shards.Worker(conn, checks, 0, 2, 60)
+        self.assertTrue(worker.local)
+        check = worker.local[0]
+        i = checks.index(check)
+        check.retry_count = 1
+        worker.forward(check)
+        worker.forward(check)
+        check.ok = False
+        worker.forward(check)
+        received = []
+        while coordinator.poll(0.1):
+            received.append(coordinator.recv())
+        self.assertEqual([(kind, [record[:3] for record in records])
+                          for kind, records in received],
+                         [('records', [(i, True, 1)]),
+                          ('records', [(i, False, 1)])])
+
+
+class CoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.flag = os.path.join(tmp, 'flag')
+        self.configfile = os.path.join(tmp, 'shards_config.py')
+        with open(self.configfile, 'w') as f:
+            f.write(CONFIG % {'flag': self.flag})
+        # the coordinator plans over the checks of the running configuration
+        tree = reload.evaluate(self.configfile)
+        self.addCleanup(setattr, config, 'checks', config.checks)
+        config.checks = tree.checks
+        index = report.StateIndex()
+        index.reset(tree.checks)
+        self.mailed = []
+        patches = [mock.patch.object(report, 'index', index),
+                   mock.patch.object(mails, '_coalescer', mails.Coalescer(0)),
+                   mock.patch.object(mails, 'send_email',
+                                     lambda subject, text, headers:
+                                     self.mailed.append(text))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def start(self):
+        coordinator = shards.Coordinator(self.configfile, 2, 0.1, 'WARNING')
+        coordinator.restart_delay = 3600
+        thread = threading.Thread(target=coordinator.run)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(_wait_for(lambda: len(coordinator._processes) == 2))
+        self.addCleanup(self.stop, coordinator)
+        return coordinator
+
+    def stop(self, coordinator):
+        for process in list(coordinator._processes.values()):
+            process.terminate()
+            process.join()
+
+    def test_applies_records_of_workers(self):
+        open(self.flag, 'w').close()
+        coordinator = self.start()
+        self.assertTrue(_wait_for(lambda: all(not check.ok for check
+                                              in coordinator.checks)))
+        self.assertEqual(coordinator.checks[0].errmsg, 'flag set')
+        self.assertTrue(_wait_for(lambda: len(self.mailed) == 4))
+        os.unlink(self.flag)
+        self.assertTrue(_wait_for(lambda: len(self.mailed) == 8))
+        for text in self.mailed[4:]:
+            retries = re.search(r'recovered after .* \((\d+) retr', text)
+            self.assertIsNotNone(retries, text)
+            self.assertGreaterEqual(int(retries.group(1)), 1)
+        self.assertEqual(report.index.counts[report.OK], 4)
+        # run statistics, for metrics
+        self.assertTrue(_wait_for(lambda: all(
+            check.stats.successes > 0 for check in coordinator.checks)))
+
+    def test_restart(self):
+        coordinator = self.start()
+        pids = set(p.pid for p in coordinator._processes.values())
+        coordinator.restart()
+        self.assertTrue(_wait_for(lambda: len(coordinator._processes) == 2 and
+                                  pids.isdisjoint(
+                                      p.pid for p in
+                                      coordinator._processes.values())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import time
+import unittest
+from concurrent.futures import Future
+
+from picomon.checks import Check
+from picomon.sharing import SharedResults
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class SharedResultsTest(unittest.TestCase):
+    def test_shares_recent_results(self):
+        shared = SharedResults(60)
+        check, other = Check(target_name='a'), Check(target_name='a')
+        check.errmsg = 'down'
+        shared.publish(check, _done(False))
+        self.assertIsNone(shared.subscribe(check))
+        self.assertFalse(shared.subscribe(other).result())
+        self.assertEqual(other.errmsg, 'down')
+        self.assertEqual(shared.hits, 1)
+
+    def test_expired_runs_are_dropped(self):
+        shared = SharedResults(0.05)
+        checks = [Check(target_name='check %d' % i) for i in range(10)]
+        for check in checks:
+            shared.publish(check, _done(True))
+        time.sleep(0.1)
+        self.assertIsNone(shared.subscribe(Check(target_name='check 0')))
+        last = Check(target_name='last')
+        shared.publish(last, Future())
+        self.assertEqual(list(shared._runs), [last.probe_key])
+
+
+if __name__ == '__main__':
+    unittest.main()
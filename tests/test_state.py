@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from picomon.checks import Check
+from picomon.state import StateStore
+
+
+def _checks():
+    return [Check(target_name='check %d' % i) for i in range(3)]
+
+
+class StateStoreTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, 'state')
+
+    def load(self, checks):
+        """ Return a store loaded with checks, and how many were restored """
+        store = StateStore(self.path, 60)
+        self.addCleanup(lambda: store._journal and store._journal.close())
+        return store, store.load(checks)
+
+    def store(self, checks):
+        return self.load(checks)[0]
+
+    def set_failed(self, check):
+        check.ok = False
+        check.retry_count = 3
+        check.errmsg = 'down'
+        check.failure_date = datetime(2020, 1, 2, 3, 4, 5)
+        check.mails_msgid = '<1@picomon>'
+        check.muted = True
+        check.ack_date = check.failure_date
+        latency = check.stats.latency
+        latency.mean, latency.deviation, latency.samples = 0.5, 0.1, 64
+
+    def assertRestored(self, check):
+        self.assertEqual((check.ok, check.retry_count, check.errmsg,
+                          check.failure_date, check.mails_msgid, check.muted,
+                          check.ack_date),
+                         (False, 3, 'down', datetime(2020, 1, 2, 3, 4, 5),
+                          '<1@picomon>', True, datetime(2020, 1, 2, 3, 4, 5)))
+        latency = check.stats.latency
+        self.assertEqual((latency.mean, latency.deviation, latency.samples),
+                         (0.5, 0.1, 64))
+
+    def test_round_trip_through_journal(self):
+        checks = _checks()
+        store = self.store(checks)
+        self.set_failed(checks[1])
+        store.mark(checks[1])
+        store.flush()
+        # not compacted yet
+        with open(self.path) as f:
+            self.assertEqual(f.read(), '')
+        checks = _checks()
+        self.assertEqual(self.load(checks)[1], 1)
+        self.assertRestored(checks[1])
+        self.assertTrue(checks[0].ok)
+        self.assertIsNone(checks[0].ack_date)
+
+    def test_round_trip_through_snapshot(self):
+        checks = _checks()
+        store = self.store(checks)
+        self.set_failed(checks[1])
+        store.mark(checks[1])
+        store.flush()
+        store.compact()
+        self.assertEqual(os.path.getsize(self.path + '.journal'), 0)
+        checks = _checks()
+        self.assertEqual(self.store(checks)._records.keys(),
+                         {checks[1].ident})
+        self.assertRestored(checks[1])
+
+    def test_journal_overrides_snapshot(self):
+        checks = _checks()
+        store = self.store(checks)
+        self.set_failed(checks[1])
+        store.mark(checks[1])
+        store.flush()
+        store.compact()
+        checks[1].ok = True
+        checks[1].retry_count = 0
+        store.mark(checks[1])
+        store.flush()
+        checks = _checks()
+        self.store(checks)
+        self.assertEqual((checks[1].ok, checks[1].retry_count), (True, 0))
+
+    def test_partly_written_record_is_skipped(self):
+        checks = _checks()
+        store = self.store(checks)
+        self.set_failed(checks[1])
+        store.mark(checks[1])
+        store.flush()
+        with open(self.path + '.journal', 'a') as f:
+            f.write(json.dumps({'id': checks[2].ident, 'ok': False})[:20])
+        checks = _checks()
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(self.load(checks)[1], 1)
+        self.assertRestored(checks[1])
+        self.assertTrue(checks[2].ok)
+
+    def test_removed_checks_are_forgotten(self):
+        checks = _checks()
+        store = self.store(checks)
+        for check in checks:
+            store.mark(check)
+        store.flush()
+        self.store(checks[:2])
+        with open(self.path) as f:
+            self.assertEqual([json.loads(line)['id'] for line in f],
+                             [check.ident for check in checks[:2]])
+
+    def test_restores_added_checks(self):
+        checks = _checks()
+        store = self.store(checks)
+        self.set_failed(checks[2])
+        store.mark(checks[2])
+        store.flush()
+        store = self.store(checks)
+        added = Check(target_name='check 2')
+        store.restore([added])
+        self.assertRestored(added)
+
+    def test_journal_is_compacted(self):
+        checks = _checks()
+        store = self.store(checks)
+        for i in range(1001):
+            checks[0].retry_count = i
+            store.mark(checks[0])
+            store.flush()
+        self.assertEqual(store._journal_size, 0)
+        with open(self.path) as f:
+            self.assertEqual(json.loads(f.read())['retry_count'], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()